@@ -0,0 +1,11 @@
+"""
+iodeflib benchmarks
+
+- corpus: generator of synthetic IODEF documents
+- run: throughput and peak memory of parsing, serialization and queries,
+  with the lxml and ElementTree backends
+- memory: memory used by Incident objects, default and compact classes
+
+usage, from the root of the source tree:
+    python -m benchmarks.run [options]
+"""
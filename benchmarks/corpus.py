@@ -0,0 +1,173 @@
+"""
+corpus.py - synthetic IODEF corpus generator for the iodeflib benchmarks
+
+Generate IODEF documents with a configurable number of incidents and
+subelements, using the iodeflib API to create objects (Incident.add_system,
+Incident.add_impact, ...). The same parameters and seed always produce the
+same document, so that results of different runs can be compared.
+
+usage: python -m benchmarks.corpus [options] output_file
+"""
+
+import sys, time, random, optparse
+
+import iodeflib
+
+
+# default parameters of generate_document, see make_incident:
+DEFAULTS = dict(
+    incidents = 1000,
+    event_data = 1,
+    flows = 1,
+    systems = 2,
+    addresses = 1,
+    payload = 64,
+    history = 2,
+    seed = 0,
+    )
+
+# values used for enumerated attributes, from RFC 5070:
+IMPACT_TYPES = ('admin', 'dos', 'extortion', 'file', 'info-leak', 'misconfiguration',
+    'recon', 'policy', 'social-engineering', 'user', 'unknown')
+SEVERITIES = ('low', 'medium', 'high')
+COMPLETIONS = ('failed', 'succeeded')
+RESTRICTIONS = ('public', 'need-to-know', 'private', 'default')
+HISTORY_ACTIONS = ('nothing', 'contact-source-site', 'contact-target-site',
+    'investigate', 'block-host', 'block-network', 'block-port',
+    'rate-limit-host', 'remediate-other', 'status-triage', 'status-new-info')
+
+# report time of the first incident (2012-01-01 00:00:00 UTC):
+BASE_TIME = 1325376000
+
+
+def format_time(seconds):
+    "return a DateTime string for a number of seconds since the epoch"
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(seconds))
+
+
+def random_ipv4(rng):
+    "return a random IPv4 address, as a string"
+    return '%d.%d.%d.%d' % (rng.randint(1, 223), rng.randint(0, 255),
+        rng.randint(0, 255), rng.randint(1, 254))
+
+
+def random_payload(rng, size):
+    "return a random string of hexadecimal digits with the given size"
+    if size <= 0:
+        return ''
+    return ('%x' % rng.getrandbits(size * 4)).zfill(size)
+
+
+def make_incident(rng, number, event_data=1, flows=1, systems=2, addresses=1,
+    payload=64, history=2):
+    """
+    return a new Incident object, with random values from rng.
+    - number: incident number, used for its id and times
+    - event_data: number of EventData elements in the incident
+    - flows: number of Flow elements in each EventData
+    - systems: number of System elements in each Flow, alternately sources
+      and targets
+    - addresses: number of Address elements in each System
+    - payload: size of the AdditionalData of the incident in bytes (none if 0)
+    - history: number of HistoryItem elements
+    """
+    report_time = BASE_TIME + number * 60
+    incident = iodeflib.Incident(id=str(number), id_name='CSIRT-BENCH',
+        report_time=format_time(report_time),
+        start_time=format_time(report_time - rng.randint(60, 86400)),
+        descriptions=['Synthetic incident %d' % number],
+        restriction=rng.choice(RESTRICTIONS))
+    incident.add_impact(description='Impact of incident %d' % number,
+        type=rng.choice(IMPACT_TYPES), severity=rng.choice(SEVERITIES),
+        completion=rng.choice(COMPLETIONS), occurence='actual')
+    for i in xrange(event_data):
+        ev = iodeflib.EventData()
+        incident.event_data.append(ev)
+        for j in xrange(flows):
+            flow = iodeflib.Flow()
+            ev.flows.append(flow)
+            for k in xrange(systems):
+                if k % 2 == 0:
+                    category = 'source'
+                else:
+                    category = 'target'
+                system = incident.add_system(category=category,
+                    name='host%d.example.com' % rng.randint(0, 99999),
+                    address=random_ipv4(rng), event_data=ev, flow=flow)
+                for n in xrange(addresses - 1):
+                    system.node_addresses.append(iodeflib.Address(
+                        address=random_ipv4(rng)))
+    if payload > 0:
+        incident.additional_data.append(iodeflib.AdditionalData(
+            data=random_payload(rng, payload), dtype='string',
+            meaning='payload'))
+    for i in xrange(history):
+        incident.history.append(iodeflib.HistoryItem(
+            action=rng.choice(HISTORY_ACTIONS),
+            datetime=format_time(report_time + (i+1) * 600),
+            descriptions=['Action %d on incident %d' % (i+1, number)]))
+    return incident
+
+
+def generate_document(incidents=1000, seed=0, **params):
+    """
+    return a new IODEF_Document object containing synthetic incidents.
+    - incidents: number of Incident elements
+    - seed: seed of the random generator
+    (see make_incident for the other parameters)
+    """
+    rng = random.Random(seed)
+    document = iodeflib.IODEF_Document()
+    for number in xrange(incidents):
+        document.incidents.append(make_incident(rng, number, **params))
+    return document
+
+
+def write_corpus(filename, **params):
+    """
+    generate a synthetic IODEF document and write it to an XML file.
+    return the number of incidents.
+    (see generate_document for the parameters)
+    """
+    document = generate_document(**params)
+    document.write(filename)
+    return len(document.incidents)
+
+
+def add_options(parser):
+    "add the options of the corpus generator to an OptionParser"
+    parser.add_option('-n', '--incidents', type='int',
+        default=DEFAULTS['incidents'], help='number of incidents per document')
+    parser.add_option('--event-data', type='int',
+        default=DEFAULTS['event_data'], help='EventData per incident')
+    parser.add_option('--flows', type='int', default=DEFAULTS['flows'],
+        help='Flows per EventData')
+    parser.add_option('--systems', type='int', default=DEFAULTS['systems'],
+        help='Systems per Flow')
+    parser.add_option('--addresses', type='int',
+        default=DEFAULTS['addresses'], help='Addresses per System')
+    parser.add_option('--payload', type='int', default=DEFAULTS['payload'],
+        help='AdditionalData size per incident, in bytes')
+    parser.add_option('--history', type='int', default=DEFAULTS['history'],
+        help='HistoryItems per incident')
+    parser.add_option('--seed', type='int', default=DEFAULTS['seed'],
+        help='seed of the random generator')
+
+
+def get_params(options):
+    "return the corpus parameters from options parsed by OptionParser"
+    return dict((name, getattr(options, name)) for name in DEFAULTS)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] output_file')
+    add_options(parser)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('an output file is required')
+    count = write_corpus(args[0], **get_params(options))
+    print '%d incidents written to %s' % (count, args[0])
+
+
+if __name__ == '__main__':
+    main()
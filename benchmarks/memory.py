@@ -0,0 +1,59 @@
+"""
+memory.py - iodeflib memory benchmark
+
+Measure the memory used by parsed Incident objects (including all their
+subelements and strings), with the default classes and with the compact classes
+created by iodeflib.compact_class.
+
+usage: python memory.py [iodef_file]
+
+(the default file is the example provided with iodeflib)
+"""
+
+import sys, os, gc
+
+# use the iodeflib module from this source tree:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'iodeflib'))
+import iodeflib
+
+
+def deep_sizeof(obj):
+    """
+    return the total size in bytes of obj and all the objects it refers to,
+    except classes and other shared objects. Each object is counted once.
+    """
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys))) or obj is None:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def bytes_per_incident(filename, compact):
+    iodef = iodeflib.parse_file(filename, compact=compact)
+    total = sum(deep_sizeof(incident) for incident in iodef.incidents)
+    return total / len(iodef.incidents)
+
+
+def main():
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            '..', 'iodeflib', 'examples', 'iodef.xml')
+    default = bytes_per_incident(filename, compact=False)
+    compact = bytes_per_incident(filename, compact=True)
+    print 'bytes per Incident (default classes): %d' % default
+    print 'bytes per Incident (compact classes): %d' % compact
+    print 'ratio: %.2f' % (float(compact) / default)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+run.py - iodeflib benchmarks
+
+Measure the throughput and peak memory of iodeflib on a synthetic corpus (see
+corpus.py), for each benchmark and each XML backend (lxml and ElementTree).
+Each benchmark runs in a separate process, so that the peak memory of one
+benchmark does not depend on the others. The memory reported is the increase
+of the peak memory during the timed runs, above the memory used after setup
+(on Linux, the peak is reset after setup). Results are written in JSON, to
+compare releases or machines.
+
+usage, from the root of the source tree:
+    python -m benchmarks.run [options]
+"""
+
+import sys, os, time, optparse, subprocess, tempfile, shutil, platform, gc
+
+try:
+    import json
+except ImportError:
+    # Python 2.5: standalone simplejson install
+    import simplejson as json
+
+try:
+    # only available on Unix, used to measure peak memory:
+    import resource
+except ImportError:
+    resource = None
+
+# environment variable used to select the XML backend of iodeflib in the
+# benchmark processes:
+BACKEND_VARIABLE = 'IODEFLIB_BENCH_BACKEND'
+BACKENDS = ('lxml', 'etree')
+
+if os.environ.get(BACKEND_VARIABLE) == 'etree':
+    # hide lxml, so that iodeflib falls back to ElementTree:
+    sys.modules['lxml'] = None
+
+import iodeflib
+from benchmarks import corpus
+
+# root of the source tree, to run benchmark processes:
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+#--- BENCHMARKS ---------------------------------------------------------------
+# Each benchmark function prepares its data from the corpus file, and returns
+# the function to be timed.
+
+def bench_parse(filename):
+    "parse an XML string"
+    data = open(filename, 'rb').read()
+    return lambda: iodeflib.parse(data)
+
+def bench_parse_file(filename):
+    "parse an XML file"
+    return lambda: iodeflib.parse_file(filename)
+
+def bench_parse_file_mmap(filename):
+    "parse an XML file mapped in memory"
+    return lambda: iodeflib.parse_file(filename, use_mmap=True)
+
+def bench_parse_file_compact(filename):
+    "parse an XML file with compact classes"
+    return lambda: iodeflib.parse_file(filename, compact=True)
+
+def bench_parse_file_lazy(filename):
+    "parse an XML file with lazy classes"
+    return lambda: iodeflib.parse_file(filename, lazy=True)
+
+def bench_iter_incidents(filename):
+    "parse an XML file incrementally"
+    def run():
+        for incident in iodeflib.iter_incidents(filename):
+            pass
+    return run
+
+def bench_to_xml_str(filename):
+    "serialize a document to an XML string"
+    document = iodeflib.parse_file(filename)
+    return document.to_xml_str
+
+def bench_sources_targets(filename):
+    "get the sources and targets of all incidents"
+    document = iodeflib.parse_file(filename)
+    def run():
+        for incident in document.incidents:
+            incident.get_sources()
+            incident.get_targets()
+    return run
+
+def bench_round_trip(filename):
+    "parse a document, edit all incidents and serialize it again"
+    data = open(filename, 'rb').read()
+    end_time = corpus.format_time(corpus.BASE_TIME)
+    def run():
+        document = iodeflib.parse(data)
+        for incident in document.incidents:
+            incident.end_time = end_time
+            incident.history.append(iodeflib.HistoryItem(action='remediate-other',
+                datetime=end_time, descriptions=['Blocked source IP.']))
+        return document.to_xml_str()
+    return run
+
+BENCHMARKS = (
+    ('parse', bench_parse),
+    ('parse_file', bench_parse_file),
+    ('parse_file_mmap', bench_parse_file_mmap),
+    ('parse_file_compact', bench_parse_file_compact),
+    ('parse_file_lazy', bench_parse_file_lazy),
+    ('iter_incidents', bench_iter_incidents),
+    ('to_xml_str', bench_to_xml_str),
+    ('sources_targets', bench_sources_targets),
+    ('round_trip', bench_round_trip),
+    )
+
+
+#--- FUNCTIONS ----------------------------------------------------------------
+
+def _proc_status(field):
+    """
+    return a value in KB from /proc/self/status (Linux), such as VmRSS, or
+    None if not available
+    """
+    try:
+        f = open('/proc/self/status')
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    return None
+
+
+def current_memory():
+    """
+    return the current memory (resident set size) of the current process in
+    KB, or None if not available
+    """
+    return _proc_status('VmRSS')
+
+
+def reset_peak_memory():
+    """
+    reset the peak memory of the current process to its current memory.
+    return False if not supported (Linux 4.0+ only)
+    """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+    except IOError:
+        return False
+    return True
+
+
+def peak_memory():
+    """
+    return the peak memory (resident set size) of the current process in KB,
+    or None if not available
+    """
+    peak = _proc_status('VmHWM')
+    if peak is not None:
+        return peak
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # in bytes on Mac OS X
+        peak //= 1024
+    return peak
+
+
+def run_benchmark(name, filename, repeat=3):
+    """
+    run one benchmark in the current process, return a dictionary with the
+    results.
+    """
+    backend = iodeflib.LXML and 'lxml' or 'etree'
+    result = dict(benchmark=name, backend=backend)
+    if os.environ.get(BACKEND_VARIABLE, backend) != backend:
+        result['error'] = '%s backend is not available' % os.environ[
+            BACKEND_VARIABLE]
+        return result
+    function = dict(BENCHMARKS)[name](filename)
+    size = os.path.getsize(filename)
+    gc.collect()
+    # memory used after setup, and peak memory from this point if possible:
+    memory_before = current_memory()
+    peak_reset = reset_peak_memory()
+    if memory_before is None or not peak_reset:
+        memory_before = peak_memory()
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    peak = peak_memory()
+    best = min(times)
+    # counted after measuring memory, with bounded memory:
+    incidents = 0
+    for incident in iodeflib.iter_incidents(filename):
+        incidents += 1
+    result.update(
+        incidents = incidents,
+        bytes = size,
+        repeat = repeat,
+        best_seconds = best,
+        mean_seconds = sum(times) / len(times),
+        incidents_per_second = incidents / best,
+        mb_per_second = size / best / 1e6,
+        peak_memory_kb = peak,
+        memory_before_kb = memory_before,
+        memory_kb = _difference(peak, memory_before),
+        peak_reset = peak_reset,
+        )
+    return result
+
+
+def _difference(a, b):
+    "return a - b, or None if one of them is None"
+    if a is None or b is None:
+        return None
+    return a - b
+
+
+def run_process(name, backend, filename, repeat):
+    """
+    run one benchmark in a new process with the given XML backend, return a
+    dictionary with the results.
+    """
+    env = dict(os.environ)
+    env[BACKEND_VARIABLE] = backend
+    args = [sys.executable, '-m', 'benchmarks.run', '--child', name,
+        '--corpus', filename, '--repeat', str(repeat)]
+    process = subprocess.Popen(args, cwd=ROOT, env=env, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return dict(benchmark=name, backend=backend,
+            error='benchmark process failed with exit code %d'
+                % process.returncode)
+    # the results are on the last line:
+    return json.loads(output.splitlines()[-1])
+
+
+def print_results(results, output=sys.stderr):
+    "print a summary of the results, as a table"
+    output.write('%-20s %-6s %12s %10s %12s\n' % ('benchmark', 'backend',
+        'incidents/s', 'MB/s', 'memory KB'))
+    for result in results:
+        if 'error' in result:
+            output.write('%-20s %-6s %s\n' % (result['benchmark'],
+                result['backend'], result['error']))
+            continue
+        output.write('%-20s %-6s %12.0f %10.2f %12s\n' % (result['benchmark'],
+            result['backend'], result['incidents_per_second'],
+            result['mb_per_second'], result['memory_kb']))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='JSON file for the results '
+        '(default: standard output)')
+    parser.add_option('-b', '--backend', action='append', choices=BACKENDS,
+        help='XML backend to benchmark, lxml or etree (default: both)')
+    parser.add_option('-k', '--benchmark', action='append',
+        choices=[name for name, function in BENCHMARKS],
+        help='benchmark to run (default: all)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help='number of runs of each benchmark, the best time is reported')
+    parser.add_option('-c', '--corpus', help='existing IODEF file to be used '
+        'instead of a synthetic corpus')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    corpus.add_options(parser)
+    options, args = parser.parse_args()
+
+    if options.child:
+        result = run_benchmark(options.child, options.corpus, options.repeat)
+        print json.dumps(result)
+        return
+
+    temp_dir = None
+    filename = options.corpus
+    params = None
+    if filename is None:
+        temp_dir = tempfile.mkdtemp(prefix='iodeflib_bench_')
+        filename = os.path.join(temp_dir, 'corpus.xml')
+        params = corpus.get_params(options)
+        corpus.write_corpus(filename, **params)
+    try:
+        results = []
+        for backend in options.backend or BACKENDS:
+            for name in options.benchmark or [name for name, f in BENCHMARKS]:
+                results.append(run_process(name, backend, filename,
+                    options.repeat))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+    report = dict(
+        iodeflib_version = iodeflib.__version__,
+        python_version = platform.python_version(),
+        platform = platform.platform(),
+        date = time.strftime('%Y-%m-%dT%H:%M:%S'),
+        corpus = params or options.corpus,
+        results = results,
+        )
+    print_results(results)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
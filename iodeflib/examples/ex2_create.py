@@ -20,4 +20,4 @@ incident1.add_impact(description='DoS on system XYZ', type='dos',
 iodef.incidents.append(incident1)
 # serialize IODEF to XML, print it and save it to a file:
 print iodef
-open('iodef2.xml', 'w').write(str(iodef))
+iodef.write('iodef2.xml', pretty_print=True)
@@ -2,8 +2,9 @@ import sys
 sys.path.append('..')
 
 import iodeflib
-# open XML file and parse IODEF:
-iodef = iodeflib.parse_file('iodef2.xml')
+# open XML file and parse IODEF, keeping the source XML so that
+# unmodified incidents and unknown elements are saved unchanged:
+iodef = iodeflib.parse_file('iodef2.xml', editable=True)
 # get incident, add end time and history item:
 incident1 = iodef.incidents[0]
 histitem = iodeflib.HistoryItem(descriptions=['Blocked source IP.'],
@@ -13,5 +14,5 @@ incident1.end_time='2011-09-13T13:47:12+00:00'
 incident1.report_time='2011-09-13T13:52:00+00:00'
 # save IODEF back to an XML file:
 print iodef
-open('iodef2_updated.xml', 'w').write(str(iodef))
+iodef.write('iodef2_updated.xml', pretty_print=True)
 
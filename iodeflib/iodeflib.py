@@ -41,6 +41,36 @@ __version__ = '0.07'
 # 2012-03-28 v0.05 PL: - added parse_file
 # 2012-04-06 v0.06 PL: - added get_sources/targets
 # 2012-04-11 v0.07 PL: - added System.get_addresses, Incident.add_system
+# 2026-10-18 v0.08     - added iter_incidents to parse large files incrementally
+#                      - from_xml parses subelements in a single pass
+#                      - to_xml/from_xml compiled from declarative xml_fields
+#                      - added compact_class and compact option to parse
+#                      - added lazy_class and lazy option to parse
+#                      - added projected_class and fields/skip options to parse
+#                      - added IODEF_Document.write for incremental serialization
+#                      - added parse_many, compact pickling of objects
+#                      - reusable per-thread lxml parsers, threads option
+#                      - added ParseCache and cache option to parse_file
+#                      - added binary snapshots: dump_binary, load_binary
+#                      - added AddressIndex for IP address/network lookups
+#                      - added IncidentQuery and IODEF_Document.select
+#                      - DateTime attributes declared in xml_datetimes, added
+#                        datetime_class and datetimes option to parse
+#                      - added to_columns and iter_columns
+#                      - added IncidentStreamReader to parse network streams
+#                      - added IncidentFeedParser, IODEF_Document.feed_parser
+#                      - added schema validation, validate option to parse
+#                      - fixed order of subelements in Incident, EventData
+#                        and System, as in the schema
+#                      - added instrumentation: enable_instrumentation,
+#                        get_stats; no console log handler by default
+#                      - added editable_class and editable option to parse:
+#                        unmodified incidents and unknown elements are kept
+#                      - added merge_documents and iter_merged_incidents
+#                      - added fingerprint, FingerprintCache and diff
+#                      - added split_file
+#                      - parse_file reads files directly, added use_mmap
+#                      - added Contact and RegistryHandle
 
 #------------------------------------------------------------------------------
 # TODO:
@@ -48,23 +78,40 @@ __version__ = '0.07'
 # + add class for multilingual strings, but also allow simple str
 # + methods to extract/iter all AdditionalData elements with a specific dtype
 #   and/or formatid
-# + use python datetime for all timestamps, use dateutil for ISO8601 parsing:
-##    import dateutil.parser
-##    yourdate = dateutil.parser.parse(datestring)
-#   (just store a list of datetime attrib names in XML mapper, for transparent
-#   automatic conversion)
 # + to make classes suitable to support IODEF extensions, add class variables
 #   to store subelement classes. (e.g. IncidentClass in IODEF_Document)
 #   => can be overridden when subclassing to implement phishing extension, for
 #   example.
-# - method to verify XML schema before parsing (and option in parse function)
-#   and after serializing to XML
 # ? provide dictionaries with enums and descriptions from RFC 5070?
 
 
 #--- IMPORTS ------------------------------------------------------------------
 
 import logging
+import time
+import os
+import hashlib
+import marshal
+import gc
+import bisect
+import calendar
+import datetime
+import weakref
+import copy
+import copy_reg
+import cPickle
+import tempfile
+import shutil
+import threading
+import random
+import re
+import sys
+import Queue
+import mmap
+import cStringIO
+import multiprocessing
+import multiprocessing.pool
+from collections import OrderedDict, namedtuple
 
 #import xml.etree.ElementTree as ET
 LXML = False
@@ -85,6 +132,12 @@ except ImportError:
                 +"see http://codespeak.net/lxml "\
                 +"or http://effbot.org/zone/element-index.htm"
 
+try:
+    # NumPy: optional, only used by to_columns
+    import numpy
+except ImportError:
+    numpy = None
+
 
 #--- CONSTANTS ----------------------------------------------------------------
 
@@ -97,8 +150,16 @@ EMPTY_IODEF = """<IODEF-Document version="1.00" lang="en"
 
 # IODEF XML namespace (with curly brackets for ElementTree)
 NS = '{urn:ietf:params:xml:ns:iodef-1.0}'
+NS_URI = 'urn:ietf:params:xml:ns:iodef-1.0'
+# XML schema instance namespace, and IODEF schema location
+XSI = '{http://www.w3.org/2001/XMLSchema-instance}'
+XSI_URI = 'http://www.w3.org/2001/XMLSchema-instance'
+SCHEMA_LOCATION = 'urn:ietf:params:xml:schema:iodef-1.0'
+# namespace prefixes for lxml (ordered like EMPTY_IODEF)
+NSMAP = OrderedDict([(None, NS_URI), ('xsi', XSI_URI)])
 
 # XML tags, including namespace
+TAG_IODEF_Document = NS+'IODEF-Document'
 TAG_Incident    = NS+'Incident'
 TAG_IncidentID  = NS+'IncidentID'
 TAG_ReportTime  = NS+'ReportTime'
@@ -118,6 +179,14 @@ TAG_System      = NS+'System'
 TAG_Node        = NS+'Node'
 TAG_NodeName    = NS+'NodeName'
 TAG_Address     = NS+'Address'
+TAG_Contact     = NS+'Contact'
+TAG_ContactName = NS+'ContactName'
+TAG_RegistryHandle = NS+'RegistryHandle'
+TAG_PostalAddress = NS+'PostalAddress'
+TAG_Email       = NS+'Email'
+TAG_Telephone   = NS+'Telephone'
+TAG_Fax         = NS+'Fax'
+TAG_Timezone    = NS+'Timezone'
 
 
 
@@ -156,8 +225,16 @@ def get_logger(name, level=logging.DEBUG):
     return logger
 
 
-# default logger object:
-log = get_logger('iodeflib')
+class _NullHandler (logging.Handler):
+    "logging handler which discards all records (logging.NullHandler)"
+    def emit(self, record):
+        pass
+
+# default logger object: messages are only shown if the application
+# configures logging, as for any library (see get_logger for a console
+# logger):
+log = logging.getLogger('iodeflib')
+log.addHandler(_NullHandler())
 debug = log.debug
 
 
@@ -197,16 +274,891 @@ def _make_list (obj):
         return list(obj)
 
 
+#--- DateTime -----------------------------------------------------------------
+
+class _FixedOffset (datetime.tzinfo):
+    """
+    timezone with a fixed offset from UTC, used for the datetime objects
+    created by parse_datetime. Use _fixed_offset to get instances.
+    """
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+        sign = '-' if minutes < 0 else '+'
+        self._name = '%s%02d:%02d' % (sign, abs(minutes) // 60,
+            abs(minutes) % 60)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return _ZERO
+
+    def tzname(self, dt):
+        return self._name
+
+    def __repr__(self):
+        return '<timezone %s>' % self._name
+
+    def __reduce__(self):
+        return (_fixed_offset, (self.minutes,))
+
+_ZERO = datetime.timedelta(0)
+_timezones = {}
+
+def _fixed_offset(minutes):
+    "return the _FixedOffset object for an offset from UTC in minutes"
+    tz = _timezones.get(minutes, None)
+    if tz is None:
+        tz = _timezones[minutes] = _FixedOffset(minutes)
+    return tz
+
+
+def _parse_datetime(text):
+    """
+    parse a DateTime string (RFC 5070 section 3.2.3, from ISO 8601) such as
+    '2001-09-13T23:19:24+00:00', return a datetime object.
+    """
+    text = text.strip()
+    if (len(text) < 19 or text[4] != '-' or text[7] != '-'
+        or text[10] not in 'Tt' or text[13] != ':' or text[16] != ':'):
+        raise ValueError, 'invalid DateTime: %r' % text
+    microsecond = 0
+    i = 19
+    if text[i:i+1] == '.':
+        # fraction of second:
+        j = i + 1
+        while text[j:j+1].isdigit():
+            j += 1
+        if j == i + 1:
+            raise ValueError, 'invalid DateTime: %r' % text
+        microsecond = int(round(float(text[i:j]) * 1000000))
+        i = j
+        if microsecond == 1000000:
+            microsecond = 999999
+    tz = text[i:]
+    if not tz:
+        tzinfo = None
+    elif tz in ('Z', 'z'):
+        tzinfo = _fixed_offset(0)
+    elif len(tz) == 6 and tz[0] in '+-' and tz[3] == ':':
+        minutes = int(tz[1:3]) * 60 + int(tz[4:6])
+        if tz[0] == '-':
+            minutes = -minutes
+        tzinfo = _fixed_offset(minutes)
+    else:
+        raise ValueError, 'invalid DateTime: %r' % text
+    return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+        int(text[11:13]), int(text[14:16]), int(text[17:19]), microsecond,
+        tzinfo)
+
+
+# memo caches of parse_datetime and _to_epoch, cleared when they contain
+# _DATETIME_CACHE_SIZE items (timestamps are very repetitive in bulk feeds):
+_DATETIME_CACHE_SIZE = 10000
+_datetime_cache = {}
+_epoch_cache = {}
+
+def parse_datetime (text):
+    """
+    Parse a DateTime string (RFC 5070 section 3.2.3, from ISO 8601) such as
+    '2001-09-13T23:19:24+00:00', return a datetime object. It has a tzinfo
+    with a fixed offset if the timezone is specified.
+    Raise ValueError if text is not a valid DateTime.
+    """
+    value = _datetime_cache.get(text, None)
+    if value is None:
+        value = _parse_datetime(text)
+        if len(_datetime_cache) >= _DATETIME_CACHE_SIZE:
+            _datetime_cache.clear()
+        _datetime_cache[text] = value
+    return value
+
+
+def _to_epoch(value):
+    """
+    convert a DateTime string, a datetime object or a number to the number of
+    seconds since the epoch (UTC): an int, or a float if there is a fraction
+    of second. A datetime without timezone is assumed to be UTC.
+    Raise ValueError if the string is not a valid DateTime.
+    """
+    if isinstance(value, basestring):
+        timestamp = _epoch_cache.get(value, None)
+        if timestamp is None:
+            timestamp = _to_epoch(_parse_datetime(value))
+            if len(_epoch_cache) >= _DATETIME_CACHE_SIZE:
+                _epoch_cache.clear()
+            _epoch_cache[value] = timestamp
+        return timestamp
+    if isinstance(value, datetime.datetime):
+        timestamp = calendar.timegm(value.utctimetuple())
+        if value.microsecond:
+            timestamp += value.microsecond / 1e6
+        return timestamp
+    return value
+
+
+def format_datetime (value):
+    """
+    Convert a datetime object or a number of seconds since the epoch to a
+    DateTime string for IODEF, such as '2001-09-13T23:19:24+00:00'.
+    Strings are returned unchanged.
+    """
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return datetime.datetime.utcfromtimestamp(value).isoformat() + '+00:00'
+
+
+def _convert_datetime(value):
+    """
+    convert a DateTime string parsed from XML (or a number of seconds since the
+    epoch) to a datetime object. Invalid strings are kept as-is.
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        if isinstance(value, basestring):
+            return parse_datetime(value)
+        # number of seconds since the epoch:
+        return datetime.datetime.utcfromtimestamp(value).replace(
+            tzinfo=_fixed_offset(0))
+    except ValueError:
+        return value
+
+
+def _convert_epoch(value):
+    """
+    convert a DateTime string parsed from XML (or a datetime object) to a
+    number of seconds since the epoch. Invalid strings are kept as-is.
+    """
+    if value is None:
+        return None
+    try:
+        return _to_epoch(value)
+    except ValueError:
+        return value
+
+# functions used to convert DateTime strings, for each mode of datetime_class:
+_DATETIME_CONVERTERS = {
+    'datetime': _convert_datetime,
+    'epoch': _convert_epoch,
+    }
+
+
+#--- Instrumentation ----------------------------------------------------------
+
+# indexes of the counters for each mapper class, see Instrumentation:
+_OBJECTS, _FROM_XML_TIME, _ELEMENTS, _TEXT_BYTES, _TO_XML_CALLS, \
+    _TO_XML_TIME = range(6)
+_CLASS_COUNTERS = ('objects', 'from_xml_time', 'elements', 'text_bytes',
+    'to_xml_calls', 'to_xml_time')
+
+class Instrumentation (object):
+    """
+    Counters and timers collected while instrumentation is enabled, see
+    enable_instrumentation.
+
+    attributes:
+    - classes: dictionary of counters for each mapper class name (list of
+      values, in the order of _CLASS_COUNTERS)
+    - operations: dictionary of [calls, time, bytes] for each operation on
+      documents (parse, feed, to_xml_str, write)
+    - hook: function called after each operation (see enable_instrumentation)
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.classes = {}
+        self.operations = {}
+
+    def class_counters(self, name):
+        "return the list of counters for a mapper class name"
+        counters = self.classes.get(name, None)
+        if counters is None:
+            counters = self.classes[name] = [0, 0.0, 0, 0, 0, 0.0]
+        return counters
+
+    def operation(self, name, start, size=None):
+        """
+        record an operation started at time start, on size bytes of XML (if
+        known), and call the hook.
+        """
+        seconds = time.time() - start
+        counters = self.operations.get(name, None)
+        if counters is None:
+            counters = self.operations[name] = [0, 0.0, 0]
+        counters[0] += 1
+        counters[1] += seconds
+        if size is not None:
+            counters[2] += size
+        if self.hook is not None:
+            self.hook(name, seconds, size)
+
+    def snapshot(self):
+        "return a copy of all counters, as nested dictionaries"
+        classes = {}
+        for name, counters in self.classes.items():
+            classes[name] = dict(zip(_CLASS_COUNTERS, counters))
+        operations = {}
+        for name, (calls, seconds, size) in self.operations.items():
+            operations[name] = {'calls': calls, 'time': seconds,
+                'bytes': size}
+        return {'enabled': _instrumentation is self, 'classes': classes,
+            'operations': operations, 'lazy': dict(lazy_stats)}
+
+
+# statistics collected by enable_instrumentation:
+_stats = Instrumentation()
+
+# _stats while instrumentation is enabled, else None. Code paths check this
+# variable only, so that disabled instrumentation does not cost anything:
+_instrumentation = None
+
+# all mapper classes, to instrument their compiled methods (see
+# _XMLMapperType):
+_mapper_classes = weakref.WeakSet()
+
+def _instrumented_from_xml(function, counters):
+    """
+    return a version of a compiled from_xml (or _from_xml_deferred) method
+    which updates counters: objects, cumulative time (including the time
+    spent in subelement objects), elements visited and bytes of text (of
+    elements without children, to ignore indentation).
+    """
+    timer = time.time
+    deferred = function.__name__ == '_from_xml_deferred'
+    def from_xml(self, xml):
+        start = timer()
+        try:
+            return function(self, xml)
+        finally:
+            counters[_FROM_XML_TIME] += timer() - start
+            children = len(xml)
+            counters[_ELEMENTS] += children
+            if not deferred:
+                counters[_OBJECTS] += 1
+                counters[_ELEMENTS] += 1
+                if xml.text and not children:
+                    counters[_TEXT_BYTES] += len(xml.text)
+    from_xml.__name__ = function.__name__
+    return from_xml
+
+def _instrumented_to_xml(function, counters):
+    """
+    return a version of a compiled to_xml method which updates counters:
+    calls and cumulative time (including subelement objects).
+    """
+    timer = time.time
+    def to_xml(self):
+        start = timer()
+        try:
+            return function(self)
+        finally:
+            counters[_TO_XML_CALLS] += 1
+            counters[_TO_XML_TIME] += timer() - start
+    return to_xml
+
+def _instrument_class(cls):
+    """
+    replace the compiled methods of a mapper class by instrumented versions,
+    which update the counters of the class name in _stats.
+    """
+    for name in ('from_xml', '_from_xml_deferred', 'to_xml'):
+        function = cls.__dict__.get(name, None)
+        if not getattr(function, '_xml_compiled', False) or \
+            hasattr(function, '_original'):
+            continue
+        counters = _stats.class_counters(cls.__name__)
+        if name == 'to_xml':
+            instrumented = _instrumented_to_xml(function, counters)
+        else:
+            instrumented = _instrumented_from_xml(function, counters)
+        instrumented._original = function
+        # not copied by compact_class, as the original:
+        instrumented._xml_compiled = True
+        setattr(cls, name, instrumented)
+
+def _restore_class(cls):
+    "restore the compiled methods replaced by _instrument_class"
+    for name in ('from_xml', '_from_xml_deferred', 'to_xml'):
+        function = cls.__dict__.get(name, None)
+        original = getattr(function, '_original', None)
+        if original is not None:
+            setattr(cls, name, original)
+
+def enable_instrumentation (hook=None):
+    """
+    Enable the collection of counters and timers, to find out where time is
+    spent when parsing and serializing documents (see get_stats).
+    The compiled from_xml/to_xml methods of all mapper classes are replaced by
+    instrumented versions, so that there is no overhead at all when
+    instrumentation is disabled.
+    - hook: optional function called after each operation on a document,
+      with 3 arguments: operation name ('parse', 'feed', 'to_xml_str' or
+      'write'), duration in seconds, and size of the XML data in bytes (or
+      None if unknown). For example to export metrics.
+    Counters are not synchronized: with several threads, they are only
+    approximate.
+    """
+    global _instrumentation
+    _stats.hook = hook
+    _instrumentation = _stats
+    for cls in list(_mapper_classes):
+        _instrument_class(cls)
+
+def disable_instrumentation ():
+    """
+    Disable instrumentation and restore the original methods. The counters
+    collected so far are still available from get_stats.
+    """
+    global _instrumentation
+    _instrumentation = None
+    _stats.hook = None
+    for cls in list(_mapper_classes):
+        _restore_class(cls)
+
+def get_stats ():
+    """
+    return a snapshot of the counters collected by instrumentation, as a
+    dictionary:
+    - enabled: True if instrumentation is enabled
+    - classes: for each mapper class name (e.g. 'Incident'), number of
+      objects parsed, from_xml_time, XML elements visited, text_bytes (size
+      of the text of parsed elements, such as AdditionalData), to_xml_calls
+      and to_xml_time. Times are cumulative and include subelements.
+    - operations: for each operation (parse, feed, to_xml_str, write), number
+      of calls, time and bytes of XML read or written
+    - lazy: copy of lazy_stats
+    """
+    return _stats.snapshot()
+
+def reset_stats ():
+    "reset all counters collected by instrumentation, and lazy_stats"
+    for counters in _stats.classes.values():
+        counters[:] = [0, 0.0, 0, 0, 0, 0.0]
+    _stats.operations.clear()
+    lazy_stats['materialized'] = 0
+    lazy_stats['time'] = 0.0
+
+
 #=== CLASSES ==================================================================
 
+#--- XML field descriptions ---------------------------------------------------
+# Each _XMLMapper subclass describes its python attributes and the corresponding
+# XML content with a tuple of field descriptions stored in the class variable
+# xml_fields. It is compiled once when the class is created into specialized
+# to_xml and from_xml methods (see _XMLMapperType).
+
+class XMLAttrib (object):
+    """
+    field description: XML attribute stored in a python attribute
+    - attrib: name of the python attribute
+    - xml_name: name of the XML attribute, if different (e.g. 'ext-dtype')
+    """
+
+    def __init__(self, attrib, xml_name=None):
+        self.attrib = attrib
+        if xml_name is None:
+            xml_name = attrib
+        self.xml_name = xml_name
+
+
+class XMLText (object):
+    """
+    field description: text of the XML element stored in a python attribute
+    - attrib: name of the python attribute
+    """
+
+    def __init__(self, attrib):
+        self.attrib = attrib
+
+
+class XMLTag (object):
+    """
+    field description: text of a subelement stored in a python attribute.
+    The subelement is only created if the value is not None.
+    - tag: XML tag of the subelement, including namespace
+    - attrib: name of the python attribute
+    """
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+
+class XMLTagList (object):
+    """
+    field description: texts of all subelements with the same tag, stored in a
+    python attribute as a list of strings
+    - tag: XML tag of the subelements, including namespace
+    - attrib: name of the python attribute
+    """
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+
+class XMLSubclassList (object):
+    """
+    field description: all subelements with the same tag, stored in a python
+    attribute as a list of objects
+    - tag: XML tag of the subelements, including namespace
+    - attrib: name of the python attribute
+    - class_var: name of the class variable storing the class of the objects
+      (such as 'AddressClass'), so that it can be overridden by subclasses
+    """
+
+    def __init__(self, tag, attrib, class_var):
+        self.tag = tag
+        self.attrib = attrib
+        self.class_var = class_var
+
+
+class XMLChild (object):
+    """
+    field description: subelement which is not mapped to a separate python
+    object, its own fields are stored in the attributes of the parent object
+    (e.g. IODEF Node in System). The subelement is always created.
+    - tag: XML tag of the subelement, including namespace
+    - fields: field descriptions of the subelement
+    """
+
+    def __init__(self, tag, *fields):
+        self.tag = tag
+        self.fields = fields
+
+
+_SUBELEMENT_FIELDS = (XMLTag, XMLTagList, XMLSubclassList, XMLChild)
+_LIST_FIELDS = (XMLTagList, XMLSubclassList)
+
+
+def _iter_xml_fields(fields):
+    """
+    helper function to iterate over all field descriptions which are mapped to
+    a python attribute, including the fields of XMLChild subelements.
+    """
+    for field in fields:
+        if isinstance(field, XMLChild):
+            for subfield in _iter_xml_fields(field.fields):
+                yield subfield
+        else:
+            yield field
+
+
+class _CodeGenerator (object):
+    """
+    helper class to generate the source code of a specialized method from
+    field descriptions, see _compile_from_xml and _compile_to_xml
+    """
+
+    def __init__(self, compact=False, datetimes=(), datetime_mode=None):
+        # in compact mode, lists are stored in slots named '_'+attrib, and
+        # empty lists are stored as None (see compact_class):
+        self.compact = compact
+        self.lines = []
+        # constants (such as XML tags) made available to the generated code:
+        self.consts = {}
+        self.counter = 0
+        # DateTime attributes, and function to convert them when parsed:
+        self.datetimes = frozenset(datetimes)
+        self.converter = None
+        if datetime_mode is not None:
+            self.converter = self.const(_DATETIME_CONVERTERS[datetime_mode])
+
+    def line(self, indent, code):
+        self.lines.append('    '*indent + code)
+
+    def var(self, prefix):
+        "return a new unique variable name"
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def list_attr(self, attrib):
+        "return the name of the python attribute used to store a list"
+        if self.compact:
+            return '_' + attrib
+        return attrib
+
+    def const(self, value):
+        "return the variable name of a constant for the generated code"
+        name = self.var('_c')
+        self.consts[name] = value
+        return name
+
+    def convert(self, field, value):
+        "return an expression to convert a value parsed from XML for a field"
+        if self.converter is not None and field.attrib in self.datetimes:
+            return '%s(%s)' % (self.converter, value)
+        return value
+
+    def format(self, field, value):
+        "return an expression to convert a value to a string for XML"
+        if field.attrib in self.datetimes:
+            return '%s(%s)' % (self.const(format_datetime), value)
+        if isinstance(field, XMLAttrib):
+            return 'str(%s)' % value
+        return value
+
+    def compile(self, name, args):
+        """
+        compile the generated code into a function with the given name and
+        arguments. Constants are passed through a closure for fast access.
+        """
+        consts = sorted(self.consts)
+        source = ['def _make(%s):' % ', '.join(consts),
+                  '    def %s(%s):' % (name, args)]
+        source += ['        ' + l for l in self.lines]
+        source.append('    return %s' % name)
+        namespace = {}
+        exec '\n'.join(source) in namespace
+        function = namespace['_make'](*[self.consts[c] for c in consts])
+        function._xml_compiled = True
+        return function
+
+
+def _gen_from_xml(gen, fields, elem, indent):
+    """
+    generate code to parse the element stored in variable elem according to
+    the field descriptions, see _compile_from_xml.
+    """
+    # attributes and text of the element:
+    for field in fields:
+        if isinstance(field, XMLAttrib):
+            gen.line(indent, 'self.%s = %s' % (field.attrib, gen.convert(field,
+                '%s.get(%r, None)' % (elem, field.xml_name))))
+        elif isinstance(field, XMLText):
+            gen.line(indent, 'self.%s = %s' % (field.attrib,
+                gen.convert(field, elem + '.text')))
+    subfields = [f for f in fields if isinstance(f, _SUBELEMENT_FIELDS)]
+    if not subfields:
+        return
+    # variables to store the first subelement of each XMLTag/XMLChild, or the
+    # values of each list:
+    variables = []
+    branches = []
+    for field in subfields:
+        tag = gen.const(field.tag)
+        if isinstance(field, (XMLTag, XMLChild)):
+            var = gen.var('e')
+            gen.line(indent, '%s = None' % var)
+            code = 'if %s is None: %s = child' % (var, var)
+        elif isinstance(field, XMLTagList):
+            var = gen.var('l')
+            gen.line(indent, '%s = []' % var)
+            code = '%s.append(child.text)' % var
+        else:
+            var = gen.var('l')
+            Class = gen.var('C')
+            gen.line(indent, '%s = []' % var)
+            gen.line(indent, '%s = self.%s' % (Class, field.class_var))
+            code = '%s.append(%s(from_xml=child))' % (var, Class)
+        variables.append(var)
+        branches.append((tag, code))
+    # single pass over all subelements:
+    gen.line(indent, 'for child in %s:' % elem)
+    gen.line(indent+1, 'tag = child.tag')
+    keyword = 'if'
+    for tag, code in branches:
+        gen.line(indent+1, '%s tag == %s:' % (keyword, tag))
+        gen.line(indent+2, code)
+        keyword = 'elif'
+    # store the values in python attributes:
+    for field, var in zip(subfields, variables):
+        if isinstance(field, XMLTag):
+            gen.line(indent, 'if %s is not None: self.%s = %s' % (
+                var, field.attrib, gen.convert(field, var + '.text')))
+            gen.line(indent, 'else: self.%s = None' % field.attrib)
+        elif isinstance(field, XMLChild):
+            gen.line(indent, 'if %s is not None:' % var)
+            gen.line(indent+1, 'pass')
+            _gen_from_xml(gen, field.fields, var, indent+1)
+            gen.line(indent, 'else:')
+            gen.line(indent+1, 'pass')
+            _gen_reset(gen, field.fields, indent+1)
+        elif gen.compact:
+            gen.line(indent, 'self.%s = %s or None' % (gen.list_attr(field.attrib),
+                var))
+        else:
+            gen.line(indent, 'self.%s = %s' % (field.attrib, var))
+
+
+def _gen_reset(gen, fields, indent):
+    """
+    generate code to reset the attributes of a missing XMLChild subelement:
+    XMLAttrib/XMLText/XMLTag values are set to None and lists are emptied.
+    """
+    for field in fields:
+        if isinstance(field, (XMLAttrib, XMLText, XMLTag)):
+            gen.line(indent, 'self.%s = None' % field.attrib)
+        elif isinstance(field, _LIST_FIELDS):
+            if gen.compact:
+                gen.line(indent, 'self.%s = None' % gen.list_attr(field.attrib))
+            else:
+                gen.line(indent, 'self.%s = []' % field.attrib)
+        elif isinstance(field, XMLChild):
+            _gen_reset(gen, field.fields, indent)
+
+
+def _gen_to_xml(gen, fields, elem, indent):
+    """
+    generate code to serialize the python attributes into the element stored
+    in variable elem according to the field descriptions, see _compile_to_xml.
+    """
+    for field in fields:
+        if isinstance(field, XMLAttrib):
+            gen.line(indent, 'value = self.%s' % field.attrib)
+            gen.line(indent, 'if value is not None: %s.set(%r, %s)' % (
+                elem, field.xml_name, gen.format(field, 'value')))
+        elif isinstance(field, XMLText):
+            gen.line(indent, 'value = self.%s' % field.attrib)
+            gen.line(indent, 'if value is not None: %s.text = %s' % (elem,
+                gen.format(field, 'value')))
+        elif isinstance(field, XMLTag):
+            gen.line(indent, 'value = self.%s' % field.attrib)
+            gen.line(indent, 'if value is not None: SubElement(%s, %s).text = %s'
+                % (elem, gen.const(field.tag), gen.format(field, 'value')))
+        elif isinstance(field, XMLTagList):
+            tag = gen.const(field.tag)
+            gen.line(indent, 'for value in %s:' % _gen_list_value(gen, field))
+            gen.line(indent+1, 'SubElement(%s, %s).text = value' % (elem, tag))
+        elif isinstance(field, XMLSubclassList):
+            gen.line(indent, 'for value in %s:' % _gen_list_value(gen, field))
+            gen.line(indent+1, '%s.append(value.to_xml())' % elem)
+        elif isinstance(field, XMLChild):
+            subelem = gen.var('e')
+            gen.line(indent, '%s = SubElement(%s, %s)' % (subelem, elem,
+                gen.const(field.tag)))
+            _gen_to_xml(gen, field.fields, subelem, indent)
+            # an empty subelement such as History is not valid, remove it:
+            gen.line(indent, 'if not (len(%s) or %s.attrib or %s.text):' % (
+                subelem, subelem, subelem))
+            gen.line(indent+1, '%s.remove(%s)' % (elem, subelem))
+
+
+def _gen_list_value(gen, field):
+    """
+    return an expression to read the list stored in a python attribute, without
+    creating it in compact mode.
+    """
+    if gen.compact:
+        return '(self.%s or ())' % gen.list_attr(field.attrib)
+    return 'self.%s' % field.attrib
+
+
+def _compile_from_xml(cls, fields=None, name='from_xml', reset=()):
+    """
+    compile a specialized from_xml method for the class, from its xml_fields
+    or from the given field descriptions. Attributes listed in reset are set
+    to None first.
+    """
+    if fields is None:
+        fields = cls.xml_fields
+    gen = _CodeGenerator(cls._compact, cls.xml_datetimes, cls._datetime_mode)
+    gen.line(0, 'pass')
+    for attrib in reset:
+        gen.line(0, 'self.%s = None' % attrib)
+    _gen_from_xml(gen, fields, 'xml', 0)
+    return gen.compile(name, 'self, xml')
+
+
+def _has_list_field(fields):
+    "return True if the field descriptions contain a list, at any level"
+    for field in _iter_xml_fields(fields):
+        if isinstance(field, _LIST_FIELDS):
+            return True
+    return False
+
+
+def _split_lazy_fields(fields):
+    """
+    split field descriptions into the fields parsed immediately by a class
+    created by lazy_class (XML attributes and texts), and the fields parsed on
+    first access (lists, and XMLChild subelements containing lists).
+    return (eager, deferred) tuples.
+    """
+    eager = []
+    deferred = []
+    for field in fields:
+        if isinstance(field, _LIST_FIELDS) or (isinstance(field, XMLChild)
+            and _has_list_field(field.fields)):
+            deferred.append(field)
+        else:
+            eager.append(field)
+    return tuple(eager), tuple(deferred)
+
+
+def _compile_to_xml(cls):
+    """
+    compile a specialized to_xml method for the class, from its xml_tag and
+    xml_fields.
+    """
+    gen = _CodeGenerator(cls._compact, cls.xml_datetimes)
+    gen.consts['Element'] = ET.Element
+    gen.consts['SubElement'] = ET.SubElement
+    if LXML:
+        # use the IODEF namespace as default namespace, so that the element
+        # can also be serialized alone without namespace prefixes:
+        gen.line(0, 'xml = Element(%s, nsmap=%s)' % (gen.const(cls.xml_tag),
+            gen.const({None: NS_URI})))
+    else:
+        gen.line(0, 'xml = Element(%s)' % gen.const(cls.xml_tag))
+    _gen_to_xml(gen, cls.xml_fields, 'xml', 0)
+    gen.line(0, 'return xml')
+    return gen.compile('to_xml', 'self')
+
+
+def _fingerprint_text(value):
+    """
+    return a string encoding a value for _fingerprint methods, prefixed by its
+    length so that consecutive values cannot be confused. ('-' for None)
+    """
+    if value is None:
+        return '-'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return '%d:%s' % (len(value), value)
+
+
+def _canonical_datetime(value):
+    """
+    return a string identifying the instant of a DateTime value, independent
+    of its type and timezone: the number of seconds since the epoch (UTC).
+    Invalid DateTime strings are returned unchanged, with a '!' prefix.
+    """
+    try:
+        return '%.6f' % _to_epoch(value)
+    except (ValueError, TypeError):
+        return '!' + format_datetime(value)
+
+
+def _fingerprint_datetime(value):
+    """
+    _fingerprint_text for a DateTime value: the same instant always has the
+    same fingerprint, as a string in any timezone, a datetime object or a
+    number (see datetime_class)
+    """
+    if value is None:
+        return '-'
+    return _fingerprint_text(_canonical_datetime(value))
+
+
+def _compile_fingerprint(cls):
+    """
+    compile a specialized _fingerprint method for the class, from its xml_tag
+    and xml_fields: it returns the SHA-1 digest of the values of the fields
+    and of the digests of subelement objects (Merkle tree), and stores it in
+    a memo dictionary {id(object): (digest, object)}. See fingerprint.
+    """
+    gen = _CodeGenerator(cls._compact)
+    text = gen.const(_fingerprint_text)
+    datetime_text = gen.const(_fingerprint_datetime)
+    gen.line(0, 'entry = memo.get(id(self), None)')
+    gen.line(0, 'if entry is not None: return entry[0]')
+    gen.line(0, 'h = %s(%s)' % (gen.const(hashlib.sha1),
+        gen.const(cls.xml_tag or '')))
+    gen.line(0, 'update = h.update')
+    datetimes = frozenset(cls.xml_datetimes)
+    for field in _iter_xml_fields(cls.xml_fields):
+        if isinstance(field, _LIST_FIELDS):
+            gen.line(0, 'values = %s' % _gen_list_value(gen, field))
+            gen.line(0, 'update(%s(len(values)))' % text)
+            if isinstance(field, XMLSubclassList):
+                code = 'update(value._fingerprint(memo))'
+            else:
+                code = 'update(%s(value))' % text
+            gen.line(0, 'for value in values: ' + code)
+        elif field.attrib in datetimes:
+            gen.line(0, 'update(%s(self.%s))' % (datetime_text, field.attrib))
+        else:
+            gen.line(0, 'update(%s(self.%s))' % (text, field.attrib))
+    gen.line(0, 'digest = h.digest()')
+    gen.line(0, 'memo[id(self)] = (digest, self)')
+    gen.line(0, 'return digest')
+    return gen.compile('_fingerprint', 'self, memo')
+
+
+class _XMLMapperType (type):
+    """
+    metaclass of _XMLMapper: when a class defines xml_tag or xml_fields, compile
+    its to_xml, from_xml and _fingerprint methods, unless they are defined
+    explicitly.
+    """
+
+    def __init__(cls, name, bases, dct):
+        super(_XMLMapperType, cls).__init__(name, bases, dct)
+        if ('xml_fields' in dct or 'xml_tag' in dct) and cls.xml_fields is not None:
+            if 'from_xml' not in dct:
+                cls.from_xml = _compile_from_xml(cls)
+            if 'to_xml' not in dct:
+                cls.to_xml = _compile_to_xml(cls)
+            if '_fingerprint' not in dct:
+                cls._fingerprint = _compile_fingerprint(cls)
+        _mapper_classes.add(cls)
+        if _instrumentation is not None:
+            _instrument_class(cls)
+
+
 class _XMLMapper (object):
     """
     base class providing helper methods to convert Python objects to/from XML
+
+    Subclasses describe their XML content with the class variables xml_tag
+    and xml_fields (see XMLAttrib, XMLText, XMLTag, XMLTagList,
+    XMLSubclassList and XMLChild), which are compiled into the to_xml and
+    from_xml methods when the class is created.
     """
 
+    __metaclass__ = _XMLMapperType
+    # no instance dict by default, for subclasses created by compact_class:
+    __slots__ = ()
+    # True for subclasses created by compact_class:
+    _compact = False
+    # field descriptions parsed by from_xml, if different from xml_fields,
+    # and attributes set to None instead of being parsed (see projected_class):
+    _parse_fields = None
+    _skipped_attribs = ()
+    # conversion of DateTime attributes by from_xml, 'datetime' or 'epoch'
+    # (see datetime_class):
+    _datetime_mode = None
+
+    def _load_deferred(self):
+        """
+        parse the subelements which have not been parsed yet, for classes
+        created by lazy_class. Return True if some attributes were set.
+        """
+        return False
+
+    def __reduce__(self):
+        """
+        compact pickling: the object is stored as a tuple of the values of its
+        attributes (in the order of xml_fields) instead of a dict, see
+        _unpickle_mapper.
+        """
+        names = _state_names(type(self))
+        state = tuple([getattr(self, name, None) for name in names])
+        attribs = getattr(self, '__dict__', None)
+        if attribs and len(attribs) > len(names):
+            # other attributes set by an extension class:
+            extra = dict((name, value) for name, value in attribs.iteritems()
+                if name not in names)
+            return (_unpickle_mapper, (type(self), state, extra))
+        return (_unpickle_mapper, (type(self), state))
+
+    # XML tag of the element, including namespace:
+    xml_tag = None
+    # tuple of field descriptions:
+    xml_fields = None
+    # names of the attributes containing a DateTime:
+    xml_datetimes = ()
+
     #TODO:
     # ? use unicode() instead of str()?
-    # - list of attributes to be converted to/from datetime automatically
 
     def _set_xml_attribs(self, elem, *attrib_names, **kw_attrib_names):
         """
@@ -354,6 +1306,16 @@ class AdditionalData (_XMLMapper):
     - restriction: enum of str
     """
 
+    xml_tag = TAG_AdditionalData
+    xml_fields = (
+        XMLText('data'),
+        XMLAttrib('dtype'),
+        XMLAttrib('formatid'),
+        XMLAttrib('meaning'),
+        XMLAttrib('restriction'),
+        XMLAttrib('ext_dtype', 'ext-dtype'),
+        )
+
     def __init__(self, data=None, dtype=None, ext_dtype=None,
         formatid=None, meaning=None, restriction=None,
         from_xml=None):
@@ -366,19 +1328,6 @@ class AdditionalData (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_AdditionalData)
-        if self.data is not None:
-            xml.text = self.data
-        self._set_xml_attribs(xml, 'dtype', 'formatid',
-            'meaning', 'restriction', ext_dtype='ext-dtype')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'dtype', 'formatid',
-            'meaning', 'restriction', ext_dtype='ext-dtype')
-        self.data = xml.text
-
     def __str__(self):
         return 'AdditionalData dtype=%s ext_dtype=%s formatid=%s meaning=%s data="%s"' % (
             self.dtype, self.ext_dtype, self.formatid, self.meaning, self.data)
@@ -398,6 +1347,15 @@ class Address (_XMLMapper):
     - vlan_num: str (int in RFC 5070)
     """
 
+    xml_tag = TAG_Address
+    xml_fields = (
+        XMLText('address'),
+        XMLAttrib('category'),
+        XMLAttrib('vlan_name'),
+        XMLAttrib('vlan_num'),
+        XMLAttrib('ext_category', 'ext-category'),
+        )
+
     def __init__(self, address=None, category='ipv4-addr', ext_category=None,
         vlan_name=None, vlan_num=None,
         from_xml=None):
@@ -414,19 +1372,6 @@ class Address (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_Address)
-        if self.address is not None:
-            xml.text = self.address
-        self._set_xml_attribs(xml, 'category', 'vlan_name',
-            'vlan_num', ext_category='ext-category')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'category', 'vlan_name',
-            'vlan_num', ext_category='ext-category')
-        self.address = xml.text
-
     def __str__(self):
         return 'Address address=%s category=%s ext_category=%s vlan_name=%s vlan_num=%s' % (
             self.address, self.category, self.ext_category, self.vlan_name,
@@ -472,6 +1417,24 @@ class System (_XMLMapper):
     AdditionalDataClass = AdditionalData
     AddressClass = Address
 
+    xml_tag = TAG_System
+    xml_fields = (
+        XMLAttrib('category'),
+        XMLAttrib('restriction'),
+        XMLAttrib('interface'),
+        XMLAttrib('spoofed'),
+        XMLAttrib('ext_category', 'ext-category'),
+        XMLChild(TAG_Node,
+            XMLAttrib('node_datetime'),
+            XMLAttrib('node_location'),
+            XMLTagList(TAG_NodeName, 'node_names'),
+            XMLSubclassList(TAG_Address, 'node_addresses', 'AddressClass'),
+            ),
+        XMLTagList(TAG_Description, 'descriptions'),
+        XMLSubclassList(TAG_AdditionalData, 'additional_data',
+            'AdditionalDataClass'),
+        )
+    xml_datetimes = ('node_datetime',)
 
     def __init__(self, category=None, ext_category=None, descriptions=None,
         interface=None, spoofed=None, restriction=None,
@@ -498,27 +1461,6 @@ class System (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_System)
-        self._set_xml_attribs(xml, 'category', 'restriction', 'interface',
-            'spoofed', ext_category='ext-category')
-        self._set_xml_taglist(xml, TAG_Description, 'descriptions')
-        self._set_xml_subclass(xml, 'additional_data')
-        node = self._set_xml_tag(xml, TAG_Node, None, 'node_datetime', 'node_location')
-        self._set_xml_taglist(node, TAG_NodeName, 'node_names')
-        self._set_xml_subclass(node, 'node_addresses')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'category', 'restriction', 'interface',
-            'spoofed', ext_category='ext-category')
-        self._get_xml_taglist(xml, TAG_Description, 'descriptions')
-        # parse AdditionalData elements:
-        self._get_xml_subclass(xml, TAG_AdditionalData, 'additional_data', self.AdditionalDataClass)
-        node = self._get_xml_tag(xml, TAG_Node, None, 'node_datetime', 'node_location')
-        self._get_xml_taglist(node, TAG_NodeName, 'node_names')
-        self._get_xml_subclass(node, TAG_Address, 'node_addresses', self.AddressClass)
-
     def __str__(self):
         return 'System category=%s ext_category=%s interface=%s spoofed=%s node_location=%s node_names=%s node_addresses=%s descriptions: %s' % (
             self.category, self.ext_category, self.interface, self.spoofed,
@@ -552,6 +1494,10 @@ class Flow (_XMLMapper):
     # can be overridden when implementing IODEF extensions
     SystemClass = System
 
+    xml_tag = TAG_Flow
+    xml_fields = (
+        XMLSubclassList(TAG_System, 'systems', 'SystemClass'),
+        )
 
     def __init__(self, systems=None, from_xml=None):
         """
@@ -563,21 +1509,6 @@ class Flow (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        """
-        convert the object to XML, return an Element object
-        """
-        xml = ET.Element(TAG_Flow)
-        self._set_xml_subclass(xml, 'systems')
-        return xml
-
-    def from_xml(self, xml):
-        """
-        parse an Element object (XML) to populate this object
-        """
-        # parse System elements:
-        self._get_xml_subclass(xml, TAG_System, 'systems', self.SystemClass)
-
     def __str__(self):
         return 'Flow'
 
@@ -628,6 +1559,18 @@ class EventData (_XMLMapper):
     AdditionalDataClass = AdditionalData
     FlowClass = Flow
 
+    xml_tag = TAG_EventData
+    xml_fields = (
+        XMLAttrib('restriction'),
+        XMLTagList(TAG_Description, 'descriptions'),
+        XMLTag(TAG_DetectTime, 'detect_time'),
+        XMLTag(TAG_StartTime, 'start_time'),
+        XMLTag(TAG_EndTime, 'end_time'),
+        XMLSubclassList(TAG_Flow, 'flows', 'FlowClass'),
+        XMLSubclassList(TAG_AdditionalData, 'additional_data',
+            'AdditionalDataClass'),
+        )
+    xml_datetimes = ('start_time', 'detect_time', 'end_time')
 
     def __init__(self, descriptions=None, start_time=None, detect_time=None,
         end_time=None, restriction=None,
@@ -646,34 +1589,6 @@ class EventData (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        """
-        convert the object to XML, return an Element object
-        """
-        xml = ET.Element(TAG_EventData)
-        self._set_xml_attribs(xml, 'restriction')
-        self._set_xml_tag(xml, TAG_StartTime, 'start_time')
-        self._set_xml_tag(xml, TAG_DetectTime, 'detect_time')
-        self._set_xml_tag(xml, TAG_EndTime, 'end_time')
-        self._set_xml_taglist(xml, TAG_Description, 'descriptions')
-        self._set_xml_subclass(xml, 'additional_data')
-        self._set_xml_subclass(xml, 'flows')
-        return xml
-
-    def from_xml(self, xml):
-        """
-        parse an Element object (XML) to populate this object
-        """
-        self._get_xml_attribs(xml, 'restriction')
-        self._get_xml_tag(xml, TAG_StartTime, 'start_time')
-        self._get_xml_tag(xml, TAG_DetectTime, 'detect_time')
-        self._get_xml_tag(xml, TAG_EndTime, 'end_time')
-        self._get_xml_taglist(xml, TAG_Description, 'descriptions')
-        # parse AdditionalData elements:
-        self._get_xml_subclass(xml, TAG_AdditionalData, 'additional_data', self.AdditionalDataClass)
-        # parse Flow elements:
-        self._get_xml_subclass(xml, TAG_Flow, 'flows', self.FlowClass)
-
     def __str__(self):
         return 'EventData start=%s detect=%s end=%s descriptions: %s' % (
             self.start_time, self.detect_time, self.end_time, ', '.join(self.descriptions))
@@ -728,6 +1643,17 @@ class HistoryItem (_XMLMapper):
     # can be overridden when implementing IODEF extensions
     AdditionalDataClass = AdditionalData
 
+    xml_tag = TAG_HistoryItem
+    xml_fields = (
+        XMLAttrib('action'),
+        XMLAttrib('restriction'),
+        XMLAttrib('ext_action', 'ext-action'),
+        XMLTag(TAG_DateTime, 'datetime'),
+        XMLTagList(TAG_Description, 'descriptions'),
+        XMLSubclassList(TAG_AdditionalData, 'additional_data',
+            'AdditionalDataClass'),
+        )
+    xml_datetimes = ('datetime',)
 
     def __init__(self, action=None, additional_data=None,
         datetime=None, descriptions=None, ext_action=None, restriction=None,
@@ -745,21 +1671,6 @@ class HistoryItem (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_HistoryItem)
-        self._set_xml_attribs(xml, 'action', 'restriction', ext_action='ext-action')
-        self._set_xml_tag(xml, TAG_DateTime, 'datetime')
-        self._set_xml_taglist(xml, TAG_Description, 'descriptions')
-        self._set_xml_subclass(xml, 'additional_data')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'action', 'restriction', ext_action='ext-action')
-        self._get_xml_tag(xml, TAG_DateTime, 'datetime')
-        self._get_xml_taglist(xml, TAG_Description, 'descriptions')
-        # parse AdditionalData elements:
-        self._get_xml_subclass(xml, TAG_AdditionalData, 'additional_data', self.AdditionalDataClass)
-
     def __str__(self):
         return 'HistoryItem action=%s ext_action=%s datetime=%s descriptions: %s' % (
             self.action, self.ext_action, self.datetime, ', '.join(self.descriptions))
@@ -779,6 +1690,16 @@ class Impact (_XMLMapper):
     - ext_type: str
     """
 
+    xml_tag = TAG_Impact
+    xml_fields = (
+        XMLText('description'),
+        XMLAttrib('lang'),
+        XMLAttrib('severity'),
+        XMLAttrib('completion'),
+        XMLAttrib('type'),
+        XMLAttrib('ext_type', 'ext-type'),
+        )
+
     def __init__(self, description=None, lang=None, severity=None,
         completion=None, type=None, ext_type=None,
         from_xml=None):
@@ -791,19 +1712,6 @@ class Impact (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_Impact)
-        if self.description:
-            xml.text = self.description
-        self._set_xml_attribs(xml, 'lang', 'severity',
-            'completion', 'type', ext_type='ext-type')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'lang', 'severity',
-            'completion', 'type', ext_type='ext-type')
-        self.description = xml.text
-
     def __str__(self):
         return 'Impact type=%s severity=%s completion=%s description: %s' % (
             self.type, self.severity, self.completion, self.description)
@@ -823,6 +1731,13 @@ class Assessment (_XMLMapper):
     # can be overridden when implementing IODEF extensions
     ImpactClass = Impact
 
+    xml_tag = TAG_Assessment
+    xml_fields = (
+        XMLAttrib('occurence'),
+        XMLAttrib('restriction'),
+        XMLSubclassList(TAG_Impact, 'impacts', 'ImpactClass'),
+        )
+
     def __init__(self, occurence=None, restriction=None, impacts=None,
         from_xml=None):
         self.occurence = occurence
@@ -833,50 +1748,174 @@ class Assessment (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_Assessment)
-        self._set_xml_attribs(xml, 'occurence', 'restriction')
-        self._set_xml_subclass(xml, 'impacts')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'occurence', 'restriction')
-        # parse Impact subelements:
-        self._get_xml_subclass(xml, TAG_Impact, 'impacts', self.ImpactClass)
-##        self.impacts = []
-##        for subelem in xml.findall(TAG_Impact):
-##            self.impacts.append(self.ImpactClass(from_xml=subelem))
-
     def __str__(self):
         return 'Assessment occurence=%s restriction=%s' % (self.occurence,
             self.restriction)
 
 
 #------------------------------------------------------------------------------
-class Incident (_XMLMapper):
+class RegistryHandle (_XMLMapper):
     """
-    Incident class
+    handle of a contact in a registry, such as an Internet registry
 
     attributes:
-    - lang: language, such as 'en'
-    - purpose: purpose of report, such as 'reporting'
-    - id: unique identifier of the report
-    - id_name: name of originator of the report, or namespace where id is unique
+    - handle: str
+    - registry: enum of str, such as 'arin' or 'ripe'
+    - ext_registry: str
     """
 
-    # class variables for subelement classes:
-    # can be overridden when implementing IODEF extensions
-    AssessmentClass = Assessment
-    AdditionalDataClass = AdditionalData
+    xml_tag = TAG_RegistryHandle
+    xml_fields = (
+        XMLText('handle'),
+        XMLAttrib('registry'),
+        XMLAttrib('ext_registry', 'ext-registry'),
+        )
+
+    def __init__(self, handle=None, registry=None, ext_registry=None,
+        from_xml=None):
+        self.handle = handle
+        self.registry = registry
+        self.ext_registry = ext_registry
+        if from_xml is not None:
+            self.from_xml(from_xml)
+
+    def __str__(self):
+        return 'RegistryHandle registry=%s handle=%s' % (self.registry,
+            self.handle)
+
+
+#------------------------------------------------------------------------------
+class Contact (_XMLMapper):
+    """
+    The Contact class describes contact information for organizations and
+    personnel involved in the incident.
+
+    attributes:
+    - role: enum of str, such as 'creator' or 'tech'
+    - ext_role: str
+    - type: enum of str, 'person' or 'organization'
+    - ext_type: str
+    - restriction: enum of str
+    - name: str
+    - descriptions: list of str
+    - registry_handles: list of RegistryHandle objects
+    - postal_address: str
+    - emails: list of str
+    - telephones: list of str
+    - fax: str
+    - timezone: str
+    - additional_data: list of AdditionalData objects
+
+    Nested Contact elements are not described (they are kept by
+    editable_class).
+    """
+
+    # class variables for subelement classes:
+    # can be overridden when implementing IODEF extensions
+    RegistryHandleClass = RegistryHandle
+    AdditionalDataClass = AdditionalData
+
+    xml_tag = TAG_Contact
+    xml_fields = (
+        XMLAttrib('role'),
+        XMLAttrib('ext_role', 'ext-role'),
+        XMLAttrib('type'),
+        XMLAttrib('ext_type', 'ext-type'),
+        XMLAttrib('restriction'),
+        XMLTag(TAG_ContactName, 'name'),
+        XMLTagList(TAG_Description, 'descriptions'),
+        XMLSubclassList(TAG_RegistryHandle, 'registry_handles',
+            'RegistryHandleClass'),
+        XMLTag(TAG_PostalAddress, 'postal_address'),
+        XMLTagList(TAG_Email, 'emails'),
+        XMLTagList(TAG_Telephone, 'telephones'),
+        XMLTag(TAG_Fax, 'fax'),
+        XMLTag(TAG_Timezone, 'timezone'),
+        XMLSubclassList(TAG_AdditionalData, 'additional_data',
+            'AdditionalDataClass'),
+        )
+
+    def __init__(self, role=None, type=None, name=None, ext_role=None,
+        ext_type=None, restriction=None, descriptions=None,
+        registry_handles=None, postal_address=None, emails=None,
+        telephones=None, fax=None, timezone=None, additional_data=None,
+        from_xml=None):
+        self.role = role
+        self.ext_role = ext_role
+        self.type = type
+        self.ext_type = ext_type
+        self.restriction = restriction
+        self.name = name
+        self.descriptions = _new_list(descriptions)
+        self.registry_handles = _new_list(registry_handles)
+        self.postal_address = postal_address
+        self.emails = _new_list(emails)
+        self.telephones = _new_list(telephones)
+        self.fax = fax
+        self.timezone = timezone
+        self.additional_data = _new_list(additional_data)
+        if from_xml is not None:
+            self.from_xml(from_xml)
+
+    def __str__(self):
+        return 'Contact role=%s type=%s name=%s emails=%s' % (self.role,
+            self.type, self.name, ','.join(self.emails))
+
+
+#------------------------------------------------------------------------------
+class Incident (_XMLMapper):
+    """
+    Incident class
+
+    attributes:
+    - lang: language, such as 'en'
+    - purpose: purpose of report, such as 'reporting'
+    - id: unique identifier of the report
+    - id_name: name of originator of the report, or namespace where id is unique
+    """
+
+    # class variables for subelement classes:
+    # can be overridden when implementing IODEF extensions
+    AssessmentClass = Assessment
+    AdditionalDataClass = AdditionalData
     HistoryItemClass = HistoryItem
     EventDataClass = EventData
+    ContactClass = Contact
+
+    xml_tag = TAG_Incident
+    xml_fields = (
+        XMLAttrib('lang'),
+        XMLAttrib('purpose'),
+        XMLAttrib('restriction'),
+        XMLAttrib('ext_purpose', 'ext-purpose'),
+        XMLChild(TAG_IncidentID,
+            XMLText('id'),
+            XMLAttrib('id_name', 'name'),
+            ),
+        XMLTag(TAG_DetectTime, 'detect_time'),
+        XMLTag(TAG_StartTime, 'start_time'),
+        XMLTag(TAG_EndTime, 'end_time'),
+        XMLTag(TAG_ReportTime, 'report_time'),
+        XMLTagList(TAG_Description, 'descriptions'),
+        XMLSubclassList(TAG_Assessment, 'assessments', 'AssessmentClass'),
+        XMLSubclassList(TAG_Contact, 'contacts', 'ContactClass'),
+        XMLSubclassList(TAG_EventData, 'event_data', 'EventDataClass'),
+        # History and HistoryItem:
+        XMLChild(TAG_History,
+            XMLAttrib('history_restriction', 'restriction'),
+            XMLSubclassList(TAG_HistoryItem, 'history', 'HistoryItemClass'),
+            ),
+        XMLSubclassList(TAG_AdditionalData, 'additional_data',
+            'AdditionalDataClass'),
+        )
+    xml_datetimes = ('report_time', 'detect_time', 'start_time', 'end_time')
 
     def __init__(self, lang='en', purpose='reporting', id=None, id_name=None,
         report_time=None, detect_time=None, start_time=None, end_time=None,
         descriptions=None, restriction=None, ext_purpose=None,
         assessments=None, additional_data=None,
         history=None, history_restriction=None, event_data=None,
-        from_xml=None):
+        contacts=None, from_xml=None):
         self.lang = lang
         self.purpose = purpose
         self.id = id
@@ -897,48 +1936,10 @@ class Incident (_XMLMapper):
         self.additional_data = []
         if additional_data: self.additional_data = additional_data
         self.event_data = _new_list(event_data)
+        self.contacts = _new_list(contacts)
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        xml = ET.Element(TAG_Incident)
-        self._set_xml_attribs(xml, 'lang', 'purpose', 'restriction',
-            ext_purpose='ext-purpose')
-        self._set_xml_tag(xml, TAG_IncidentID, 'id', id_name='name')
-        self._set_xml_tag(xml, TAG_ReportTime, 'report_time')
-        self._set_xml_tag(xml, TAG_DetectTime, 'detect_time')
-        self._set_xml_tag(xml, TAG_StartTime, 'start_time')
-        self._set_xml_tag(xml, TAG_EndTime, 'end_time')
-        self._set_xml_taglist(xml, TAG_Description, 'descriptions')
-        # create History and HistoryItem:
-        history = self._set_xml_tag(xml, TAG_History, None, history_restriction='restriction')
-        self._set_xml_subclass(history, 'history')
-        self._set_xml_subclass(xml, 'assessments')
-        self._set_xml_subclass(xml, 'additional_data')
-        self._set_xml_subclass(xml, 'event_data')
-        return xml
-
-    def from_xml(self, xml):
-        self._get_xml_attribs(xml, 'lang', 'purpose', 'restriction',
-            ext_purpose='ext-purpose')
-        self._get_xml_tag(xml, TAG_IncidentID, 'id', id_name='name')
-        self._get_xml_tag(xml, TAG_ReportTime, 'report_time')
-        self._get_xml_tag(xml, TAG_DetectTime, 'detect_time')
-        self._get_xml_tag(xml, TAG_StartTime, 'start_time')
-        self._get_xml_tag(xml, TAG_EndTime, 'end_time')
-        self._get_xml_taglist(xml, TAG_Description, 'descriptions')
-        # parse History and HistoryItem:
-        history = self._get_xml_tag(xml, TAG_History, None, history_restriction='restriction')
-        self.history = []
-        if history is not None:
-            self._get_xml_subclass(history, TAG_HistoryItem, 'history', self.HistoryItemClass)
-        # parse Assessment elements:
-        self._get_xml_subclass(xml, TAG_Assessment, 'assessments', self.AssessmentClass)
-        # parse AdditionalData elements:
-        self._get_xml_subclass(xml, TAG_AdditionalData, 'additional_data', self.AdditionalDataClass)
-        # parse EventData elements:
-        self._get_xml_subclass(xml, TAG_EventData, 'event_data', self.EventDataClass)
-
     def __str__(self):
         return 'Incident ID=%s id_name=%s lang=%s purpose=%s' % (
             self.id, self.id_name, self.lang, self.purpose)
@@ -1029,6 +2030,146 @@ class Incident (_XMLMapper):
         flow.systems.append(system)
         return system
 
+#------------------------------------------------------------------------------
+class _XMLWriter (object):
+    """
+    simple incremental XML writer, used by IODEF_Document.write when lxml is
+    not available: elements are written to a binary file one at a time, using
+    the IODEF namespace as default namespace.
+    """
+
+    def __init__(self, f, encoding='UTF-8', pretty_print=False):
+        self.f = f
+        self.encoding = encoding
+        self.pretty_print = pretty_print
+
+    def _encode(self, value):
+        if isinstance(value, unicode):
+            return value.encode(self.encoding, 'xmlcharrefreplace')
+        return str(value)
+
+    # markup characters are escaped before encoding, so that the character
+    # references of characters missing from the encoding are not escaped:
+
+    def _escape_text(self, value):
+        if not isinstance(value, basestring):
+            value = str(value)
+        return self._encode(value.replace('&', '&amp;').replace('<', '&lt;'
+            ).replace('>', '&gt;'))
+
+    def _escape_attrib(self, value):
+        if not isinstance(value, basestring):
+            value = str(value)
+        return self._encode(value.replace('&', '&amp;').replace('<', '&lt;'
+            ).replace('>', '&gt;').replace('"', '&quot;').replace('\n',
+            '&#10;').replace('\r', '&#13;').replace('\t', '&#09;'))
+
+    def _qname(self, name, namespaces, declarations, attrib=False):
+        """
+        return the qualified name (with prefix) of an element or attribute
+        name in ElementTree format ('{uri}local'). namespaces is a dict
+        {uri: prefix} of the namespaces in scope ('' is the default prefix),
+        which is updated with new namespace declarations (appended to
+        declarations as (prefix, uri) tuples).
+        """
+        if name[:1] == '{':
+            uri, local = name[1:].split('}', 1)
+        elif attrib:
+            return name
+        else:
+            uri, local = '', name
+        prefix = namespaces.get(uri, None)
+        if prefix is None or (attrib and prefix == ''):
+            if uri == '':
+                # element without namespace, while a default one is set:
+                prefix = ''
+            else:
+                prefix = 'ns%d' % len(namespaces)
+            namespaces[uri] = prefix
+            declarations.append((prefix, uri))
+        if prefix:
+            return '%s:%s' % (prefix, local)
+        return local
+
+    def _start_tag(self, elem, namespaces, declarations=None):
+        """
+        return the start tag of elem (without the final '>'), and update
+        namespaces for its subelements.
+        """
+        if declarations is None:
+            declarations = []
+        tag = self._qname(elem.tag, namespaces, declarations)
+        attribs = []
+        for name, value in sorted(elem.items()):
+            attribs.append((self._qname(name, namespaces, declarations,
+                attrib=True), value))
+        parts = ['<', tag]
+        for prefix, uri in declarations:
+            if prefix:
+                parts.append(' xmlns:%s="%s"' % (prefix, self._escape_attrib(uri)))
+            else:
+                parts.append(' xmlns="%s"' % self._escape_attrib(uri))
+        for name, value in attribs:
+            parts.append(' %s="%s"' % (name, self._escape_attrib(value)))
+        return ''.join(parts), tag
+
+    def write_declaration(self):
+        self.f.write("<?xml version='1.0' encoding='%s'?>\n" % self.encoding)
+
+    def start(self, elem, namespaces):
+        """
+        write the start tag of elem (without its subelements), with namespace
+        declarations for namespaces (dict {uri: prefix}, '' for the default
+        namespace), return the end tag.
+        """
+        declarations = sorted((prefix, uri) for uri, prefix in namespaces.items())
+        start, tag = self._start_tag(elem, namespaces, declarations)
+        self.f.write(start + '>')
+        if self.pretty_print:
+            self.f.write('\n')
+        return '</%s>' % tag
+
+    def write(self, elem, namespaces, level=0):
+        """
+        write elem and all its subelements, with the given namespaces in scope
+        """
+        write = self.f.write
+        if self.pretty_print:
+            write('  ' * level)
+        self._write(elem, dict(namespaces), level)
+        if self.pretty_print:
+            write('\n')
+
+    def _write(self, elem, namespaces, level):
+        write = self.f.write
+        tag = elem.tag
+        if tag is ET.Comment:
+            write('<!--%s-->' % self._encode(elem.text))
+        elif tag is ET.ProcessingInstruction:
+            write('<?%s?>' % self._encode(elem.text))
+        else:
+            start, qname = self._start_tag(elem, namespaces)
+            text = elem.text
+            children = len(elem)
+            if not text and not children:
+                write(start + ' />')
+            else:
+                write(start + '>')
+                if text:
+                    write(self._escape_text(text))
+                # indent subelements unless there is some text content:
+                indent = self.pretty_print and not (text and text.strip())
+                for child in elem:
+                    if indent:
+                        write('\n' + '  ' * (level+1))
+                    self._write(child, dict(namespaces), level+1)
+                if indent and children:
+                    write('\n' + '  ' * level)
+                write('</%s>' % qname)
+        if elem.tail and not (self.pretty_print and not elem.tail.strip()):
+            write(self._escape_text(elem.tail))
+
+
 #------------------------------------------------------------------------------
 class IODEF_Document (_XMLMapper):
     """
@@ -1043,6 +2184,14 @@ class IODEF_Document (_XMLMapper):
     # can be overridden when implementing IODEF extensions
     IncidentClass = Incident
 
+    # to_xml and from_xml are not compiled, because they handle the XML root
+    xml_tag = TAG_IODEF_Document
+    xml_fields = (
+        XMLAttrib('lang'),
+        XMLAttrib('version'),
+        XMLSubclassList(TAG_Incident, 'incidents', 'IncidentClass'),
+        )
+
     def __init__(self, lang='en', version='1.00', incidents=None, from_xml=None):
         self.lang = lang
         self.version = version
@@ -1052,48 +2201,3302 @@ class IODEF_Document (_XMLMapper):
         if from_xml is not None:
             self.from_xml(from_xml)
 
-    def to_xml(self):
-        # start with an empty IODEF document:
-        xml = ET.fromstring(EMPTY_IODEF)
+    def _new_xml_root(self):
+        """
+        create the root element of the IODEF document, with proper namespaces
+        and main attributes, but without incidents.
+        """
+        if LXML:
+            xml = ET.Element(TAG_IODEF_Document, nsmap=NSMAP)
+        else:
+            xml = ET.Element(TAG_IODEF_Document)
+        # same attributes as EMPTY_IODEF:
+        xml.set('version', '1.00')
+        xml.set('lang', 'en')
+        xml.set(XSI+'schemaLocation', SCHEMA_LOCATION)
         # set main attributes:
         self._set_xml_attribs(xml, 'lang', 'version')
+        return xml
+
+    def to_xml(self):
+        # start with an empty IODEF document:
+        xml = self._new_xml_root()
         # add each incident report
         self._set_xml_subclass(xml, 'incidents')
         return xml
 
-    def to_xml_str(self, pretty_print=False):
-        xml = self.to_xml()
+    def to_xml_str(self, pretty_print=False, validate=None):
+        """
+        Serialize the IODEF document to an XML string.
+        - pretty_print: if True, indent XML elements (with lxml)
+        - validate: None, 'structure' or 'schema' to validate the XML before
+          returning it (see validate_element)
+        """
+        stats = _instrumentation
+        if stats is not None:
+            start = time.time()
+        if LXML:
+            xml = self.to_xml()
+        else:
+            # the source elements of unmodified incidents are not copied, as
+            # ElementTree elements can be shared by several trees:
+            xml = self._new_xml_root()
+            xml.extend(self._incident_elements())
+        if validate is not None:
+            validate_element(xml, validate)
         if LXML:
-            return ET.tostring(xml, pretty_print=pretty_print)
+            result = ET.tostring(xml, pretty_print=pretty_print)
         else:
-            return ET.tostring(xml)
+            result = ET.tostring(xml)
+        if stats is not None:
+            stats.operation('to_xml_str', start, len(result))
+        return result
 
     def __str__(self):
         return self.to_xml_str(pretty_print=True)
 
+    def select(self, **criteria):
+        """
+        return the list of incidents matching all the given criteria, see
+        IncidentQuery.select for the criteria. For example:
+        iodef.select(severity='high', source='10.0.0.0/8')
+        The indexes are built again for each call: to run several queries on
+        the same incidents, create an IncidentQuery object and keep it.
+        """
+        return IncidentQuery(self).select(**criteria)
+
+    def write(self, output, pretty_print=False, encoding='UTF-8',
+        validate=None, validate_sample=1.0):
+        """
+        Serialize the IODEF document to XML and write it to a file, one
+        incident at a time: memory usage only depends on the size of the
+        largest incident, not on the whole document.
+        - output: filename, or file object opened in binary mode
+        - pretty_print: if True, indent XML elements
+        - encoding: character encoding of the XML file
+        - validate: None, 'structure' or 'schema' to validate the document
+          before writing each incident (see validate_element). In 'schema'
+          mode, each Incident element is validated with the schema.
+        - validate_sample: fraction of the incidents to be validated with the
+          schema, between 0 and 1
+        """
+        if validate is not None:
+            if validate not in VALIDATION_MODES:
+                raise ValueError('Unknown validation mode: %r' % validate)
+            _check_root(self._new_xml_root())
+            if not self.incidents:
+                raise ValidationError(
+                    'IODEF-Document does not contain any Incident')
+        stats = _instrumentation
+        if stats is not None:
+            start = time.time()
+        if isinstance(output, basestring):
+            f = open(output, 'wb')
+        else:
+            f = output
+        try:
+            root = self._new_xml_root()
+            elements = self._incident_elements(validate, validate_sample)
+            if LXML:
+                self._write_lxml(f, root, elements, pretty_print, encoding)
+            else:
+                writer = _XMLWriter(f, encoding, pretty_print)
+                writer.write_declaration()
+                namespaces = {NS_URI: '', XSI_URI: 'xsi'}
+                end_tag = writer.start(root, namespaces)
+                for elem in elements:
+                    writer.write(elem, namespaces, 1)
+                f.write(end_tag)
+            if stats is not None:
+                stats.operation('write', start, _tell(f))
+        finally:
+            if f is not output:
+                f.close()
+
+    def _incident_elements(self, validate=None, validate_sample=1.0):
+        """
+        yield the XML element of each incident, validated with the schema
+        if validate is 'schema' (see write). The source element of unmodified
+        incidents is used as-is (see editable_class).
+        """
+        for incident in self.incidents:
+            elem = None
+            unmodified_source = getattr(incident, '_unmodified_source', None)
+            if unmodified_source is not None:
+                elem = unmodified_source()
+            if elem is None:
+                elem = incident.to_xml()
+            if validate == 'schema' and _sampled(validate_sample):
+                _validate_schema(elem)
+            yield elem
+
+    def _write_lxml(self, f, root, elements, pretty_print, encoding):
+        """
+        write the IODEF document to a file with lxml, using incremental
+        serialization (see write)
+        """
+        with ET.xmlfile(f, encoding=encoding) as xf:
+            xf.write_declaration()
+            # keep the attributes order of root:
+            attrib = OrderedDict(root.items())
+            with xf.element(root.tag, attrib, nsmap=NSMAP):
+                if pretty_print:
+                    xf.write('\n')
+                for elem in elements:
+                    xf.write(elem, pretty_print=pretty_print)
+
+    def dump_binary(self, output):
+        """
+        Write the IODEF document to a file in a compact binary format, which
+        can be loaded much faster than XML with load_binary.
+        - output: filename, or file object opened in binary mode
+        """
+        if isinstance(output, basestring):
+            f = open(output, 'wb')
+        else:
+            f = output
+        try:
+            _dump_binary(self, f)
+        finally:
+            if f is not output:
+                f.close()
+
+    @classmethod
+    def load_binary(cls, source):
+        """
+        Load an IODEF document written by dump_binary, return an object of
+        this class. Subelements are created using the class variables such as
+        IncidentClass.
+        - source: filename, or file object opened in binary mode
+        """
+        if isinstance(source, basestring):
+            f = open(source, 'rb')
+        else:
+            f = source
+        try:
+            return _load_binary(cls, f)
+        finally:
+            if f is not source:
+                f.close()
+
+    @classmethod
+    def feed_parser(cls, **options):
+        """
+        return an IncidentFeedParser object to parse a document of this class
+        incrementally, from chunks of data. (see IncidentFeedParser for the
+        options)
+        """
+        return IncidentFeedParser(cls, **options)
+
     def from_xml(self, xml_str):
-        # parse string to XML element:
-        xml = ET.fromstring(xml_str)
+        # parse string to XML element, unless it is already parsed:
+        if isinstance(xml_str, basestring):
+            xml = _fromstring(xml_str)
+        else:
+            xml = xml_str
         # get main attributes:
         self._get_xml_attribs(xml, 'lang', 'version')
         # parse incidents:
         self._get_xml_subclass(xml, TAG_Incident, 'incidents', self.IncidentClass)
 
 
-def parse (xml_string):
+# cache of the names of the attributes stored by __reduce__, for each class:
+_state_names_cache = {}
+
+def _state_names(cls):
     """
-    Parse an XML string containing an IODEF incident report
-    return an IODEF_Document object
+    return the names of the python attributes (or slots) storing the fields of
+    an _XMLMapper class, in the order of xml_fields. (used for pickling)
     """
-    return IODEF_Document(from_xml = xml_string)
+    names = _state_names_cache.get(cls, None)
+    if names is None:
+        names = []
+        for field in _iter_xml_fields(cls.xml_fields or ()):
+            if cls._compact and isinstance(field, _LIST_FIELDS):
+                names.append('_' + field.attrib)
+            else:
+                names.append(field.attrib)
+        names = tuple(names)
+        _state_names_cache[cls] = names
+    return names
 
 
-def parse_file (filename):
+def _unpickle_mapper(cls, state, extra=None):
     """
-    Parse an XML file containing an IODEF incident report
+    create an _XMLMapper object from the values stored by __reduce__, without
+    calling its constructor.
+    """
+    obj = cls.__new__(cls)
+    names = _state_names(cls)
+    if cls._compact:
+        for name, value in zip(names, state):
+            setattr(obj, name, value)
+    else:
+        obj.__dict__.update(zip(names, state))
+    if extra:
+        obj.__dict__.update(extra)
+    return obj
+
+
+def _reduce_mapper_class(cls):
+    """
+    pickle _XMLMapper classes: classes created by compact_class, lazy_class,
+    projected_class or the parsing functions are created again from the same
+    arguments, other classes are stored by name.
+    """
+    variant = cls.__dict__.get('_variant', None)
+    if variant is None:
+        return cls.__name__
+    return variant
+
+copy_reg.pickle(_XMLMapperType, _reduce_mapper_class)
+
+
+#--- BINARY SNAPSHOTS ---------------------------------------------------------
+
+# Binary format written by dump_binary: a header line with BINARY_MAGIC and
+# BINARY_VERSION, followed by a marshal dump of a tuple (schema, strings,
+# document):
+# - schema describes the attributes of each class (see _binary_schema), to
+#   check that the snapshot is loaded with compatible classes.
+# - strings is the list of all distinct strings of the document.
+# - each object is stored as a tuple of its attribute values, in the order of
+#   xml_fields. A string is stored as its index in strings, other values than
+#   None as a tuple (value,). Lists contain strings or object tuples.
+BINARY_MAGIC = 'IODEFBIN'
+BINARY_VERSION = 1
+
+# kinds of attributes:
+_BIN_VALUE = 0
+_BIN_STRINGS = 1
+_BIN_OBJECTS = 2
+
+# cache of the attributes of each class, see _binary_plan:
+_binary_plans = {}
+
+def _binary_plan(cls):
+    """
+    return the list of (name, kind, class_var) tuples describing how the
+    attributes of an _XMLMapper class are stored in a binary snapshot. name is
+    the attribute or slot storing the value (see _state_names).
+    """
+    plan = _binary_plans.get(cls, None)
+    if plan is None:
+        plan = []
+        fields = _iter_xml_fields(cls.xml_fields or ())
+        for name, field in zip(_state_names(cls), fields):
+            if isinstance(field, XMLSubclassList):
+                plan.append((name, _BIN_OBJECTS, field.class_var))
+            elif isinstance(field, XMLTagList):
+                plan.append((name, _BIN_STRINGS, None))
+            else:
+                plan.append((name, _BIN_VALUE, None))
+        _binary_plans[cls] = plan
+    return plan
+
+
+def _binary_schema(cls):
+    """
+    return a tuple describing the attributes of an _XMLMapper class and of
+    its subelement classes, which does not depend on compact or lazy classes.
+    """
+    schema = []
+    for field, (name, kind, class_var) in zip(
+        _iter_xml_fields(cls.xml_fields or ()), _binary_plan(cls)):
+        if kind == _BIN_OBJECTS:
+            schema.append((field.attrib, kind,
+                _binary_schema(getattr(cls, class_var))))
+        else:
+            schema.append((field.attrib, kind))
+    return tuple(schema)
+
+
+def _binary_encode(obj, strings, str_index, unicode_index):
+    """
+    return the tuple storing an _XMLMapper object in a binary snapshot, and
+    add its strings to strings and to the index matching their type.
+    """
+    values = []
+    for name, kind, class_var in _binary_plan(type(obj)):
+        value = getattr(obj, name, None)
+        if kind == _BIN_OBJECTS:
+            value = [_binary_encode(item, strings, str_index, unicode_index)
+                for item in value or ()]
+        elif kind == _BIN_STRINGS:
+            items = []
+            for item in value or ():
+                index = str_index if type(item) is str else unicode_index
+                i = index.get(item, None)
+                if i is None:
+                    i = index[item] = len(strings)
+                    strings.append(item)
+                items.append(i)
+            value = items
+        elif value is not None:
+            if isinstance(value, datetime.datetime):
+                # stored as a DateTime string, see format_datetime:
+                value = format_datetime(value)
+            value_type = type(value)
+            if value_type is str or value_type is unicode:
+                index = str_index if value_type is str else unicode_index
+                i = index.get(value, None)
+                if i is None:
+                    i = index[value] = len(strings)
+                    strings.append(value)
+                value = i
+            else:
+                value = (value,)
+        values.append(value)
+    return tuple(values)
+
+
+# cache of the functions created by _binary_decoder, for each class:
+_binary_decoders = {}
+
+def _binary_decoder(cls):
+    """
+    return a function decode(values, strings) compiled for an _XMLMapper
+    class, which creates an object of that class from the tuple stored by
+    _binary_encode. Subelement classes are taken from the class variables
+    such as IncidentClass.
+    """
+    decoder = _binary_decoders.get(cls, None)
+    if decoder is not None:
+        return decoder
+    gen = _CodeGenerator(cls._compact, cls.xml_datetimes, cls._datetime_mode)
+    plan = _binary_plan(cls)
+    gen.line(0, 'obj = %s(%s)' % (gen.const(cls.__new__), gen.const(cls)))
+    variables = [gen.var('v') for item in plan]
+    if variables:
+        gen.line(0, '%s, = values' % ', '.join(variables))
+    attribs = []
+    for (name, kind, class_var), v in zip(plan, variables):
+        if kind == _BIN_OBJECTS:
+            decode = gen.const(_binary_decoder(getattr(cls, class_var)))
+            value = '[%s(item, strings) for item in %s]' % (decode, v)
+        elif kind == _BIN_STRINGS:
+            value = '[strings[i] for i in %s]' % v
+        else:
+            # index in strings, None or (value,):
+            value = 'strings[%s] if %s.__class__ is int else %s and %s[0]' % (
+                v, v, v, v)
+            if gen.converter is not None and name in gen.datetimes:
+                value = '%s(%s)' % (gen.converter, value)
+        if gen.compact and kind != _BIN_VALUE:
+            # compact classes store empty lists as None:
+            value = '%s or None' % value
+        attribs.append((name, value))
+    if gen.compact:
+        for name, value in attribs:
+            gen.line(0, 'obj.%s = %s' % (name, value))
+    else:
+        gen.line(0, 'obj.__dict__ = {%s}' % ', '.join(
+            '%r: %s' % (name, value) for name, value in attribs))
+    gen.line(0, 'return obj')
+    decoder = gen.compile('decode', 'values, strings')
+    _binary_decoders[cls] = decoder
+    return decoder
+
+
+def _dump_binary(document, f):
+    """
+    write a binary snapshot of an IODEF_Document object to a file object
+    """
+    strings = []
+    values = _binary_encode(document, strings, {}, {})
+    f.write('%s %d\n' % (BINARY_MAGIC, BINARY_VERSION))
+    # marshal.dump only supports real files:
+    f.write(marshal.dumps((_binary_schema(type(document)), strings, values),
+        marshal.version))
+
+
+# exceptions raised by load_binary for files which are not valid snapshots
+# (marshal raises EOFError, ValueError or TypeError for invalid data):
+_BINARY_ERRORS = (EnvironmentError, EOFError, ValueError, TypeError)
+
+def _load_binary(cls, f):
+    """
+    load a binary snapshot from a file object, return an object of the
+    IODEF_Document class cls.
+    """
+    header = f.readline().split()
+    if len(header) != 2 or header[0] != BINARY_MAGIC:
+        raise ValueError, 'not an IODEF binary snapshot'
+    if header[1] != str(BINARY_VERSION):
+        raise ValueError, 'unsupported IODEF binary snapshot version %s' \
+            % header[1]
+    schema, strings, values = marshal.loads(f.read())
+    if schema != _binary_schema(cls):
+        raise ValueError, 'IODEF binary snapshot not compatible with %s' \
+            % cls.__name__
+    # the garbage collector would be triggered many times while creating
+    # objects, although they do not contain reference cycles:
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _binary_decoder(cls)(values, strings)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def load_binary (source, document_class=None, compact=False, datetimes=None):
+    """
+    Load an IODEF document written by IODEF_Document.dump_binary
     return an IODEF_Document object
+    - source: filename, or file object opened in binary mode
+    - document_class: IODEF_Document class (or subclass) to be created.
+      Default: IODEF_Document
+    - compact: if True, use compact classes to reduce memory usage, see
+      compact_class
+    - datetimes: 'datetime' or 'epoch' to convert DateTime attributes, see
+      parse
+    """
+    document_class = _document_class(document_class, compact,
+        datetimes=datetimes)
+    return document_class.load_binary(source)
+
+
+# cache of classes created by compact_class:
+_compact_classes = {}
+
+def _lazy_list_property(cls, attrib):
+    """
+    helper function to create a property for a list attribute of a class
+    created by compact_class: the list is stored in the slot named '_'+attrib,
+    as None while it is empty. It is only created when the attribute is read.
+    """
+    slot = cls.__dict__['_' + attrib]
+    get_slot = slot.__get__
+    set_slot = slot.__set__
+    def fget(self):
+        try:
+            value = get_slot(self, cls)
+        except AttributeError:
+            if self._load_deferred():
+                return fget(self)
+            value = None
+        if value is None:
+            value = []
+            set_slot(self, value)
+        return value
+    def fset(self, value):
+        if not value:
+            value = None
+        set_slot(self, value)
+    return property(fget, fset)
+
+
+def compact_class (cls):
+    """
+    Return a compact version of an _XMLMapper class (such as Incident or an
+    extension subclass), which stores the attributes described by xml_fields
+    in __slots__ instead of a per-instance dict, to reduce memory usage when
+    many objects are kept in memory.
+    Empty lists are only created when the corresponding attribute is read, so
+    assigning an empty list to an attribute does not keep a reference to it.
+    The *Class variables of the compact class refer to compact classes, so that
+    all subelements are compact too.
+    Note that the compact class is not a subclass of cls, and that attributes
+    not described by xml_fields cannot be set on its objects.
+    """
+    if cls._compact or cls is _XMLMapper:
+        return cls
+    compact_cls = _compact_classes.get(cls, None)
+    if compact_cls is not None:
+        return compact_cls
+    bases = tuple(compact_class(base) for base in cls.__bases__
+        if issubclass(base, _XMLMapper))
+    # attributes already stored in the slots of the base classes:
+    inherited = set()
+    for base in bases:
+        for klass in base.__mro__:
+            inherited.update(klass.__dict__.get('__slots__', ()))
+    slots = []
+    list_attribs = []
+    for field in _iter_xml_fields(cls.__dict__.get('xml_fields', None) or ()):
+        if isinstance(field, _LIST_FIELDS):
+            slot = '_' + field.attrib
+            if slot not in inherited:
+                slots.append(slot)
+                list_attribs.append(field.attrib)
+        elif field.attrib not in inherited:
+            slots.append(field.attrib)
+    namespace = {}
+    for name, value in cls.__dict__.items():
+        if name in ('__dict__', '__weakref__', '__slots__', '_variant'):
+            continue
+        if getattr(value, '_xml_compiled', False):
+            # compiled methods are compiled again for compact lists:
+            continue
+        if isinstance(value, type) and issubclass(value, _XMLMapper):
+            # *Class variables:
+            value = compact_class(value)
+        namespace[name] = value
+    namespace['__slots__'] = tuple(slots)
+    namespace['_compact'] = True
+    namespace['_variant'] = (compact_class, (cls,))
+    compact_cls = type(cls)(cls.__name__, bases, namespace)
+    for attrib in list_attribs:
+        setattr(compact_cls, attrib, _lazy_list_property(compact_cls, attrib))
+    _compact_classes[cls] = compact_cls
+    return compact_cls
+
+
+# statistics about the Incident objects created by lazy_class classes:
+# - materialized: number of objects whose deferred subelements were parsed
+# - time: cumulative time spent parsing them, in seconds
+lazy_stats = {'materialized': 0, 'time': 0.0}
+
+# cache of classes created by lazy_class:
+_lazy_classes = {}
+
+def _lazy_getattr(self, name):
+    """
+    __getattr__ method for classes created by lazy_class: only called when an
+    attribute is missing, which is the case for deferred attributes until
+    they are parsed.
+    """
+    if name in self._deferred_attribs and self._load_deferred():
+        return getattr(self, name)
+    raise AttributeError("'%s' object has no attribute '%s'" % (
+        type(self).__name__, name))
+
+
+def _lazy_load_deferred(self):
+    """
+    _load_deferred method for classes created by lazy_class: parse the
+    deferred subelements from the source XML element, then release it.
+    Attributes which were assigned in the meantime are kept.
+    """
+    xml = getattr(self, '_xml_source', None)
+    if xml is None:
+        return False
+    start = time.time()
+    self._xml_source = None
+    # keep values assigned before parsing:
+    assigned = []
+    for name in self._deferred_attribs:
+        try:
+            assigned.append((name, object.__getattribute__(self, name)))
+        except AttributeError:
+            pass
+    self._from_xml_deferred(xml)
+    for name, value in assigned:
+        setattr(self, name, value)
+    lazy_stats['materialized'] += 1
+    lazy_stats['time'] += time.time() - start
+    return True
+
+
+def lazy_class (cls):
+    """
+    Return a lazy version of an _XMLMapper class such as Incident (or a
+    compact or extension class): when an object is created from XML, only
+    XML attributes and texts (e.g. id, id_name, report_time) are parsed
+    immediately. The source XML element is kept, and lists of subelements
+    (e.g. event_data, assessments, history) are only parsed when one of them
+    is accessed for the first time. See lazy_stats for the cost of this
+    deferred parsing.
+    The lazy class is a subclass of cls.
+    """
+    lazy_cls = _lazy_classes.get(cls, None)
+    if lazy_cls is not None:
+        return lazy_cls
+    fields = cls._parse_fields
+    if fields is None:
+        fields = cls.xml_fields
+    eager, deferred = _split_lazy_fields(fields)
+    gen = _CodeGenerator(cls._compact, cls.xml_datetimes, cls._datetime_mode)
+    # names of the python attributes (or slots) of the deferred fields:
+    names = []
+    for field in _iter_xml_fields(deferred):
+        if isinstance(field, _LIST_FIELDS):
+            names.append(gen.list_attr(field.attrib))
+        else:
+            names.append(field.attrib)
+    # from_xml: parse eager fields, keep the XML element, and remove deferred
+    # attributes set by the constructor so that __getattr__ is called:
+    gen.line(0, 'pass')
+    for attrib in cls._skipped_attribs:
+        gen.line(0, 'self.%s = None' % attrib)
+    _gen_from_xml(gen, eager, 'xml', 0)
+    gen.line(0, 'self._xml_source = xml')
+    for name in names:
+        gen.line(0, 'try: del self.%s' % name)
+        gen.line(0, 'except AttributeError: pass')
+    namespace = {
+        '__slots__': ('_xml_source',),
+        '__module__': cls.__module__,
+        '__doc__': cls.__doc__,
+        '_deferred_attribs': frozenset(names),
+        'from_xml': gen.compile('from_xml', 'self, xml'),
+        '_from_xml_deferred': _compile_from_xml(cls, deferred,
+            '_from_xml_deferred'),
+        '_load_deferred': _lazy_load_deferred,
+        '__getattr__': _lazy_getattr,
+        '_variant': (lazy_class, (cls,)),
+        }
+    lazy_cls = type(cls)(cls.__name__, (cls,), namespace)
+    _lazy_classes[cls] = lazy_cls
+    return lazy_cls
+
+
+# cache of classes created by projected_class:
+_projected_classes = {}
+
+def _project_fields(fields, attribs, skip, cls):
+    """
+    helper function for projected_class: return the field descriptions to be
+    parsed, keeping only the given python attributes (if attribs is not None),
+    and excluding lists of objects whose class is a subclass of skip.
+    """
+    result = []
+    for field in fields:
+        if isinstance(field, XMLChild):
+            subfields = _project_fields(field.fields, attribs, skip, cls)
+            if subfields:
+                result.append(XMLChild(field.tag, *subfields))
+            continue
+        if attribs is not None and field.attrib not in attribs:
+            continue
+        if (isinstance(field, XMLSubclassList)
+            and issubclass(getattr(cls, field.class_var), skip)):
+            continue
+        result.append(field)
+    return tuple(result)
+
+
+def projected_class (cls, fields=None, skip=()):
+    """
+    Return a version of an _XMLMapper class (such as Incident) which only
+    parses the requested fields from XML, skipping other subelements entirely.
+    Attributes which are not parsed are set to None (or an empty list for
+    lists), even if the constructor has another default value such as
+    lang='en'. The projected class is a subclass of cls, and to_xml is
+    unchanged.
+    - fields: list of python attribute names to be parsed, such as
+      ['id', 'report_time', 'assessments'], or None for all attributes
+    - skip: list of classes (such as [EventData]) whose objects are not
+      parsed at any level, including their subclasses
+    """
+    if fields is not None:
+        fields = frozenset(fields)
+        names = set(field.attrib for field in _iter_xml_fields(cls.xml_fields))
+        unknown = fields - names
+        if unknown:
+            raise ValueError('Unknown field(s) for %s: %s' % (cls.__name__,
+                ', '.join(sorted(unknown))))
+    skip = frozenset(skip)
+    key = (cls, fields, skip)
+    projected_cls = _projected_classes.get(key, None)
+    if projected_cls is not None:
+        return projected_cls
+    # also skip the compact versions of skipped classes:
+    skip_classes = tuple(skip) + tuple(compact_class(c) for c in skip)
+    parse_fields = _project_fields(cls.xml_fields, fields, skip_classes, cls)
+    parsed = set(field.attrib for field in _iter_xml_fields(parse_fields))
+    skipped = tuple(field.attrib for field in _iter_xml_fields(cls.xml_fields)
+        if not isinstance(field, _LIST_FIELDS) and field.attrib not in parsed)
+    namespace = {
+        '__slots__': (),
+        '__module__': cls.__module__,
+        '__doc__': cls.__doc__,
+        '_parse_fields': parse_fields,
+        '_skipped_attribs': skipped,
+        'from_xml': _compile_from_xml(cls, parse_fields, reset=skipped),
+        '_variant': (projected_class, (cls, fields, skip)),
+        }
+    if skip:
+        # objects created for subelements are projected too:
+        for field in _iter_xml_fields(parse_fields):
+            if isinstance(field, XMLSubclassList):
+                namespace[field.class_var] = projected_class(
+                    getattr(cls, field.class_var), skip=skip)
+    projected_cls = type(cls)(cls.__name__, (cls,), namespace)
+    _projected_classes[key] = projected_cls
+    return projected_cls
+
+
+# cache of classes created by datetime_class:
+_datetime_classes = {}
+
+def datetime_class (cls, mode='datetime'):
+    """
+    Return a version of an _XMLMapper class (such as Incident) which converts
+    the DateTime attributes listed in xml_datetimes (e.g. report_time) when
+    parsing XML. The classes of subelements (e.g. EventDataClass) are
+    converted too.
+    - mode: 'datetime' to convert to datetime objects (see parse_datetime),
+      or 'epoch' to convert to a number of seconds since the epoch (UTC).
+      Invalid DateTime strings are kept unchanged.
+    In all classes, DateTime attributes may be set to a string, a datetime
+    object or a number of seconds since the epoch: to_xml converts them to
+    strings (see format_datetime).
+    The new class is a subclass of cls.
+    """
+    if mode not in _DATETIME_CONVERTERS:
+        raise ValueError('Unknown datetime mode: %r' % mode)
+    key = (cls, mode)
+    datetime_cls = _datetime_classes.get(key, None)
+    if datetime_cls is not None:
+        return datetime_cls
+    namespace = {
+        '__slots__': (),
+        '__module__': cls.__module__,
+        '__doc__': cls.__doc__,
+        '_datetime_mode': mode,
+        '_variant': (datetime_class, (cls, mode)),
+        }
+    # objects created for subelements are converted too:
+    for field in _iter_xml_fields(cls.xml_fields or ()):
+        if isinstance(field, XMLSubclassList):
+            namespace[field.class_var] = datetime_class(
+                getattr(cls, field.class_var), mode)
+    datetime_cls = type(cls)(cls.__name__, (cls,), namespace)
+    datetime_cls.from_xml = _compile_from_xml(datetime_cls)
+    if _instrumentation is not None:
+        _instrument_class(datetime_cls)
+    _datetime_classes[key] = datetime_cls
+    return datetime_cls
+
+
+# cache of classes created by editable_class:
+_editable_classes = {}
+
+def _source_plan(parsed, fields):
+    """
+    helper function for editable_class: return a tuple describing how to merge
+    a source element into an element generated by to_xml, from the parsed
+    field descriptions and all field descriptions (used by to_xml):
+    (parsed attribute names, parsed subelement tags, {tag: position} for all
+    subelements, ((tag, plan), ...) for XMLChild subelements)
+    """
+    attribs = frozenset(field.xml_name for field in parsed
+        if isinstance(field, XMLAttrib))
+    order = {}
+    for position, field in enumerate(fields):
+        if isinstance(field, _SUBELEMENT_FIELDS):
+            order[field.tag] = position
+    tags = []
+    children = []
+    for field in parsed:
+        if isinstance(field, _SUBELEMENT_FIELDS):
+            tags.append(field.tag)
+        if isinstance(field, XMLChild):
+            for generated in fields:
+                if getattr(generated, 'tag', None) == field.tag:
+                    children.append((field.tag,
+                        _source_plan(field.fields, generated.fields)))
+    return attribs, frozenset(tags), order, tuple(children)
+
+
+def _merge_source(xml, source, plan):
+    """
+    add to an element generated by to_xml the XML attributes and subelements
+    of its source element which were not parsed (see editable_class), such as
+    unknown extension elements. Subelements are inserted after the parsed
+    ones which precede them in the source element.
+    """
+    attribs, tags, order, children = plan
+    for name, value in source.items():
+        if name not in attribs and xml.get(name) is None:
+            xml.set(name, value)
+    for tag, child_plan in children:
+        new = xml.find(tag)
+        old = source.find(tag)
+        if new is not None and old is not None:
+            _merge_source(new, old, child_plan)
+    extra = []
+    generated = None
+    position = -1
+    for child in source:
+        tag = child.tag
+        if tag in tags:
+            position = order[tag]
+            continue
+        if tag in order:
+            # not parsed (see projected_class), keep it unless it was set:
+            if generated is None:
+                generated = set(c.tag for c in xml)
+            position = order[tag]
+            if tag in generated:
+                continue
+        extra.append(child)
+        extra.append(position)
+    if not extra:
+        return
+    # stable sort of the generated subelements (already in the order of the
+    # fields) and the extra ones:
+    items = [(order.get(c.tag, -1), 0, i, c) for i, c in enumerate(xml)]
+    for i in xrange(0, len(extra), 2):
+        items.append((extra[i+1], 1, i, copy.deepcopy(extra[i])))
+    items.sort()
+    xml[:] = [item[3] for item in items]
+
+
+def _editable_setattr(self, name, value):
+    """
+    __setattr__ method for classes created by editable_class: assigning a
+    public attribute marks the object as modified.
+    """
+    object.__setattr__(self, name, value)
+    if name[0] != '_':
+        object.__setattr__(self, '_modified', True)
+
+
+def _editable_is_modified(self):
+    """
+    return True if the object has been modified since it was parsed, or if it
+    was not parsed from XML. Accessing its subelements (e.g. event_data)
+    counts as a modification, as they may be changed in place.
+    """
+    return getattr(self, '_xml_original', None) is None or \
+        getattr(self, '_modified', True)
+
+
+def _editable_unmodified_source(self):
+    """
+    return the source XML element of the object if it has not been modified,
+    else None. (see IODEF_Document.write)
+    """
+    if _editable_is_modified(self):
+        return None
+    return self._xml_original
+
+
+def editable_class (cls, track=True):
+    """
+    Return an editable version of an _XMLMapper class such as Incident, whose
+    objects keep the XML element they were parsed from, so that documents can
+    be edited and serialized again without losing anything nor serializing
+    all objects again:
+    - to_xml adds back the XML attributes and subelements which are not
+      described by xml_fields (such as Method or IODEF extensions), at the
+      same position. The classes of subelements are editable too.
+    - if track is True, the objects of cls track modifications (see
+      is_modified): an object which has not been modified is serialized by
+      copying its source element. Subelements are parsed on first access as
+      with lazy_class, and accessing them counts as a modification.
+    The editable class is a subclass of cls. Each object keeps a reference to
+    its source element, so the whole XML tree is kept in memory.
+    """
+    key = (cls, track)
+    editable_cls = _editable_classes.get(key, None)
+    if editable_cls is not None:
+        return editable_cls
+    base = cls
+    if track and getattr(cls, '_deferred_attribs', None) is None:
+        base = lazy_class(cls)
+    parsed = cls._parse_fields
+    if parsed is None:
+        parsed = cls.xml_fields
+    plan = _source_plan(parsed, cls.xml_fields)
+
+    def from_xml(self, xml):
+        base.from_xml(self, xml)
+        self._xml_original = xml
+        if track:
+            self._modified = False
+
+    def to_xml(self):
+        source = getattr(self, '_xml_original', None)
+        if source is None:
+            return base.to_xml(self)
+        if track and not getattr(self, '_modified', True):
+            return copy.deepcopy(source)
+        xml = base.to_xml(self)
+        _merge_source(xml, source, plan)
+        return xml
+
+    namespace = {
+        '__slots__': ('_xml_original',),
+        '__module__': cls.__module__,
+        '__doc__': cls.__doc__,
+        'from_xml': from_xml,
+        'to_xml': to_xml,
+        '_variant': (editable_class, key),
+        }
+    if track:
+        def load_deferred(self):
+            if base._load_deferred(self):
+                self._modified = True
+                return True
+            return False
+        namespace.update({
+            '__slots__': ('_xml_original', '_modified'),
+            '__setattr__': _editable_setattr,
+            '_load_deferred': load_deferred,
+            'is_modified': _editable_is_modified,
+            '_unmodified_source': _editable_unmodified_source,
+            })
+    # objects created for subelements keep their source too:
+    for field in _iter_xml_fields(cls.xml_fields or ()):
+        if isinstance(field, XMLSubclassList):
+            namespace[field.class_var] = editable_class(
+                getattr(cls, field.class_var), track=False)
+    editable_cls = type(cls)(cls.__name__, (base,), namespace)
+    _editable_classes[key] = editable_cls
+    return editable_cls
+
+
+# cache of document classes created by _document_class:
+_document_classes = {}
+
+def _document_class(document_class=None, compact=False, lazy=False,
+    fields=None, skip=None, datetimes=None, editable=False):
+    """
+    return the IODEF_Document class (or subclass) to be used by the parsing
+    functions for the given options.
+    """
+    if document_class is None:
+        document_class = IODEF_Document
+    if fields is not None:
+        fields = frozenset(fields)
+    skip = frozenset(skip or ())
+    key = (document_class, compact, lazy, fields, skip, datetimes, editable)
+    cls = _document_classes.get(key, None)
+    if cls is not None:
+        return cls
+    cls = document_class
+    if compact:
+        cls = compact_class(cls)
+    IncidentClass = cls.IncidentClass
+    if datetimes is not None:
+        IncidentClass = datetime_class(IncidentClass, datetimes)
+    if fields is not None or skip:
+        IncidentClass = projected_class(IncidentClass, fields, skip)
+    if lazy:
+        IncidentClass = lazy_class(IncidentClass)
+    if editable:
+        IncidentClass = editable_class(IncidentClass)
+    if IncidentClass is not cls.IncidentClass:
+        cls = type(cls)(cls.__name__, (cls,), {
+            '__slots__': (),
+            '__module__': cls.__module__,
+            'IncidentClass': IncidentClass,
+            '_variant': (_document_class, key),
+            })
+    _document_classes[key] = cls
+    return cls
+
+
+#--- VALIDATION ---------------------------------------------------------------
+
+# XML schema of IODEF (RFC 5070), installed with iodeflib:
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'iodef-1.0.xsd')
+
+# validation modes, see validate_element:
+VALIDATION_MODES = ('structure', 'schema')
+
+
+class ValidationError (ValueError):
+    """
+    Exception raised when an IODEF document is not valid.
+
+    attributes:
+    - errors: list of error messages
+    """
+
+    def __init__(self, message, errors=None):
+        ValueError.__init__(self, message)
+        if errors is None:
+            errors = [message]
+        self.errors = errors
+
+
+# XMLSchema objects, for each thread (see get_schema):
+_thread_schemas = threading.local()
+
+def get_schema():
+    """
+    return the lxml XMLSchema object for IODEF, compiled from SCHEMA_FILE the
+    first time it is used in each thread. (compiled schemas are not shared
+    between threads, as for parsers)
+    Raise ImportError if lxml is not available.
+    """
+    if not LXML:
+        raise ImportError, "lxml is required for schema validation, "\
+            +"see http://codespeak.net/lxml"
+    schema = getattr(_thread_schemas, 'schema', None)
+    if schema is None:
+        schema = _thread_schemas.schema = ET.XMLSchema(ET.parse(SCHEMA_FILE))
+    return schema
+
+
+def check_structure (elem):
+    """
+    Quick check of the structure of an IODEF document parsed to an XML
+    element, much faster than schema validation: the root element must be
+    IODEF-Document in the IODEF namespace, with version 1.00, and it must
+    contain one or more Incident elements (and nothing else).
+    return the number of Incident elements.
+    Raise ValidationError if the structure is not valid.
+    """
+    _check_root(elem)
+    count = 0
+    for child in elem:
+        if child.tag == TAG_Incident:
+            count += 1
+        elif isinstance(child.tag, basestring):
+            # (comments and processing instructions are allowed)
+            raise ValidationError('Unexpected element in IODEF-Document: %s'
+                % child.tag)
+    if not count:
+        raise ValidationError('IODEF-Document does not contain any Incident')
+    return count
+
+
+def _check_root(elem):
+    "check the tag and version of the root element, see check_structure"
+    if elem.tag != TAG_IODEF_Document:
+        raise ValidationError('Root element is %s instead of %s' % (elem.tag,
+            TAG_IODEF_Document))
+    version = elem.get('version', None)
+    if version != '1.00':
+        raise ValidationError('Unsupported IODEF version: %r' % version)
+
+
+def _validate_schema(elem):
+    "validate an XML element with the IODEF schema, raise ValidationError"
+    schema = get_schema()
+    if not schema.validate(elem):
+        errors = [str(error) for error in schema.error_log]
+        raise ValidationError('%d schema error(s), first: %s' % (len(errors),
+            errors[0]), errors)
+
+
+def _sampled(sample):
+    "return True for a fraction sample (between 0 and 1) of the calls"
+    return sample >= 1 or random.random() < sample
+
+
+def validate_element (elem, mode='schema', sample=1.0):
+    """
+    Validate an IODEF document parsed to an XML element.
+    - mode: 'structure' for a quick check of the structure only (see
+      check_structure), or 'schema' to also validate the element with the
+      IODEF XML schema (see get_schema, requires lxml)
+    - sample: fraction of the documents to be validated with the schema,
+      between 0 and 1. The structure is always checked. This is useful to
+      detect invalid data in large volumes without validating everything.
+    Raise ValidationError if the document is not valid.
+    """
+    if mode not in VALIDATION_MODES:
+        raise ValueError('Unknown validation mode: %r' % mode)
+    check_structure(elem)
+    if mode == 'schema' and _sampled(sample):
+        _validate_schema(elem)
+
+
+# lxml parsers, for each thread (see get_parser):
+_thread_parsers = threading.local()
+
+def get_parser(huge_tree=False):
+    """
+    return an lxml XMLParser tuned for IODEF documents, which is created once
+    for each thread and then reused. (an lxml parser can be used for several
+    documents but not by several threads at the same time)
+    The parser removes blank text between elements, does not resolve entities
+    and does not access the network.
+    - huge_tree: if True, disable the security limits of libxml2 for very
+      large documents
+    return None if lxml is not available.
+    """
+    if not LXML:
+        return None
+    try:
+        parsers = _thread_parsers.parsers
+    except AttributeError:
+        parsers = _thread_parsers.parsers = {}
+    parser = parsers.get(huge_tree, None)
+    if parser is None:
+        parser = _new_parser(huge_tree)
+        parsers[huge_tree] = parser
+    return parser
+
+
+# options of all lxml parsers (XMLParser, XMLPullParser, iterparse): entities
+# are not resolved and the network is not accessed, so that documents cannot
+# include the content of local files or URLs (XXE attacks)
+_LXML_PARSER_OPTIONS = dict(remove_blank_text=True, resolve_entities=False,
+    no_network=True)
+
+def _new_parser(huge_tree=False):
+    "return a new XMLParser with the options of get_parser"
+    if LXML:
+        return ET.XMLParser(huge_tree=huge_tree, **_LXML_PARSER_OPTIONS)
+    return ET.XMLParser()
+
+
+def _iterparse(source, huge_tree=False):
     """
-    return parse(open(filename).read())
+    return an iterator of (event, element) tuples for the start and end
+    events of an XML file, with the options of get_parser.
+    - source: filename or file object opened in binary mode
+    """
+    if LXML:
+        return ET.iterparse(source, events=('start', 'end'),
+            huge_tree=huge_tree, **_LXML_PARSER_OPTIONS)
+    return ET.iterparse(source, events=('start', 'end'))
+
+
+def _fromstring(xml_string, huge_tree=False):
+    """
+    parse an XML string to an element, using the parser of the current thread
+    when lxml is available.
+    """
+    if LXML:
+        return ET.fromstring(xml_string, get_parser(huge_tree))
+    return ET.fromstring(xml_string)
+
+
+# size of the chunks of a memory-mapped file passed to the parser:
+MMAP_CHUNK_SIZE = 1024*1024
+
+def _parse_mmap(f, huge_tree=False):
+    """
+    parse an XML file mapped in memory, return the root element, or None if
+    the file cannot be mapped (e.g. an empty file or a pipe).
+    The file is passed to a new parser in chunks of MMAP_CHUNK_SIZE bytes,
+    so that its content is never copied into a single string.
+    """
+    try:
+        fileno = f.fileno()
+        size = os.fstat(fileno).st_size
+    except (AttributeError, IOError, OSError):
+        return None
+    start = _tell(f) or 0
+    if size <= start:
+        return None
+    try:
+        data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+    try:
+        parser = _new_parser(huge_tree)
+        for position in xrange(start, size, MMAP_CHUNK_SIZE):
+            parser.feed(data[position:position+MMAP_CHUNK_SIZE])
+        return parser.close()
+    finally:
+        data.close()
+
+
+def _parse_source(source, huge_tree=False, use_mmap=False):
+    """
+    parse an XML file to an element, reading it directly instead of loading
+    it into a string first. The parser decodes the file according to its XML
+    declaration.
+    - source: filename or file object opened in binary mode
+    - use_mmap: if True, map the file in memory, see parse_file
+    """
+    if use_mmap:
+        if isinstance(source, basestring):
+            f = open(source, 'rb')
+        else:
+            f = source
+        try:
+            elem = _parse_mmap(f, huge_tree)
+        finally:
+            if f is not source:
+                f.close()
+        if elem is not None:
+            return elem
+    if LXML:
+        return ET.parse(source, get_parser(huge_tree)).getroot()
+    return ET.parse(source).getroot()
+
+
+def _new_document(elem, compact=False, lazy=False, fields=None, skip=None,
+    datetimes=None, validate=None, validate_sample=1.0, editable=False):
+    """
+    validate a parsed root element and create the IODEF_Document object,
+    see parse
+    """
+    document_class = _document_class(compact=compact, lazy=lazy,
+        fields=fields, skip=skip, datetimes=datetimes, editable=editable)
+    if validate is not None:
+        validate_element(elem, validate, validate_sample)
+    return document_class(from_xml = elem)
+
+
+def parse (xml_string, compact=False, lazy=False, fields=None, skip=None,
+    huge_tree=False, datetimes=None, validate=None, validate_sample=1.0,
+    editable=False):
+    """
+    Parse an XML string containing an IODEF incident report
+    return an IODEF_Document object
+    - compact: if True, use compact classes to reduce memory usage, see
+      compact_class
+    - lazy: if True, the subelements of each Incident are only parsed when
+      accessed, see lazy_class
+    - fields: list of Incident attributes to be parsed, such as
+      ['id', 'report_time', 'assessments'], or None for all (see
+      projected_class)
+    - skip: list of classes which are not parsed at all, such as [EventData]
+    - huge_tree: if True, allow very large documents with lxml (see
+      get_parser)
+    - datetimes: 'datetime' or 'epoch' to convert DateTime attributes such as
+      report_time to datetime objects or numbers (see datetime_class), None
+      to keep strings
+    - validate: None, 'structure' or 'schema' to validate the XML before
+      parsing it, see validate_element (ValidationError is raised if it is
+      not valid)
+    - validate_sample: fraction of the documents to be validated with the
+      schema, between 0 and 1
+    - editable: if True, incidents keep their source XML element, so that
+      unmodified incidents and unknown subelements are written unchanged
+      (see editable_class)
+    This function is thread-safe: with lxml, several threads can parse
+    documents at the same time.
+    """
+    stats = _instrumentation
+    if stats is not None:
+        start = time.time()
+    elem = _fromstring(xml_string, huge_tree)
+    document = _new_document(elem, compact, lazy, fields, skip, datetimes,
+        validate, validate_sample, editable)
+    if stats is not None:
+        stats.operation('parse', start, len(xml_string))
+    return document
+
+
+def parse_file (filename, compact=False, lazy=False, fields=None, skip=None,
+    huge_tree=False, datetimes=None, validate=None, validate_sample=1.0,
+    editable=False, cache=None, use_mmap=False):
+    """
+    Parse an XML file containing an IODEF incident report
+    return an IODEF_Document object
+    The file is read directly by the parser, without loading it into a
+    string first, and decoded according to its XML declaration.
+    - filename: filename or file object opened in binary mode
+    - cache: optional ParseCache object, to avoid parsing the same file again
+      (filename must be a filename)
+    - use_mmap: if True, map the file in memory and pass it to the parser in
+      chunks (see MMAP_CHUNK_SIZE), for large local files. Files which cannot
+      be mapped are read normally.
+    (see parse for the other options)
+    """
+    if cache is not None:
+        return cache.parse_file(filename, compact=compact, lazy=lazy,
+            fields=fields, skip=skip, huge_tree=huge_tree, datetimes=datetimes,
+            validate=validate, validate_sample=validate_sample,
+            editable=editable, use_mmap=use_mmap)
+    stats = _instrumentation
+    if stats is not None:
+        start = time.time()
+    elem = _parse_source(filename, huge_tree, use_mmap)
+    document = _new_document(elem, compact, lazy, fields, skip, datetimes,
+        validate, validate_sample, editable)
+    if stats is not None:
+        if isinstance(filename, basestring):
+            size = os.path.getsize(filename)
+        else:
+            size = _tell(filename)
+        stats.operation('parse', start, size)
+    return document
+
+
+def _replace_file(source, destination):
+    """
+    rename the file source to destination, replacing it if it exists. (on
+    Windows, os.rename fails if destination exists)
+    """
+    try:
+        os.rename(source, destination)
+    except OSError:
+        if not os.path.exists(destination):
+            raise
+        try:
+            os.remove(destination)
+        except OSError:
+            # already removed by another process
+            pass
+        os.rename(source, destination)
+
+
+class ParseCache (object):
+    """
+    Cache of IODEF_Document objects parsed from files, to be used with
+    parse_file when the same files are parsed many times.
+
+    Files are identified by their path, size and modification time, or by a
+    hash of their content if content_hash is True (slower, but files may be
+    copied or touched). The least recently used documents are removed when
+    the cache holds more than max_entries documents, or when the total size
+    of the parsed files exceeds max_bytes.
+    If directory is set, documents are also stored in that directory as binary
+    snapshots (see dump_binary), so that they can be loaded without parsing
+    after being removed from memory, or by another process. The least recently
+    used snapshots are deleted when their total size exceeds max_disk_bytes.
+
+    Note that cached documents are shared: they should not be modified.
+
+    attributes:
+    - hits: number of documents found in memory
+    - disk_hits: number of documents loaded from directory
+    - misses: number of files parsed
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, directory=None,
+        content_hash=False, max_disk_bytes=256*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.content_hash = content_hash
+        # key -> (document, size of the file), from oldest to newest:
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """
+        remove all documents from memory (but not from directory), and reset
+        counters.
+        """
+        self._entries.clear()
+        self.size = 0
+        self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        """
+        return a dictionary with the counters and the current size of the
+        cache.
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+            'misses': self.misses, 'entries': len(self._entries),
+            'bytes': self.size}
+
+    def _disk_path(self, key):
+        """
+        return the path of the file storing the document for key in directory
+        """
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, digest + '.iodefcache')
+
+    def _load(self, key, document_class):
+        """
+        load the document for key from directory, return None if not found.
+        """
+        path = self._disk_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            document = document_class.load_binary(f)
+            # update the modification time, used to find the least recently
+            # used files (see _prune):
+            os.utime(path, None)
+            return document
+        except _BINARY_ERRORS:
+            # corrupted or incompatible file, or deleted by another process,
+            # parse again:
+            log.debug('ignoring cache file %s', f.name)
+            return None
+        finally:
+            f.close()
+
+    def _store(self, key, document):
+        """
+        store the document for key in directory.
+        """
+        path = self._disk_path(key)
+        # write to a temporary file first, for concurrent readers:
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        f = open(temp_path, 'wb')
+        try:
+            document.dump_binary(f)
+        finally:
+            f.close()
+        try:
+            _replace_file(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        if self.max_disk_bytes is not None:
+            self._prune()
+
+    def _prune(self):
+        """
+        delete the least recently used files from directory until their total
+        size is below max_disk_bytes.
+        """
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.iodefcache'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # deleted by another process
+                continue
+            files.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+        files.sort()
+        # always keep the most recent file:
+        for mtime, path, size in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _add(self, key, document, size):
+        """
+        add a document to memory, and remove the least recently used ones if
+        needed.
+        """
+        self._entries[key] = (document, size)
+        self.size += size
+        while len(self._entries) > 1 and (
+            (self.max_entries is not None
+                and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.size > self.max_bytes)):
+            old_key, (old_document, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+
+    def parse_file(self, filename, compact=False, lazy=False, fields=None,
+        skip=None, huge_tree=False, datetimes=None, validate=None,
+        validate_sample=1.0, editable=False, use_mmap=False):
+        """
+        return the IODEF_Document object parsed from filename, from the cache
+        if available. (see parse and parse_file for the options)
+        Files are only validated when they are parsed, not when a document is
+        found in the cache. Editable documents are only kept in memory, not in
+        directory, as binary snapshots do not contain the source XML.
+        """
+        # the options are part of the key, in a form which does not depend on
+        # the process (for directory):
+        if fields is not None:
+            fields = tuple(sorted(fields))
+        options = (bool(compact), bool(lazy), fields,
+            tuple(sorted(skip or (), key=repr)), datetimes, bool(editable))
+        data = None
+        if self.content_hash:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            size = len(data)
+            key = (hashlib.sha1(data).hexdigest(),) + options
+        else:
+            st = os.stat(filename)
+            size = st.st_size
+            key = (os.path.abspath(filename), size, st.st_mtime) + options
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            # move the entry to the end, as the most recently used:
+            self._entries[key] = entry
+            return entry[0]
+        document = None
+        use_directory = self.directory is not None and not editable
+        if use_directory:
+            document_class = _document_class(compact=compact, lazy=lazy,
+                fields=fields, skip=skip, datetimes=datetimes)
+            document = self._load(key, document_class)
+            if document is not None:
+                self.disk_hits += 1
+        if document is None:
+            self.misses += 1
+            if data is None:
+                document = parse_file(filename, compact=compact, lazy=lazy,
+                    fields=fields, skip=skip, huge_tree=huge_tree,
+                    datetimes=datetimes, validate=validate,
+                    validate_sample=validate_sample, editable=editable,
+                    use_mmap=use_mmap)
+            else:
+                document = parse(data, compact=compact, lazy=lazy,
+                    fields=fields, skip=skip, huge_tree=huge_tree,
+                    datetimes=datetimes, validate=validate,
+                    validate_sample=validate_sample, editable=editable)
+            if use_directory:
+                self._store(key, document)
+        self._add(key, document, size)
+        return document
+
+
+def _tell(f):
+    "return the current position of a file object, or None if not available"
+    try:
+        return f.tell()
+    except (AttributeError, IOError):
+        return None
+
+
+def _discard_element(elem, root, keep=False):
+    """
+    helper function to free the memory used by an XML element (and all its
+    subelements) once it has been processed by iterparse, including previous
+    siblings still referenced by the parent element.
+    If keep is True, the element is only detached from its parent, because it
+    is still used (e.g. by a lazy Incident object).
+    """
+    if not keep:
+        elem.clear()
+    if LXML:
+        # lxml keeps other nodes such as comments as siblings:
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+        if keep:
+            parent.remove(elem)
+    else:
+        # ElementTree does not provide parent links, but previous incidents
+        # have already been removed so elem is the first child of root:
+        root.remove(elem)
+
+
+def iter_incidents (source, document_class=None, compact=False, lazy=False,
+    fields=None, skip=None, datetimes=None, editable=False, huge_tree=False):
+    """
+    Parse an XML file containing an IODEF incident report incrementally,
+    yield each Incident object as soon as its XML element has been parsed.
+    Each Incident element is discarded after use, so that memory usage does
+    not depend on the size of the file.
+    - source: filename or file object opened in binary mode
+    - document_class: IODEF_Document class (or subclass) whose IncidentClass
+      is used to create Incident objects. Default: IODEF_Document
+    - compact: if True, use compact classes to reduce memory usage, see
+      compact_class
+    - lazy: if True, the subelements of each Incident are only parsed when
+      accessed, see lazy_class. (each Incident keeps its XML element in memory
+      until then)
+    - fields: list of Incident attributes to be parsed, or None for all
+    - skip: list of classes which are not parsed at all, such as [EventData]
+    - datetimes: 'datetime' or 'epoch' to convert DateTime attributes, see
+      parse
+    - editable: if True, each Incident keeps its XML element, see
+      editable_class
+    - huge_tree: if True, allow very large documents with lxml (see
+      get_parser)
+    """
+    document_class = _document_class(document_class, compact, lazy, fields,
+        skip, datetimes, editable)
+    IncidentClass = document_class.IncidentClass
+    root = None
+    for event, elem in _iterparse(source, huge_tree):
+        if event == 'start':
+            if root is None:
+                root = elem
+        elif elem.tag == TAG_Incident:
+            yield IncidentClass(from_xml=elem)
+            _discard_element(elem, root, keep=lazy or editable)
+
+
+class _EventTreeBuilder (object):
+    """
+    parser target for ElementTree, which builds the tree with a TreeBuilder
+    and records start/end events, like lxml's XMLPullParser.
+    """
+
+    def __init__(self):
+        self.builder = ET.TreeBuilder()
+        self.events = []
+
+    def start(self, tag, attrib):
+        elem = self.builder.start(tag, attrib)
+        self.events.append(('start', elem))
+        return elem
+
+    def end(self, tag):
+        elem = self.builder.end(tag)
+        self.events.append(('end', elem))
+        return elem
+
+    def data(self, data):
+        self.builder.data(data)
+
+    def close(self):
+        return self.builder.close()
+
+
+class _IncidentPullParser (object):
+    """
+    incremental parser fed with chunks of an IODEF document, which creates
+    Incident objects as soon as their end tag has been parsed. Each Incident
+    element is discarded after use (see iter_incidents).
+    """
+
+    def __init__(self, IncidentClass, lazy=False, huge_tree=False):
+        self.IncidentClass = IncidentClass
+        self.lazy = lazy
+        # root element, once its start tag has been parsed:
+        self.root = None
+        if LXML:
+            self._parser = ET.XMLPullParser(events=('start', 'end'),
+                huge_tree=huge_tree, **_LXML_PARSER_OPTIONS)
+            self._target = None
+        else:
+            self._target = _EventTreeBuilder()
+            self._parser = ET.XMLParser(target=self._target)
+
+    def _read_events(self):
+        "return the list of events parsed since the last call"
+        if self._target is None:
+            return self._parser.read_events()
+        events = self._target.events
+        self._target.events = []
+        return events
+
+    def _elements(self):
+        """
+        return the list of Incident elements completed since the last call,
+        detached from the root element.
+        """
+        elements = []
+        for event, elem in self._read_events():
+            if event == 'start':
+                if self.root is None:
+                    self.root = elem
+            elif elem.tag == TAG_Incident:
+                elements.append(elem)
+                _discard_element(elem, self.root, keep=True)
+        return elements
+
+    def _create(self, elements):
+        "create the Incident objects for a list of elements"
+        IncidentClass = self.IncidentClass
+        incidents = []
+        for elem in elements:
+            incidents.append(IncidentClass(from_xml=elem))
+            if not self.lazy:
+                elem.clear()
+        return incidents
+
+    def feed(self, data, executor=None):
+        """
+        parse a chunk of data, return the list of Incident objects whose end
+        tag has been parsed.
+        - executor: object with an apply(function, args) method, used to
+          create the Incident objects
+        """
+        stats = _instrumentation
+        if stats is not None:
+            start = time.time()
+        self._parser.feed(data)
+        elements = self._elements()
+        if executor is not None and elements:
+            incidents = executor.apply(self._create, (elements,))
+        else:
+            incidents = self._create(elements)
+        if stats is not None:
+            stats.operation('feed', start, len(data))
+        return incidents
+
+    def close(self):
+        """
+        finish parsing, return the list of remaining Incident objects. Raise
+        an exception if the document is incomplete.
+        """
+        self._parser.close()
+        return self._create(self._elements())
+
+
+class IncidentFeedParser (object):
+    """
+    Incremental parser for an IODEF document received in chunks of any size,
+    e.g. from a socket or a message queue: data is passed to feed, and the
+    Incident objects are created as soon as their end tag has been parsed,
+    without waiting for the whole document.
+
+    usage:
+        parser = IncidentFeedParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+            for incident in parser.read_incidents():
+                ...
+        parser.close()
+        for incident in parser.read_incidents():
+            ...
+
+    attributes:
+    - lang, version: attributes of the IODEF-Document element, set as soon
+      as its start tag has been parsed (None until then)
+    """
+
+    def __init__(self, document_class=None, compact=False, lazy=False,
+        fields=None, skip=None, datetimes=None, huge_tree=False):
+        """
+        constructor for IncidentFeedParser class
+        (see iter_incidents and parse for the options)
+        """
+        self.document_class = _document_class(document_class, compact, lazy,
+            fields, skip, datetimes)
+        self._parser = _IncidentPullParser(self.document_class.IncidentClass,
+            lazy, huge_tree)
+        self._incidents = []
+        self.lang = None
+        self.version = None
+
+    def _update(self, incidents):
+        "store new incidents, and get the document attributes"
+        self._incidents += incidents
+        root = self._parser.root
+        if root is not None and self.version is None:
+            self.lang = root.get('lang', None)
+            self.version = root.get('version', None)
+
+    def feed(self, data):
+        """
+        parse a chunk of data (bytes). The completed incidents are available
+        from read_incidents.
+        """
+        self._update(self._parser.feed(data))
+
+    def read_incidents(self):
+        """
+        return the list of Incident objects completed since the last call.
+        """
+        incidents = self._incidents
+        self._incidents = []
+        return incidents
+
+    def close(self):
+        """
+        finish parsing: raise an exception if the document is incomplete.
+        The last incidents are available from read_incidents.
+        """
+        self._update(self._parser.close())
+
+
+class IncidentStreamReader (object):
+    """
+    Read Incident objects incrementally from a stream such as a socket or an
+    HTTP response, yielding each of them as soon as its end tag has been
+    received. Incidents can be processed while the rest of the document is
+    still being transferred, and memory usage does not depend on the size of
+    the document.
+
+    To avoid blocking other connections in a server based on an event loop or
+    on coroutines (e.g. gevent), the Incident objects of large chunks can be
+    created by an executor: an object with an apply(function, args) method,
+    such as gevent.threadpool.ThreadPool or multiprocessing.pool.ThreadPool.
+    (the XML parser itself always runs in the calling thread, because lxml
+    parsers cannot be used from several threads)
+
+    usage:
+        for incident in IncidentStreamReader(sock.makefile('rb')):
+            ...
+    """
+
+    def __init__(self, source, chunk_size=65536, executor=None,
+        executor_threshold=65536, document_class=None, compact=False,
+        lazy=False, fields=None, skip=None, datetimes=None, huge_tree=False):
+        """
+        constructor for IncidentStreamReader class
+        - source: file-like object with a read method, or iterable of byte
+          strings (chunks of the document)
+        - chunk_size: number of bytes read at once from a file-like object
+        - executor: object with an apply(function, args) method, used to
+          create the Incident objects of chunks of at least
+          executor_threshold bytes
+        - other options: see iter_incidents and parse
+        """
+        self.source = source
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.executor_threshold = executor_threshold
+        self.document_class = _document_class(document_class, compact, lazy,
+            fields, skip, datetimes)
+        self.lazy = lazy
+        self.huge_tree = huge_tree
+
+    def _chunks(self):
+        "return an iterator over the chunks of the source"
+        read = getattr(self.source, 'read', None)
+        if read is None:
+            return iter(self.source)
+        chunk_size = self.chunk_size
+        return iter(lambda: read(chunk_size), '')
+
+    def __iter__(self):
+        parser = _IncidentPullParser(self.document_class.IncidentClass,
+            self.lazy, self.huge_tree)
+        executor = self.executor
+        for chunk in self._chunks():
+            if len(chunk) >= self.executor_threshold:
+                incidents = parser.feed(chunk, executor)
+            else:
+                incidents = parser.feed(chunk)
+            for incident in incidents:
+                yield incident
+        for incident in parser.close():
+            yield incident
+
+
+def _parse_many_worker(task):
+    """
+    parse one file for parse_many, in a worker process.
+    return (path, result, error) (see parse_many)
+    """
+    path, incidents, options = task
+    try:
+        iodef = parse_file(path, **options)
+    except Exception, exc:
+        # exceptions may not be picklable, so only the message is returned:
+        return (path, None, '%s: %s' % (type(exc).__name__, exc))
+    if incidents:
+        return (path, iodef.incidents, None)
+    return (path, iodef, None)
+
+
+def parse_many (paths, workers=None, chunksize=1, ordered=True,
+    incidents=False, threads=False, **options):
+    """
+    Parse many XML files containing IODEF incident reports in parallel, using
+    a pool of processes (or threads).
+    Yield a (path, result, error) tuple for each file: result is an
+    IODEF_Document object (or a list of Incident objects if incidents is
+    True), or None if the file could not be parsed. In that case error is a
+    string describing the error, else None. An error does not stop the batch.
+    - paths: iterable of filenames
+    - workers: number of processes, by default the number of CPUs
+    - chunksize: number of files sent to a process at once
+    - ordered: if True, results are yielded in the order of paths, else as
+      soon as they are available
+    - incidents: if True, return lists of Incident objects
+    - threads: if True, use a pool of threads instead of processes. lxml
+      releases the GIL while parsing, so this avoids the cost of pickling
+      results, especially when reading files is slow.
+    - other keyword arguments are passed to parse_file (e.g. compact)
+    With processes, results are pickled: lazy documents are fully loaded, and
+    editable documents lose their source XML (all incidents are considered as
+    modified, see editable_class).
+    """
+    if threads:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    else:
+        pool = multiprocessing.Pool(workers)
+    finished = False
+    try:
+        tasks = ((path, incidents, options) for path in paths)
+        if ordered:
+            results = pool.imap(_parse_many_worker, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_parse_many_worker, tasks, chunksize)
+        for result in results:
+            yield result
+        finished = True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+#--- ADDRESS INDEX ------------------------------------------------------------
+
+# Address categories which can be indexed: category -> number of bits
+_IP_CATEGORIES = {
+    'ipv4-addr': 32,
+    'ipv4-net': 32,
+    'ipv4-net-mask': 32,
+    'ipv6-addr': 128,
+    'ipv6-net': 128,
+    'ipv6-net-mask': 128,
+    }
+
+# valid parts of IPv4 and IPv6 addresses, checked before int() which also
+# accepts signs, spaces or '0x' prefixes:
+_IPV4_PART = re.compile(r'[0-9]{1,3}\Z')
+_IPV6_GROUP = re.compile(r'[0-9a-fA-F]{1,4}\Z')
+
+def _parse_ipv4(text):
+    """
+    convert an IPv4 address in dotted-decimal notation to an integer
+    """
+    parts = text.split('.')
+    if len(parts) != 4:
+        raise ValueError, 'invalid IPv4 address: %r' % text
+    value = 0
+    for part in parts:
+        if not _IPV4_PART.match(part):
+            raise ValueError, 'invalid IPv4 address: %r' % text
+        n = int(part)
+        if n > 255:
+            raise ValueError, 'invalid IPv4 address: %r' % text
+        value = (value << 8) | n
+    return value
+
+
+def _parse_ipv6(text):
+    """
+    convert an IPv6 address (RFC 4291 text representation) to an integer
+    """
+    if '.' in text:
+        # IPv4 address in the last 32 bits:
+        head, sep, ipv4 = text.rpartition(':')
+        ipv4 = _parse_ipv4(ipv4)
+        text = '%s:%x:%x' % (head, ipv4 >> 16, ipv4 & 0xFFFF)
+    if '::' in text:
+        if text.count('::') > 1:
+            raise ValueError, 'invalid IPv6 address: %r' % text
+        left, right = text.split('::')
+        left = left.split(':') if left else []
+        right = right.split(':') if right else []
+        missing = 8 - len(left) - len(right)
+        if missing < 1:
+            raise ValueError, 'invalid IPv6 address: %r' % text
+        groups = left + ['0'] * missing + right
+    else:
+        groups = text.split(':')
+    if len(groups) != 8:
+        raise ValueError, 'invalid IPv6 address: %r' % text
+    value = 0
+    for group in groups:
+        if not _IPV6_GROUP.match(group):
+            raise ValueError, 'invalid IPv6 address: %r' % text
+        value = (value << 16) | int(group, 16)
+    return value
+
+
+def _netmask(bits, length):
+    """
+    return the network mask for a prefix length, as an integer
+    """
+    return ((1 << length) - 1) << (bits - length)
+
+
+def parse_ip_range (text, category=None):
+    """
+    Parse an IP address or network, as stored in Address objects.
+    return a tuple (bits, start, length): bits is 32 for IPv4 and 128 for
+    IPv6, start is the first address of the network as an integer, length is
+    the prefix length (equal to bits for a single address).
+    - text: address such as '10.2.3.4', network such as '10.2.0.0/16',
+      '10.2.0.0/255.255.0.0' or '2001:db8::/32'
+    - category: category of the Address object, such as 'ipv4-addr' or
+      'ipv6-net'. By default the IP version is deduced from text.
+    Raise ValueError if text is not a valid address or network.
+    """
+    if category is None:
+        bits = 128 if ':' in text else 32
+    else:
+        bits = _IP_CATEGORIES[category]
+    parse_ip = _parse_ipv6 if bits == 128 else _parse_ipv4
+    address, sep, suffix = text.strip().partition('/')
+    value = parse_ip(address)
+    if not sep:
+        return (bits, value, bits)
+    if '.' in suffix or ':' in suffix:
+        # network mask:
+        mask = parse_ip(suffix)
+        length = bits
+        while length and not mask & (1 << (bits - length)):
+            length -= 1
+        if mask != _netmask(bits, length):
+            raise ValueError, 'non-contiguous network mask: %r' % text
+    else:
+        length = int(suffix)
+        if not 0 <= length <= bits:
+            raise ValueError, 'invalid prefix length: %r' % text
+    return (bits, value & _netmask(bits, length), length)
+
+
+class AddressIndex (object):
+    """
+    Index of the IP addresses and networks of the systems of incidents, to
+    find quickly which incidents involve an address or a network.
+
+    For each IP version and prefix length, the indexed networks are stored
+    in a dictionary and a sorted list of their first address, so that each
+    lookup takes a time proportional to the logarithm of the number of
+    addresses.
+    Each hit is a tuple (incident, system, role), where role is the category
+    of the System object (e.g. 'source' or 'target').
+
+    attributes:
+    - skipped: number of Address objects which could not be indexed (other
+      categories such as 'mac', or invalid values)
+    """
+
+    def __init__(self, source=None):
+        """
+        constructor for AddressIndex class
+        - source: IODEF_Document object, or iterable of Incident objects
+          (e.g. from iter_incidents) to be indexed
+        """
+        # (bits, length) -> {start: list of hits}
+        self._networks = {}
+        # (bits, length) -> sorted list of start, None when not up to date
+        self._starts = {}
+        # bits -> sorted list of indexed prefix lengths
+        self._lengths = {32: [], 128: []}
+        self.count = 0
+        self.skipped = 0
+        if source is not None:
+            self.add_incidents(source)
+
+    def __len__(self):
+        "return the number of indexed addresses and networks"
+        return self.count
+
+    def add_incidents(self, source):
+        """
+        add all the systems of an IODEF_Document object, or of an iterable
+        of Incident objects.
+        """
+        # IODEF_Document object, including compact classes:
+        source = getattr(source, 'incidents', source)
+        for incident in source:
+            self.add_incident(incident)
+
+    def add_incident(self, incident):
+        """
+        add all the systems of an Incident object, in all event_data/flows.
+        """
+        for event_data in incident.event_data:
+            for flow in event_data.flows:
+                for system in flow.systems:
+                    self.add_system(system, incident)
+
+    def add_system(self, system, incident=None):
+        """
+        add the IP addresses and networks of a System object.
+        """
+        hit = (incident, system, system.category)
+        for address in system.node_addresses:
+            category = address.category or 'ipv4-addr'
+            if category not in _IP_CATEGORIES or address.address is None:
+                self.skipped += 1
+                continue
+            try:
+                bits, start, length = parse_ip_range(address.address,
+                    category)
+            except ValueError:
+                self.skipped += 1
+                continue
+            key = (bits, length)
+            networks = self._networks.get(key, None)
+            if networks is None:
+                networks = self._networks[key] = {}
+                bisect.insort(self._lengths[bits], length)
+            hits = networks.get(start, None)
+            if hits is None:
+                networks[start] = [hit]
+                self._starts[key] = None
+            else:
+                hits.append(hit)
+            self.count += 1
+
+    def _sorted_starts(self, key):
+        "return the sorted list of network starts for key (bits, length)"
+        starts = self._starts.get(key, None)
+        if starts is None:
+            starts = self._starts[key] = sorted(self._networks[key])
+        return starts
+
+    def lookup(self, query, role=None, containing=True):
+        """
+        return the list of (incident, system, role) hits for an IP address or
+        network.
+        - query: address such as '10.2.3.4' or network such as '10.2.0.0/16'
+          (see parse_ip_range)
+        - role: if set, only return systems with this category, e.g. 'source'
+        - containing: if True, also return the indexed networks which contain
+          the query (e.g. 10.0.0.0/8 for 10.2.3.4), else only the addresses
+          and networks within the query.
+        """
+        bits, start, length = parse_ip_range(query)
+        end = start | ((1 << (bits - length)) - 1)
+        result = []
+        for indexed_length in self._lengths[bits]:
+            key = (bits, indexed_length)
+            if indexed_length > length:
+                # addresses and networks within the query:
+                starts = self._sorted_starts(key)
+                networks = self._networks[key]
+                i = bisect.bisect_left(starts, start)
+                j = bisect.bisect_right(starts, end)
+                for network in starts[i:j]:
+                    result += networks[network]
+            elif indexed_length == length or containing:
+                network = start & _netmask(bits, indexed_length)
+                result += self._networks[key].get(network, ())
+        if role is not None:
+            result = [hit for hit in result if hit[2] == role]
+        return result
+
+
+#--- QUERIES ------------------------------------------------------------------
+
+def _impact_values(attrib):
+    "return a function to get an attribute of all the impacts of an incident"
+    def values(incident):
+        return [getattr(impact, attrib) for assessment in incident.assessments
+            for impact in assessment.impacts]
+    return values
+
+
+def _time_values(attrib):
+    """
+    return a function to get a time attribute of an incident and of all its
+    event_data
+    """
+    def values(incident):
+        return [getattr(incident, attrib)] + [getattr(event_data, attrib)
+            for event_data in incident.event_data]
+    return values
+
+
+# functions to get the values of an incident, for each criterion of
+# IncidentQuery.select:
+_QUERY_VALUES = {
+    'purpose': lambda incident: (incident.purpose,),
+    'restriction': lambda incident: (incident.restriction,),
+    'impact_type': _impact_values('type'),
+    'severity': _impact_values('severity'),
+    'completion': _impact_values('completion'),
+    }
+
+_QUERY_TIMES = {
+    'report_time': lambda incident: (incident.report_time,),
+    'start_time': _time_values('start_time'),
+    'detect_time': _time_values('detect_time'),
+    }
+
+
+class IncidentQuery (object):
+    """
+    Query engine to select incidents matching some criteria, see select.
+
+    The values used by each criterion are only collected the first time it is
+    used, into a hash index (value -> positions of incidents) or a sorted
+    column of timestamps, so that following queries do not need to walk
+    through all incidents again.
+    The indexes are not updated when incidents are modified: a new
+    IncidentQuery object must be created in that case.
+    """
+
+    def __init__(self, source):
+        """
+        constructor for IncidentQuery class
+        - source: IODEF_Document object, or iterable of Incident objects
+        """
+        # IODEF_Document object, including compact classes:
+        source = getattr(source, 'incidents', source)
+        self.incidents = list(source)
+        # criterion -> {value: list of positions}
+        self._indexes = {}
+        # criterion -> (sorted list of timestamps, list of positions)
+        self._columns = {}
+        self._address_index = None
+        self._positions = None
+
+    def _index(self, name):
+        "return the hash index for a criterion of _QUERY_VALUES"
+        index = self._indexes.get(name, None)
+        if index is None:
+            index = self._indexes[name] = {}
+            get_values = _QUERY_VALUES[name]
+            for position, incident in enumerate(self.incidents):
+                for value in get_values(incident):
+                    positions = index.get(value, None)
+                    if positions is None:
+                        index[value] = [position]
+                    elif positions[-1] != position:
+                        positions.append(position)
+        return index
+
+    def _column(self, name):
+        "return the sorted column for a criterion of _QUERY_TIMES"
+        column = self._columns.get(name, None)
+        if column is None:
+            get_values = _QUERY_TIMES[name]
+            items = []
+            for position, incident in enumerate(self.incidents):
+                for value in get_values(incident):
+                    if value is None:
+                        continue
+                    try:
+                        items.append((_to_epoch(value), position))
+                    except ValueError:
+                        log.debug('ignoring invalid DateTime %r', value)
+            items.sort()
+            column = self._columns[name] = ([item[0] for item in items],
+                [item[1] for item in items])
+        return column
+
+    def _address_positions(self, query, role):
+        "return the set of positions of incidents involving an address"
+        if self._address_index is None:
+            self._address_index = AddressIndex(self.incidents)
+            self._positions = dict((id(incident), position)
+                for position, incident in enumerate(self.incidents))
+        return set(self._positions[id(hit[0])]
+            for hit in self._address_index.lookup(query, role=role))
+
+    def select(self, purpose=None, restriction=None, impact_type=None,
+        severity=None, completion=None, report_time=None, start_time=None,
+        detect_time=None, source=None, target=None):
+        """
+        return the list of incidents matching all the given criteria, in
+        their original order.
+        - purpose, restriction: value (or list of values) of the Incident
+          attribute
+        - impact_type, severity, completion: value (or list of values) of the
+          type/severity/completion attribute of one of the impacts of the
+          incident, in all assessments
+        - report_time: (start, end) time window, where start or end may be
+          None. Each bound is a DateTime string, a datetime object or a number
+          of seconds since the epoch.
+        - start_time, detect_time: time window for the attribute of the
+          incident or of one of its event_data
+        - source, target: IP address or network of a source/target system
+          (see AddressIndex.lookup)
+        """
+        selections = []
+        for name, value in (('purpose', purpose),
+            ('restriction', restriction), ('impact_type', impact_type),
+            ('severity', severity), ('completion', completion)):
+            if value is None:
+                continue
+            if isinstance(value, basestring):
+                value = (value,)
+            index = self._index(name)
+            positions = set()
+            for item in value:
+                positions.update(index.get(item, ()))
+            selections.append(positions)
+        for name, window in (('report_time', report_time),
+            ('start_time', start_time), ('detect_time', detect_time)):
+            if window is None:
+                continue
+            low, high = window
+            timestamps, positions = self._column(name)
+            i = 0
+            j = len(timestamps)
+            if low is not None:
+                i = bisect.bisect_left(timestamps, _to_epoch(low))
+            if high is not None:
+                j = bisect.bisect_right(timestamps, _to_epoch(high))
+            selections.append(set(positions[i:j]))
+        for role, query in (('source', source), ('target', target)):
+            if query is not None:
+                selections.append(self._address_positions(query, role))
+        if not selections:
+            return list(self.incidents)
+        # start with the smallest set:
+        selections.sort(key=len)
+        result = selections[0].intersection(*selections[1:])
+        return [self.incidents[position] for position in sorted(result)]
+
+
+#--- COLUMNS ------------------------------------------------------------------
+
+# value used for missing timestamps in columns (as NumPy's NaT):
+MISSING_TIME = -2**63
+
+# columns created by to_columns, with their NumPy type:
+# - dictionary-encoded strings: index in the list name+'_values', -1 if None
+_STRING_COLUMNS = ('id', 'id_name', 'purpose', 'restriction', 'impact_type',
+    'severity', 'completion', 'role', 'address', 'category')
+# - timestamps: number of seconds since the epoch, MISSING_TIME if None
+_TIME_COLUMNS = ('report_time', 'start_time', 'detect_time')
+_COLUMN_TYPES = {
+    'incident': 'int64',
+    'ip_version': 'int8',
+    'ipv4': 'int64',
+    'prefix_length': 'int16',
+    }
+for _name in _STRING_COLUMNS:
+    _COLUMN_TYPES[_name] = 'int32'
+for _name in _TIME_COLUMNS:
+    _COLUMN_TYPES[_name] = 'int64'
+
+
+class _ColumnBuilder (object):
+    """
+    helper class for to_columns and iter_columns: collect the rows of
+    incidents into lists, encoding strings with dictionaries.
+    """
+
+    def __init__(self):
+        self.incidents = 0
+        self.rows = 0
+        self.columns = dict((name, []) for name in _COLUMN_TYPES)
+        # for each string column: value -> code, and list of values
+        self.codes = dict((name, {None: -1}) for name in _STRING_COLUMNS)
+        self.values = dict((name, []) for name in _STRING_COLUMNS)
+        # (address, category) -> (ip_version, ipv4, prefix_length)
+        self.ips = {}
+
+    def code(self, name, value):
+        "return the code of a value for a string column"
+        codes = self.codes[name]
+        code = codes.get(value, None)
+        if code is None:
+            code = codes[value] = len(codes) - 1
+            self.values[name].append(value)
+        return code
+
+    def ip(self, address, category):
+        "return (ip_version, ipv4, prefix_length) for an address"
+        key = (address, category)
+        result = self.ips.get(key, None)
+        if result is None:
+            result = (0, -1, -1)
+            if address is not None and category in _IP_CATEGORIES:
+                try:
+                    bits, start, length = parse_ip_range(address, category)
+                    if bits == 32:
+                        result = (4, start, length)
+                    else:
+                        result = (6, -1, length)
+                except ValueError:
+                    pass
+            self.ips[key] = result
+        return result
+
+    def add(self, strings, times, systems):
+        """
+        add the rows of an incident:
+        - strings: values of id, id_name, purpose, restriction, impact_type,
+          severity, completion
+        - times: values of report_time, start_time, detect_time
+        - systems: list of (role, list of (address, category)) tuples
+        """
+        incident = self.incidents
+        self.incidents += 1
+        code = self.code
+        values = [incident]
+        values += [code(name, value)
+            for name, value in zip(_STRING_COLUMNS[:7], strings)]
+        for value in times:
+            if value is not None:
+                try:
+                    value = int(_to_epoch(value))
+                except ValueError:
+                    value = None
+            if value is None:
+                value = MISSING_TIME
+            values.append(value)
+        names = ('incident',) + _STRING_COLUMNS[:7] + _TIME_COLUMNS
+        incident_columns = [self.columns[name] for name in names]
+        rows = []
+        for role, addresses in systems or [(None, ())]:
+            role = code('role', role)
+            for address, category in addresses or [(None, None)]:
+                rows.append((role, code('address', address),
+                    code('category', category)) + self.ip(address, category))
+        for column, value in zip(incident_columns, values):
+            column.extend([value] * len(rows))
+        for name, column in zip(('role', 'address', 'category', 'ip_version',
+            'ipv4', 'prefix_length'), zip(*rows)):
+            self.columns[name].extend(column)
+        self.rows += len(rows)
+
+    def flush(self, use_numpy=None):
+        """
+        return the columns of the rows added since the last call, as a dict
+        of NumPy arrays (or lists). The list of values of each string column
+        is stored with the name column+'_values'.
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        result = {}
+        for name, column in self.columns.iteritems():
+            if use_numpy:
+                column = numpy.array(column, dtype=_COLUMN_TYPES[name])
+            result[name] = column
+            self.columns[name] = []
+        for name, values in self.values.iteritems():
+            result[name + '_values'] = list(values)
+        self.rows = 0
+        return result
+
+
+def _incident_values(incident):
+    "return (strings, times, systems) for _ColumnBuilder.add, from an Incident"
+    impact = incident.get_first_impact()
+    if impact is None:
+        impact_values = (None, None, None)
+    else:
+        impact_values = (impact.type, impact.severity, impact.completion)
+    strings = (incident.id, incident.id_name, incident.purpose,
+        incident.restriction) + impact_values
+    times = (incident.report_time, incident.start_time, incident.detect_time)
+    systems = []
+    for event_data in incident.event_data:
+        for flow in event_data.flows:
+            for system in flow.systems:
+                systems.append((system.category, [(address.address,
+                    address.category) for address in system.node_addresses]))
+    return strings, times, systems
+
+
+def _element_values(elem):
+    """
+    return (strings, times, systems) for _ColumnBuilder.add, directly from an
+    Incident XML element (same values as _incident_values)
+    """
+    incident_id = impact = None
+    times = {}
+    systems = []
+    for child in elem:
+        tag = child.tag
+        if tag == TAG_IncidentID:
+            if incident_id is None:
+                incident_id = child
+        elif tag in (TAG_ReportTime, TAG_StartTime, TAG_DetectTime):
+            times.setdefault(tag, child.text)
+        elif tag == TAG_Assessment:
+            if impact is None:
+                impact = child.find(TAG_Impact)
+        elif tag == TAG_EventData:
+            for flow in child.findall(TAG_Flow):
+                for system in flow.findall(TAG_System):
+                    addresses = []
+                    node = system.find(TAG_Node)
+                    if node is not None:
+                        addresses = [(address.text, address.get('category',
+                            None)) for address in node.findall(TAG_Address)]
+                    systems.append((system.get('category', None), addresses))
+    if impact is None:
+        impact_values = (None, None, None)
+    else:
+        impact_values = (impact.get('type', None),
+            impact.get('severity', None), impact.get('completion', None))
+    if incident_id is None:
+        id = id_name = None
+    else:
+        id = incident_id.text
+        id_name = incident_id.get('name', None)
+    strings = (id, id_name, elem.get('purpose', None),
+        elem.get('restriction', None)) + impact_values
+    times = (times.get(TAG_ReportTime, None), times.get(TAG_StartTime, None),
+        times.get(TAG_DetectTime, None))
+    return strings, times, systems
+
+
+def to_columns (source, use_numpy=None):
+    """
+    Flatten incidents into columns for analytics, with one row for each
+    (incident, system, address). An incident without system (or a system
+    without address) still has one row, with missing values.
+    return a dict of columns, which are NumPy arrays (or lists) of the same
+    length:
+    - incident: position of the incident in source
+    - id, id_name, purpose, restriction: Incident attributes
+    - impact_type, severity, completion: attributes of the first Impact (see
+      Incident.get_first_impact)
+    - report_time, start_time, detect_time: number of seconds since the epoch,
+      or MISSING_TIME
+    - role: category of the System, e.g. 'source' or 'target'
+    - address, category: Address attributes
+    - ip_version: 4 or 6 for IP addresses and networks, else 0
+    - ipv4: IPv4 address (or first address of the network) as an integer, -1
+      if not IPv4
+    - prefix_length: prefix length for IP addresses and networks, else -1
+    String columns are dictionary-encoded: each value is a code (-1 for None)
+    and the list of values is stored with the name column+'_values', e.g.
+    columns['severity_values'][columns['severity'][0]]
+    Parameters:
+    - source: IODEF_Document object, or iterable of Incident objects
+    - use_numpy: True for NumPy arrays, False for lists, None for NumPy
+      arrays if numpy is installed
+    """
+    # IODEF_Document object, including compact classes:
+    source = getattr(source, 'incidents', source)
+    builder = _ColumnBuilder()
+    for incident in source:
+        builder.add(*_incident_values(incident))
+    return builder.flush(use_numpy)
+
+
+def iter_columns (source, rows=100000, use_numpy=None, huge_tree=False):
+    """
+    Streaming variant of to_columns: parse an XML file incrementally and yield
+    a dict of columns each time about rows rows have been collected, without
+    creating Incident objects. Codes of string columns are consistent between
+    dicts (each list of values extends the previous one), so that columns can
+    be concatenated.
+    - source: filename or file object opened in binary mode
+    - huge_tree: if True, allow very large documents with lxml (see
+      get_parser)
+    (see to_columns for the columns)
+    """
+    builder = _ColumnBuilder()
+    root = None
+    for event, elem in _iterparse(source, huge_tree):
+        if event == 'start':
+            if root is None:
+                root = elem
+        elif elem.tag == TAG_Incident:
+            builder.add(*_element_values(elem))
+            _discard_element(elem, root)
+            if builder.rows >= rows:
+                yield builder.flush(use_numpy)
+    if builder.rows or not builder.incidents:
+        yield builder.flush(use_numpy)
+
+
+#--- FINGERPRINTS AND DIFF ----------------------------------------------------
+
+class FingerprintCache (object):
+    """
+    Cache of the fingerprints of mapper objects (see fingerprint), to compare
+    the same documents several times without computing them again.
+    Cached objects are kept in memory by the cache, and must not be modified:
+    after modifying an object, discard it (or the whole incident) from the
+    cache.
+    """
+
+    def __init__(self):
+        # {id(object): (digest, object)}, see _compile_fingerprint:
+        self._memo = {}
+
+    def __len__(self):
+        return len(self._memo)
+
+    def fingerprint(self, obj):
+        "return the fingerprint of obj, see fingerprint"
+        return obj._fingerprint(self._memo).encode('hex')
+
+    def discard(self, obj):
+        """
+        remove obj and all its subelement objects from the cache. Objects
+        containing obj (e.g. its IODEF_Document) must be discarded as well.
+        """
+        for item in _iter_objects(obj):
+            self._memo.pop(id(item), None)
+
+    def clear(self):
+        self._memo.clear()
+
+
+def _iter_objects(obj):
+    "yield obj and all its subelement objects (depth first)"
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        yield obj
+        for field in _iter_xml_fields(type(obj).xml_fields or ()):
+            if isinstance(field, XMLSubclassList):
+                stack.extend(getattr(obj, field.attrib))
+
+
+def fingerprint (obj, cache=None):
+    """
+    Return the structural fingerprint of a mapper object (IODEF_Document,
+    Incident, EventData, System, ...), as a hexadecimal string: two objects
+    have the same fingerprint if and only if their attributes and their
+    subelements are the same, independently of the XML backend, compact
+    classes or DateTime conversions (see datetime_class). The fingerprint of
+    an object is computed from the fingerprints of its subelements (Merkle
+    tree), so identical subtrees can be skipped when comparing documents.
+    - cache: optional FingerprintCache object
+    """
+    if cache is not None:
+        return cache.fingerprint(obj)
+    return obj._fingerprint({}).encode('hex')
+
+
+# change reported by diff:
+# - action: 'added', 'removed' or 'changed'
+# - kind: 'incident', 'system', 'address' or 'history_item'
+# - incident: key (id_name, id) of the incident
+# - key: key of the object in the incident: same as incident for an incident,
+#   (category, node names) for a system, (category, address) for an address,
+#   datetime for a history item
+# - old, new: old and new objects (None if added or removed)
+# - fields: names of the attributes which are different, for a change
+Change = namedtuple('Change', 'action kind incident key old new fields')
+
+
+def _system_key(system):
+    return (system.category, tuple(system.node_names))
+
+def _address_key(address):
+    return (address.category, address.address)
+
+def _history_key(item):
+    "key used to match history items: the instant of their datetime"
+    if item.datetime is None:
+        return None
+    return _canonical_datetime(item.datetime)
+
+def _history_datetime(item):
+    "key of a history item in Change tuples: its datetime as a string"
+    if item.datetime is None:
+        return None
+    return format_datetime(item.datetime)
+
+def _incident_systems(incident):
+    "return the list of all System objects of an incident"
+    systems = []
+    for event_data in incident.event_data:
+        for flow in event_data.flows:
+            systems.extend(flow.systems)
+    return systems
+
+
+def _changed_fields(old, new, memo):
+    """
+    return the names of the attributes of old and new (objects of the same
+    class, or variants) which are different.
+    """
+    fields = []
+    datetimes = frozenset(type(old).xml_datetimes)
+    for field in _iter_xml_fields(type(old).xml_fields):
+        name = field.attrib
+        old_value = getattr(old, name)
+        new_value = getattr(new, name)
+        if isinstance(field, XMLSubclassList):
+            changed = ([v._fingerprint(memo) for v in old_value] !=
+                [v._fingerprint(memo) for v in new_value])
+        elif name in datetimes:
+            changed = (_fingerprint_datetime(old_value) !=
+                _fingerprint_datetime(new_value))
+        elif isinstance(field, XMLTagList):
+            changed = list(old_value) != list(new_value)
+        else:
+            changed = _fingerprint_text(old_value) != _fingerprint_text(
+                new_value)
+        if changed:
+            fields.append(name)
+    return tuple(fields)
+
+
+def _match(old_items, new_items, memo, key):
+    """
+    match two lists of objects: objects with the same fingerprint are
+    unchanged, and remaining objects with the same key are changed.
+    return (removed, added, changed) lists, changed being (old, new) pairs.
+    """
+    unmatched = {}
+    for item in old_items:
+        unmatched.setdefault(item._fingerprint(memo), []).append(item)
+    added = []
+    for item in new_items:
+        items = unmatched.get(item._fingerprint(memo), None)
+        if items:
+            items.pop(0)
+        else:
+            added.append(item)
+    remaining = set()
+    for items in unmatched.itervalues():
+        remaining.update(id(item) for item in items)
+    removed = [item for item in old_items if id(item) in remaining]
+    if not removed or not added:
+        return removed, added, []
+    # pair remaining objects by key:
+    by_key = {}
+    for item in removed:
+        by_key.setdefault(key(item), []).append(item)
+    changed = []
+    paired = set()
+    still_added = []
+    for item in added:
+        items = by_key.get(key(item), None)
+        if items:
+            old = items.pop(0)
+            paired.add(id(old))
+            changed.append((old, item))
+        else:
+            still_added.append(item)
+    removed = [item for item in removed if id(item) not in paired]
+    return removed, still_added, changed
+
+
+def _diff_incident(old, new, incident_key, memo, changes):
+    "append the changes between two versions of an incident to changes"
+    changes.append(Change('changed', 'incident', incident_key, incident_key,
+        old, new, _changed_fields(old, new, memo)))
+    removed, added, changed = _match(_incident_systems(old),
+        _incident_systems(new), memo, _system_key)
+    for system in removed:
+        changes.append(Change('removed', 'system', incident_key,
+            _system_key(system), system, None, ()))
+    for system in added:
+        changes.append(Change('added', 'system', incident_key,
+            _system_key(system), None, system, ()))
+    for old_system, new_system in changed:
+        changes.append(Change('changed', 'system', incident_key,
+            _system_key(old_system), old_system, new_system,
+            _changed_fields(old_system, new_system, memo)))
+        removed_addresses, added_addresses, changed_addresses = _match(
+            old_system.node_addresses, new_system.node_addresses, memo,
+            _address_key)
+        for old_address, new_address in changed_addresses:
+            # (vlan or ext_category changed)
+            changes.append(Change('changed', 'address', incident_key,
+                _address_key(old_address), old_address, new_address,
+                _changed_fields(old_address, new_address, memo)))
+        for address in removed_addresses:
+            changes.append(Change('removed', 'address', incident_key,
+                _address_key(address), address, None, ()))
+        for address in added_addresses:
+            changes.append(Change('added', 'address', incident_key,
+                _address_key(address), None, address, ()))
+    removed, added, changed = _match(old.history, new.history, memo,
+        _history_key)
+    for item in removed:
+        changes.append(Change('removed', 'history_item', incident_key,
+            _history_datetime(item), item, None, ()))
+    for item in added:
+        changes.append(Change('added', 'history_item', incident_key,
+            _history_datetime(item), None, item, ()))
+    for old_item, new_item in changed:
+        changes.append(Change('changed', 'history_item', incident_key,
+            _history_datetime(old_item), old_item, new_item,
+            _changed_fields(old_item, new_item, memo)))
+
+
+def diff (old, new, cache=None):
+    """
+    Compare two IODEF documents (e.g. two revisions of a report), return the
+    list of changes as Change tuples (see Change), in the order of the
+    incidents of new then removed incidents:
+    - incidents are matched by (id_name, id), and reported as added, removed
+      or changed. For a changed incident, fields lists the attributes which
+      are different (e.g. 'end_time', 'event_data', 'history'), followed by
+      the systems, addresses and history items which were added, removed or
+      changed.
+    - systems are matched by category and node names, addresses by category
+      and address, history items by datetime
+    Incidents and subelements with the same fingerprint are skipped without
+    comparing their content (see fingerprint).
+    - old, new: IODEF_Document objects, or lists of Incident objects
+    - cache: optional FingerprintCache object, to compare the same documents
+      several times (e.g. a snapshot with each new revision)
+    """
+    if cache is not None:
+        memo = cache._memo
+    else:
+        memo = {}
+    old_incidents = getattr(old, 'incidents', old)
+    new_incidents = getattr(new, 'incidents', new)
+    # incidents with the same key are matched in order, incidents without id
+    # by position:
+    old_index = {}
+    for position, incident in enumerate(old_incidents):
+        key = _incident_key(incident) or (position,)
+        old_index.setdefault(key, []).append(incident)
+    changes = []
+    for position, incident in enumerate(new_incidents):
+        key = _incident_key(incident) or (position,)
+        old_list = old_index.get(key, None)
+        if not old_list:
+            changes.append(Change('added', 'incident', key, key, None,
+                incident, ()))
+            continue
+        old_incident = old_list.pop(0)
+        if old_incident is not incident and old_incident._fingerprint(memo) \
+            != incident._fingerprint(memo):
+            _diff_incident(old_incident, incident, key, memo, changes)
+    remaining = set()
+    for old_list in old_index.itervalues():
+        remaining.update(id(incident) for incident in old_list)
+    for position, incident in enumerate(old_incidents):
+        if id(incident) in remaining:
+            key = _incident_key(incident) or (position,)
+            changes.append(Change('removed', 'incident', key, key, incident,
+                None, ()))
+    return changes
+
+
+#--- MERGING ------------------------------------------------------------------
+
+def _incident_key(incident):
+    """
+    return the key used to merge incidents, (id_name, id), or None if the
+    incident has no id.
+    """
+    if incident.id is None:
+        return None
+    return (incident.id_name, incident.id)
+
+
+def _epoch_or_none(value):
+    "helper function to sort by DateTime: return a number of seconds or None"
+    if value is None:
+        return None
+    try:
+        return _to_epoch(value)
+    except ValueError:
+        return None
+
+
+def _union(existing, new, key=None):
+    """
+    return a list of the items of existing followed by the new items which are
+    not duplicates. key is a function returning the value compared to find
+    duplicates (default: the item itself).
+    """
+    if key is None:
+        seen = set(existing)
+    else:
+        seen = set(key(item) for item in existing)
+    result = list(existing)
+    for item in new:
+        value = item if key is None else key(item)
+        if value not in seen:
+            seen.add(value)
+            result.append(item)
+    return result
+
+
+# lists of objects sorted by a DateTime attribute when merged, see
+# _merge_union:
+_MERGE_SORTED = {'history': 'datetime'}
+
+def _merge_union(existing, new):
+    """
+    merge policy 'union' (see merge_documents): return a copy of existing,
+    completed with new. Attribute values of the incident with the latest
+    report_time take precedence, missing values are taken from the other one.
+    Lists are merged without duplicates: subelement objects (EventData,
+    HistoryItem, ...) are compared by fingerprint, and HistoryItems are sorted
+    by datetime.
+    """
+    merged = copy.copy(existing)
+    memo = {}
+    digest = lambda obj: obj._fingerprint(memo)
+    newer = _epoch_or_none(new.report_time) > _epoch_or_none(
+        existing.report_time)
+    for field in _iter_xml_fields(type(existing).xml_fields):
+        name = field.attrib
+        old_value = getattr(existing, name)
+        new_value = getattr(new, name)
+        if isinstance(field, XMLSubclassList):
+            value = _union(old_value, new_value, digest)
+            sort_attrib = _MERGE_SORTED.get(name, None)
+            if sort_attrib is not None:
+                value.sort(key=lambda item: _epoch_or_none(getattr(item,
+                    sort_attrib)))
+        elif isinstance(field, XMLTagList):
+            value = _union(old_value, new_value)
+        elif old_value is None or (newer and new_value is not None):
+            value = new_value
+        else:
+            continue
+        setattr(merged, name, value)
+    return merged
+
+
+# merge policies for merge_documents:
+MERGE_POLICIES = {
+    'union': _merge_union,
+    'first': lambda existing, new: existing,
+    'last': lambda existing, new: new,
+    }
+
+
+class _MergeIndex (object):
+    """
+    hash index of merged incidents, keyed by (id_name, id), in order of first
+    appearance. Incidents without id are kept as-is.
+    """
+
+    def __init__(self, merge):
+        self.merge = merge
+        self.incidents = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, incident, key):
+        if key is None:
+            # unique key for an incident without id:
+            key = (len(self.keys),)
+        existing = self.incidents.get(key, None)
+        if existing is None:
+            self.keys.append(key)
+            self.incidents[key] = incident
+        else:
+            self.incidents[key] = self.merge(existing, incident)
+
+    def pop_all(self):
+        "yield all (key, incident) in order, and empty the index"
+        incidents = self.incidents
+        keys = self.keys
+        self.incidents = {}
+        self.keys = []
+        for key in keys:
+            yield key, incidents.pop(key)
+
+
+class _SpillFiles (object):
+    """
+    temporary files storing pickled incidents, partitioned by hash of their
+    key so that each partition can be merged separately in memory.
+    """
+
+    def __init__(self, partitions, directory=None):
+        self.directory = tempfile.mkdtemp(prefix='iodeflib_merge_',
+            dir=directory)
+        self.files = []
+        for i in xrange(partitions):
+            self.files.append(open(os.path.join(self.directory, '%d.tmp' % i),
+                'w+b'))
+
+    def add(self, incident, key):
+        f = self.files[hash(key) % len(self.files)]
+        cPickle.dump(incident, f, 2)
+
+    def partitions(self):
+        "yield the list of incidents of each partition, in order of addition"
+        for f in self.files:
+            f.seek(0)
+            incidents = []
+            while True:
+                try:
+                    incidents.append(cPickle.load(f))
+                except EOFError:
+                    break
+            f.close()
+            yield incidents
+
+    def remove(self):
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _iter_source_incidents(sources, options):
+    """
+    yield the incidents of each source: IODEF_Document objects, or XML files
+    parsed incrementally by iter_incidents with options.
+    """
+    for source in sources:
+        incidents = getattr(source, 'incidents', None)
+        if incidents is None:
+            incidents = iter_incidents(source, **options)
+        for incident in incidents:
+            yield incident
+
+
+def iter_merged_incidents (sources, policy='union', max_incidents=None,
+    directory=None, partitions=64, **options):
+    """
+    Merge the incidents of several IODEF documents, yield the merged Incident
+    objects: incidents with the same id_name and id (IncidentID) are merged
+    into one, using a hash index. Incidents without id are not merged.
+    - sources: iterable of IODEF_Document objects, or filenames/file objects
+      of XML files which are parsed incrementally (see iter_incidents)
+    - policy: 'union' to merge the content of duplicate incidents (values of
+      the latest report_time take precedence, lists are merged without
+      duplicates: EventData and other subelements are compared by
+      fingerprint, and HistoryItems are sorted by datetime), 'first' or
+      'last' to keep the first or last one, or a function
+      merge(existing, new) returning the merged incident
+    - max_incidents: maximum number of incidents kept in memory. When there are
+      more, incidents are stored in temporary files in partitions (by hash of
+      their key) which are merged one at a time at the end, so that millions
+      of incidents can be merged with bounded memory (default: no limit)
+    - directory: where to create temporary files (default: system temp dir)
+    - partitions: number of temporary files, to be increased if a partition
+      does not fit in memory
+    - options: options for iter_incidents, such as compact or datetimes
+    Incidents are yielded in order of first appearance, except when temporary
+    files are used.
+    Objects of IODEF_Document sources are not modified, but may be yielded.
+    """
+    if isinstance(policy, basestring):
+        if policy not in MERGE_POLICIES:
+            raise ValueError('Unknown merge policy: %r' % policy)
+        policy = MERGE_POLICIES[policy]
+    index = _MergeIndex(policy)
+    spill = None
+    try:
+        for incident in _iter_source_incidents(sources, options):
+            key = _incident_key(incident)
+            if spill is not None:
+                spill.add(incident, key)
+                continue
+            index.add(incident, key)
+            if max_incidents is not None and len(index) > max_incidents:
+                # move the index to temporary files:
+                spill = _SpillFiles(partitions, directory)
+                for key, merged in index.pop_all():
+                    spill.add(merged, key)
+        if spill is None:
+            for key, merged in index.pop_all():
+                yield merged
+            return
+        for incidents in spill.partitions():
+            for incident in incidents:
+                index.add(incident, _incident_key(incident))
+            for key, merged in index.pop_all():
+                yield merged
+    finally:
+        if spill is not None:
+            spill.remove()
+
+
+def merge_documents (sources, policy='union', max_incidents=None,
+    directory=None, partitions=64, **options):
+    """
+    Merge several IODEF documents into a new IODEF_Document object, see
+    iter_merged_incidents for the parameters.
+    (to write millions of merged incidents without keeping them in memory,
+    use iter_merged_incidents)
+    """
+    document_class = _document_class(options.get('document_class', None),
+        options.get('compact', False))
+    return document_class(incidents=list(iter_merged_incidents(sources,
+        policy, max_incidents, directory, partitions, **options)))
+
+
+#--- SPLITTING ----------------------------------------------------------------
+
+def _shard_name(key):
+    "return a string usable in a filename for a shard key"
+    if key is None:
+        return 'none'
+    if not isinstance(key, basestring):
+        key = str(key)
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return re.sub(r'[^A-Za-z0-9._-]', '_', key) or '_'
+
+
+class _Shard (object):
+    """
+    shard file being written by split_file: an IODEF document with the root
+    attributes of the source document.
+    """
+
+    def __init__(self, filename, key, number, header, footer):
+        self.filename = filename
+        self.key = key
+        # number of the shard in split_file, used to choose its writer thread:
+        self.number = number
+        self.footer = footer
+        self.incidents = 0
+        self.size = len(header) + len(footer)
+        # the file is opened by the writer thread, with the header, and may
+        # be closed and opened again to append data (see _ShardWriters):
+        self.f = None
+        self.header = header
+        self.started = False
+
+
+# operations on shards for _ShardWriters, other than writing data:
+_SHARD_FINISH = 0
+_SHARD_SUSPEND = 1
+
+class _ShardWriters (object):
+    """
+    pool of threads writing shard files for split_file: the operations on a
+    shard are always sent to the same thread (chosen by shard number), so
+    that incidents are written in order. Queues are bounded to keep memory
+    usage bounded when the disk is slower than the parser. With workers=0,
+    files are written by the calling thread.
+    At most max_open shard files are open at once (plus one per thread while
+    operations are pending): the least recently used shard is suspended
+    (its file is closed, and opened again to append data when needed).
+    """
+
+    def __init__(self, workers, max_open=None, queue_size=64):
+        self.error = None
+        self.max_open = max_open
+        # shards which may have an open file, from least recently used:
+        self.active = OrderedDict()
+        # shards whose file is open, to close them after an error:
+        self.open_shards = set()
+        self.queues = []
+        self.threads = []
+        for i in xrange(workers):
+            queue = Queue.Queue(queue_size)
+            thread = threading.Thread(target=self._run, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    def _write(self, shard, data):
+        "write data to a shard, or finish or suspend it (see write)"
+        if data is _SHARD_SUSPEND:
+            if shard.f is not None:
+                self._close(shard)
+            return
+        if shard.f is None:
+            if shard.started:
+                shard.f = open(shard.filename, 'ab')
+            else:
+                shard.f = open(shard.filename, 'wb')
+                shard.f.write(shard.header)
+                shard.started = True
+            self.open_shards.add(shard)
+        if data is _SHARD_FINISH:
+            shard.f.write(shard.footer)
+            self._close(shard)
+        else:
+            shard.f.write(data)
+
+    def _close(self, shard):
+        self.open_shards.discard(shard)
+        f = shard.f
+        shard.f = None
+        f.close()
+
+    def _run(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            if self.error is None:
+                try:
+                    self._write(*task)
+                except Exception:
+                    self.error = sys.exc_info()
+
+    def _check(self):
+        "raise the first exception of a writer thread"
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _send(self, shard, data):
+        if not self.queues:
+            self._write(shard, data)
+        else:
+            self.queues[shard.number % len(self.queues)].put((shard, data))
+
+    def write(self, shard, data):
+        """
+        write data to a shard (opened and started if needed), or finish it if
+        data is _SHARD_FINISH
+        """
+        self._check()
+        active = self.active
+        if shard.number in active:
+            # most recently used:
+            del active[shard.number]
+        elif self.max_open is not None and len(active) >= self.max_open:
+            number, old_shard = active.popitem(last=False)
+            self._send(old_shard, _SHARD_SUSPEND)
+        if data is not _SHARD_FINISH:
+            active[shard.number] = shard
+        self._send(shard, data)
+
+    def join(self, check=True):
+        """
+        wait until all operations are done, and close the files of shards
+        which were not finished. If check is True, raise the first exception
+        of a writer thread.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for shard in list(self.open_shards):
+            self._close(shard)
+        if check:
+            self._check()
+
+
+def split_file (source, dest_pattern, max_incidents=None, max_bytes=None,
+    key=None, workers=4, max_open=64, huge_tree=False):
+    """
+    Split an IODEF document into several smaller documents (shards), reading
+    the source incrementally: memory usage does not depend on the size of the
+    document. Each shard is a complete IODEF document, with the root
+    attributes of the source document (lang, version, ...). The Incident
+    elements are copied without being converted to objects.
+    Return the list of shard filenames, in the order they were created.
+    - source: filename or file object opened in binary mode
+    - dest_pattern: filename pattern of the shards, with %(index)d for the
+      number of the shard (starting from 0 for each key), and %(key)s for
+      the key if key is used, e.g. 'out/%(key)s-%(index)04d.xml'.
+    - max_incidents: maximum number of incidents per shard, or None
+    - max_bytes: maximum size of a shard in bytes, or None. (a shard may be
+      larger if it contains a single incident larger than max_bytes)
+    - key: function called with each Incident object (see lazy_class) and
+      returning the key of its shard, e.g. lambda incident: incident.id_name
+      (key values are converted to strings usable in filenames)
+    - workers: number of threads writing shards in parallel, or 0 to write
+      them in the calling thread
+    - max_open: maximum number of shard files open at once, when splitting by
+      key (files of other keys are closed, and opened again when needed), or
+      None for no limit
+    - huge_tree: see get_parser
+    """
+    if key is not None and '%(key)' not in dest_pattern:
+        raise ValueError('dest_pattern must contain %(key)s to split by key')
+    if (max_incidents or max_bytes) and '%(index)' not in dest_pattern:
+        raise ValueError('dest_pattern must contain %(index)d to split by '
+            'size')
+    if key is not None:
+        IncidentClass = lazy_class(Incident)
+    filenames = []
+    # current shard for each key, and number of shards created:
+    shards = {}
+    counts = {}
+    writers = _ShardWriters(workers, max_open)
+    namespaces = {NS_URI: '', XSI_URI: 'xsi'}
+    header = footer = None
+    root = None
+    events = _iterparse(source, huge_tree)
+    finished = False
+    try:
+        for event, elem in events:
+            if event == 'start':
+                if root is None:
+                    root = elem
+                    _check_root(root)
+                    # shard root with the attributes of the source root:
+                    shard_root = ET.Element(TAG_IODEF_Document,
+                        OrderedDict(root.items()))
+                    f = cStringIO.StringIO()
+                    writer = _XMLWriter(f)
+                    writer.write_declaration()
+                    footer = writer.start(shard_root, dict(namespaces))
+                    header = f.getvalue()
+                continue
+            if elem.tag != TAG_Incident:
+                continue
+            if key is not None:
+                shard_key = _shard_name(key(IncidentClass(from_xml=elem)))
+            else:
+                shard_key = ''
+            if LXML:
+                data = ET.tostring(elem, with_tail=False)
+            else:
+                f = cStringIO.StringIO()
+                _XMLWriter(f).write(elem, namespaces)
+                data = f.getvalue()
+            _discard_element(elem, root)
+            shard = shards.get(shard_key, None)
+            if shard is not None and ((max_incidents and
+                shard.incidents >= max_incidents) or (max_bytes and
+                shard.size + len(data) > max_bytes)):
+                writers.write(shard, _SHARD_FINISH)
+                shard = None
+            if shard is None:
+                index = counts.get(shard_key, 0)
+                counts[shard_key] = index + 1
+                filename = dest_pattern % dict(index=index, key=shard_key)
+                shard = _Shard(filename, shard_key, len(filenames), header,
+                    footer)
+                shards[shard_key] = shard
+                filenames.append(filename)
+                log.debug('writing shard %s', filename)
+            shard.incidents += 1
+            shard.size += len(data)
+            writers.write(shard, data)
+        for shard in shards.itervalues():
+            writers.write(shard, _SHARD_FINISH)
+        finished = True
+    finally:
+        # errors of writer threads are only raised if there is no other
+        # exception, which would be hidden:
+        writers.join(check=finished)
+    return filenames
 
 
 #=== MAIN =====================================================================
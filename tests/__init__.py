@@ -0,0 +1,27 @@
+"""
+iodeflib tests
+
+usage, from the root of the source tree:
+    python -m unittest discover -s tests -t .
+
+Set the environment variable IODEFLIB_TEST_BACKEND=etree to run the tests
+with ElementTree instead of lxml.
+"""
+
+import sys, os
+
+if os.environ.get('IODEFLIB_TEST_BACKEND') == 'etree':
+    # hide lxml, so that iodeflib falls back to ElementTree:
+    sys.modules['lxml'] = None
+
+# sample IODEF document from RFC 5070:
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'iodeflib', 'examples', 'iodef.xml')
+
+def sample_data():
+    "return the content of the sample IODEF document"
+    f = open(SAMPLE_FILE, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
@@ -0,0 +1,117 @@
+"""
+tests for ParseCache and binary snapshots
+"""
+
+import unittest, os, tempfile, shutil
+
+import iodeflib
+from tests import sample_data
+
+
+class ParseCacheTest (unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = []
+        for i in xrange(5):
+            filename = os.path.join(self.directory, 'iodef%d.xml' % i)
+            iodef = iodeflib.parse(sample_data())
+            iodef.incidents[0].id = str(i)
+            iodef.write(filename)
+            self.files.append(filename)
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        os.mkdir(self.cache_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory(self):
+        cache = iodeflib.ParseCache(max_entries=2)
+        for filename in self.files[:3]:
+            cache.parse_file(filename)
+        self.assertEqual(len(cache), 2)
+        iodef = iodeflib.parse_file(self.files[2], cache=cache)
+        self.assertEqual(iodef.incidents[0].id, '2')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_content_hash(self):
+        cache = iodeflib.ParseCache(content_hash=True)
+        cache.parse_file(self.files[0])
+        cache.parse_file(self.files[0])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_directory(self):
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        iodef = cache.parse_file(self.files[0], compact=True)
+        other = iodeflib.ParseCache(directory=self.cache_directory)
+        loaded = other.parse_file(self.files[0], compact=True)
+        self.assertEqual(other.stats()['disk_hits'], 1)
+        self.assertEqual(iodeflib.fingerprint(loaded),
+            iodeflib.fingerprint(iodef))
+
+    def test_directory_size(self):
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        cache.parse_file(self.files[0])
+        size = sum(os.path.getsize(os.path.join(self.cache_directory, name))
+            for name in os.listdir(self.cache_directory))
+        # room for two snapshots:
+        cache = iodeflib.ParseCache(directory=self.cache_directory,
+            max_disk_bytes=size * 2)
+        for filename in self.files:
+            cache.parse_file(filename)
+        self.assertEqual(len(os.listdir(self.cache_directory)), 2)
+
+    def corrupt(self):
+        for name in os.listdir(self.cache_directory):
+            f = open(os.path.join(self.cache_directory, name), 'r+b')
+            f.seek(20)
+            f.truncate()
+            f.close()
+
+    def test_corrupted(self):
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        cache.parse_file(self.files[0])
+        self.corrupt()
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        iodef = cache.parse_file(self.files[0])
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(iodef.incidents[0].id, '0')
+
+    def test_errors_not_hidden(self):
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        cache.parse_file(self.files[0])
+        load_binary = iodeflib.IODEF_Document.load_binary
+        def broken(cls, source):
+            raise KeyError('bug')
+        iodeflib.IODEF_Document.load_binary = classmethod(broken)
+        try:
+            cache = iodeflib.ParseCache(directory=self.cache_directory)
+            self.assertRaises(KeyError, cache.parse_file, self.files[0])
+        finally:
+            iodeflib.IODEF_Document.load_binary = load_binary
+
+    def test_replace(self):
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        cache.parse_file(self.files[0])
+        self.corrupt()
+        # os.rename fails if the destination exists on Windows:
+        rename = os.rename
+        def windows_rename(source, destination):
+            if os.path.exists(destination):
+                raise OSError(17, 'File exists')
+            rename(source, destination)
+        os.rename = windows_rename
+        try:
+            cache = iodeflib.ParseCache(directory=self.cache_directory)
+            cache.parse_file(self.files[0])
+        finally:
+            os.rename = rename
+        self.assertEqual(len(os.listdir(self.cache_directory)), 1)
+        cache = iodeflib.ParseCache(directory=self.cache_directory)
+        iodef = cache.parse_file(self.files[0])
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        self.assertEqual(iodef.incidents[0].id, '0')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+tests for fingerprint, diff and merge_documents
+"""
+
+import unittest, copy
+
+import iodeflib
+from tests import sample_data
+
+# fingerprint of the sample document, with all backends and classes:
+SAMPLE_FINGERPRINT = 'f875105197959c23fa5c11298cbc5fdedcec41c8'
+
+
+def with_timezone(data):
+    "return the sample document with the same DateTimes in other timezones"
+    return data.replace('2001-09-13T23:19:24+00:00', '2001-09-13T23:19:24Z'
+        ).replace('2001-09-14T08:19:01+00:00', '2001-09-14T10:19:01+02:00')
+
+
+class FingerprintTest (unittest.TestCase):
+
+    def test_options(self):
+        data = sample_data()
+        for options in ({}, {'compact': True}, {'lazy': True},
+            {'datetimes': 'datetime'}, {'datetimes': 'epoch'},
+            {'editable': True}, {'compact': True, 'datetimes': 'epoch'}):
+            iodef = iodeflib.parse(data, **options)
+            self.assertEqual(iodeflib.fingerprint(iodef), SAMPLE_FINGERPRINT)
+
+    def test_timezones(self):
+        data = with_timezone(sample_data())
+        self.assertNotEqual(data, sample_data())
+        iodef = iodeflib.parse(data)
+        self.assertEqual(iodeflib.fingerprint(iodef), SAMPLE_FINGERPRINT)
+
+    def test_changes(self):
+        iodef = iodeflib.parse(sample_data())
+        iodef.incidents[0].history[0].action = 'nothing'
+        self.assertNotEqual(iodeflib.fingerprint(iodef), SAMPLE_FINGERPRINT)
+        iodef = iodeflib.parse(sample_data())
+        # one second later:
+        iodef.incidents[0].report_time = '2001-09-13T23:19:25+00:00'
+        self.assertNotEqual(iodeflib.fingerprint(iodef), SAMPLE_FINGERPRINT)
+        # same instant with another offset:
+        iodef.incidents[0].report_time = '2001-09-14T01:19:24+02:00'
+        self.assertEqual(iodeflib.fingerprint(iodef), SAMPLE_FINGERPRINT)
+
+    def test_cache(self):
+        iodef = iodeflib.parse(sample_data())
+        cache = iodeflib.FingerprintCache()
+        self.assertEqual(cache.fingerprint(iodef), SAMPLE_FINGERPRINT)
+        self.assertTrue(len(cache) > 1)
+        incident = iodef.incidents[0]
+        cache.discard(iodef)
+        self.assertEqual(len(cache), 0)
+        cache.fingerprint(incident)
+        incident.descriptions.append('changed')
+        cache.discard(incident)
+        self.assertNotEqual(iodeflib.fingerprint(iodef, cache),
+            SAMPLE_FINGERPRINT)
+
+
+class DiffTest (unittest.TestCase):
+
+    def test_equal(self):
+        old = iodeflib.parse(sample_data())
+        new = iodeflib.parse(with_timezone(sample_data()),
+            datetimes='datetime')
+        self.assertEqual(iodeflib.diff(old, new), [])
+
+    def test_changes(self):
+        old = iodeflib.parse(sample_data())
+        new = iodeflib.parse(sample_data())
+        incident = new.incidents[0]
+        key = (incident.id_name, incident.id)
+        incident.end_time = '2013-01-01T00:00:00+00:00'
+        incident.get_sources()[0].node_addresses.append(
+            iodeflib.Address(address='192.0.2.99'))
+        incident.history.append(iodeflib.HistoryItem(action='nothing',
+            datetime='2013-01-01T00:00:00Z'))
+        new.incidents.append(iodeflib.Incident(id='1', id_name='new'))
+        removed = new.incidents.pop(1)
+        changes = iodeflib.diff(old, new)
+        summary = [(c.action, c.kind, c.key) for c in changes]
+        self.assertEqual(summary, [
+            ('changed', 'incident', key),
+            ('changed', 'system', ('source', ())),
+            ('added', 'address', ('ipv4-addr', '192.0.2.99')),
+            ('added', 'history_item', '2013-01-01T00:00:00Z'),
+            ('added', 'incident', ('new', '1')),
+            ('removed', 'incident', (removed.id_name, removed.id)),
+            ])
+        self.assertEqual(changes[0].fields, ('end_time', 'event_data',
+            'history'))
+
+
+class MergeTest (unittest.TestCase):
+
+    def test_duplicates(self):
+        # the same incidents, with DateTimes in other timezones:
+        documents = [iodeflib.parse(sample_data()),
+            iodeflib.parse(with_timezone(sample_data()))]
+        merged = iodeflib.merge_documents(documents)
+        expected = iodeflib.merge_documents(documents[:1])
+        self.assertEqual([iodeflib.fingerprint(incident)
+            for incident in merged.incidents], [iodeflib.fingerprint(incident)
+            for incident in expected.incidents])
+
+    def test_union(self):
+        old = iodeflib.parse(sample_data())
+        new = iodeflib.parse(sample_data())
+        new.incidents[0].history.append(iodeflib.HistoryItem(action='nothing',
+            datetime='2013-01-01T00:00:00+00:00'))
+        merged = iodeflib.merge_documents([old, new])
+        self.assertEqual(len(merged.incidents[0].history),
+            len(old.incidents[0].history) + 1)
+        # the sources are not modified:
+        self.assertEqual(iodeflib.fingerprint(old), SAMPLE_FINGERPRINT)
+
+    def test_spill(self):
+        documents = [iodeflib.parse(sample_data()) for i in xrange(3)]
+        for i, iodef in enumerate(documents):
+            for incident in iodef.incidents:
+                incident.id += '-%d' % i
+        documents.append(iodeflib.parse(sample_data()))
+        expected = iodeflib.merge_documents(documents)
+        merged = iodeflib.merge_documents(documents, max_incidents=2,
+            partitions=3)
+        self.assertEqual(sorted(iodeflib.fingerprint(incident)
+            for incident in merged.incidents), sorted(
+            iodeflib.fingerprint(incident) for incident in expected.incidents))
+
+
+if __name__ == '__main__':
+    unittest.main()
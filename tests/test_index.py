@@ -0,0 +1,66 @@
+"""
+tests for parse_ip_range and AddressIndex
+"""
+
+import unittest
+
+import iodeflib
+from tests import sample_data
+
+
+class ParseIPRangeTest (unittest.TestCase):
+
+    def test_ipv4(self):
+        self.assertEqual(iodeflib.parse_ip_range('10.2.3.4'),
+            (32, 0x0A020304, 32))
+        self.assertEqual(iodeflib.parse_ip_range('10.2.3.4/16'),
+            (32, 0x0A020000, 16))
+        self.assertEqual(iodeflib.parse_ip_range('10.2.0.0/255.255.0.0'),
+            (32, 0x0A020000, 16))
+
+    def test_ipv6(self):
+        self.assertEqual(iodeflib.parse_ip_range('2001:db8::/32'),
+            (128, 0x20010DB8 << 96, 32))
+        self.assertEqual(iodeflib.parse_ip_range('::1'), (128, 1, 128))
+        self.assertEqual(iodeflib.parse_ip_range('::ffff:10.0.0.1'),
+            (128, 0xFFFF0A000001, 128))
+
+    def test_invalid(self):
+        for text in ('0x10::', '1::+1', '1:: 2', '12345::', '1:2:3:4:5:6:7:8:9',
+            '1::2::3', '10.0.0.256', '10.0.0', '10.0.0.+1', '10.0.0. 1',
+            '10.0.0.1/33', '10.0.0.0/255.0.255.0'):
+            self.assertRaises(ValueError, iodeflib.parse_ip_range, text)
+
+
+class AddressIndexTest (unittest.TestCase):
+
+    def setUp(self):
+        self.iodef = iodeflib.parse(sample_data())
+        self.index = iodeflib.AddressIndex(self.iodef)
+
+    def test_address(self):
+        hits = self.index.lookup('192.0.2.200')
+        self.assertEqual(len(hits), 2)
+        self.assertEqual(set(role for incident, system, role in hits),
+            set(['source']))
+
+    def test_containing(self):
+        # 192.0.2.20 is within the indexed network 192.0.2.16/28:
+        hits = self.index.lookup('192.0.2.20')
+        networks = [system for incident, system, role in hits
+            if system.node_addresses[0].address == '192.0.2.16/28']
+        self.assertTrue(networks)
+        hits = self.index.lookup('192.0.2.20', containing=False)
+        self.assertEqual(len(hits), 1)
+
+    def test_network(self):
+        hits = self.index.lookup('192.0.2.192/26', role='source',
+            containing=False)
+        addresses = set(address.address for incident, system, role in hits
+            for address in system.node_addresses)
+        self.assertEqual(addresses, set(['192.0.2.200', '192.0.2.240',
+            '192.0.2.241']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+tests for instrumentation: enable_instrumentation, get_stats, ...
+"""
+
+import unittest, StringIO
+
+import iodeflib
+from tests import sample_data
+
+
+class InstrumentationTest (unittest.TestCase):
+
+    def setUp(self):
+        iodeflib.reset_stats()
+
+    def tearDown(self):
+        iodeflib.disable_instrumentation()
+        iodeflib.reset_stats()
+
+    def test_stats(self):
+        data = sample_data()
+        iodeflib.parse(data)
+        self.assertEqual(iodeflib.get_stats()['operations'], {})
+        iodeflib.enable_instrumentation()
+        self.assertTrue(iodeflib.get_stats()['enabled'])
+        iodef = iodeflib.parse(data)
+        iodeflib.parse(data)
+        result = iodef.to_xml_str()
+        iodef.write(StringIO.StringIO())
+        stats = iodeflib.get_stats()
+        operations = stats['operations']
+        self.assertEqual(operations['parse']['calls'], 2)
+        self.assertEqual(operations['parse']['bytes'], 2 * len(data))
+        self.assertEqual(operations['to_xml_str']['calls'], 1)
+        self.assertEqual(operations['to_xml_str']['bytes'], len(result))
+        self.assertEqual(operations['write']['calls'], 1)
+        incident = stats['classes']['Incident']
+        self.assertEqual(incident['objects'], 2 * len(iodef.incidents))
+        self.assertEqual(incident['to_xml_calls'], 2 * len(iodef.incidents))
+        iodeflib.reset_stats()
+        self.assertEqual(iodeflib.get_stats()['operations'], {})
+
+    def test_hook(self):
+        calls = []
+        def hook(name, seconds, size):
+            calls.append((name, size))
+        data = sample_data()
+        iodeflib.enable_instrumentation(hook)
+        iodef = iodeflib.parse(data)
+        result = iodef.to_xml_str()
+        self.assertEqual(calls, [('parse', len(data)),
+            ('to_xml_str', len(result))])
+        iodeflib.disable_instrumentation()
+        iodeflib.parse(data)
+        self.assertEqual(len(calls), 2)
+
+    def test_disable(self):
+        iodef = iodeflib.parse(sample_data())
+        methods = [(cls, name, cls.__dict__[name])
+            for cls in (iodeflib.Incident, iodeflib.HistoryItem)
+            for name in ('from_xml', 'to_xml')]
+        iodeflib.enable_instrumentation()
+        for cls, name, method in methods:
+            self.assertTrue(cls.__dict__[name] is not method)
+        iodeflib.disable_instrumentation()
+        self.assertFalse(iodeflib.get_stats()['enabled'])
+        for cls, name, method in methods:
+            self.assertTrue(cls.__dict__[name] is method)
+        iodeflib.parse(sample_data()).to_xml_str()
+        stats = iodeflib.get_stats()
+        self.assertEqual(stats['operations'], {})
+        self.assertEqual(stats['classes']['Incident']['objects'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
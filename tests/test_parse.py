@@ -0,0 +1,81 @@
+"""
+tests for parsing options: projection, lazy and compact classes, ...
+"""
+
+import unittest, datetime
+
+import iodeflib
+from tests import sample_data
+
+
+class ProjectionTest (unittest.TestCase):
+
+    def test_skipped_attributes_are_none(self):
+        # constructor defaults such as purpose='reporting' must not be
+        # reported for attributes which were not parsed:
+        for options in ({}, {'lazy': True}, {'compact': True},
+            {'editable': True}):
+            iodef = iodeflib.parse(sample_data(), fields=['id', 'report_time'],
+                **options)
+            incident = iodef.incidents[0]
+            self.assertEqual(incident.id, '189493')
+            self.assertEqual(incident.report_time, '2001-09-13T23:19:24+00:00')
+            self.assertEqual(incident.purpose, None)
+            self.assertEqual(incident.history, [])
+
+    def test_parsed_attributes(self):
+        iodef = iodeflib.parse(sample_data(), fields=['purpose'])
+        self.assertEqual(iodef.incidents[0].purpose, 'reporting')
+        self.assertEqual(iodef.incidents[0].id, None)
+
+
+class DateTimeTest (unittest.TestCase):
+
+    def parse(self, report_time, datetimes):
+        "return the report_time of the first incident, parsed as a DateTime"
+        data = sample_data().replace('2001-09-13T23:19:24+00:00', report_time)
+        iodef = iodeflib.parse(data, datetimes=datetimes)
+        return iodef.incidents[0].report_time
+
+    def test_fraction(self):
+        value = iodeflib.parse_datetime('2001-09-13T23:19:24.25+00:00')
+        self.assertEqual(value.microsecond, 250000)
+        value = iodeflib.parse_datetime('2001-09-13T23:19:24.1234567Z')
+        self.assertEqual(value.microsecond, 123457)
+        value = iodeflib.parse_datetime('2001-09-13T23:19:24.9999999Z')
+        self.assertEqual((value.second, value.microsecond), (24, 999999))
+        self.assertEqual(self.parse('2001-09-13T23:19:24.25+00:00', 'epoch'),
+            1000423164.25)
+
+    def test_timezone(self):
+        utc = iodeflib.parse_datetime('2001-09-13T23:19:24+00:00')
+        self.assertEqual(utc.utcoffset(), datetime.timedelta(0))
+        for text in ('2001-09-13T23:19:24Z', '2001-09-13t23:19:24z',
+            '2001-09-14T01:19:24+02:00', '2001-09-13T18:49:24-04:30'):
+            value = iodeflib.parse_datetime(text)
+            self.assertEqual(value, utc)
+            self.assertEqual(self.parse(text, 'epoch'), 1000423164)
+        value = iodeflib.parse_datetime('2001-09-13T18:49:24-04:30')
+        self.assertEqual(value.utcoffset(), -datetime.timedelta(hours=4.5))
+        self.assertEqual(value.isoformat(), '2001-09-13T18:49:24-04:30')
+
+    def test_no_timezone(self):
+        value = iodeflib.parse_datetime('2001-09-13T23:19:24')
+        self.assertEqual(value, datetime.datetime(2001, 9, 13, 23, 19, 24))
+        self.assertEqual(value.tzinfo, None)
+        # assumed to be UTC:
+        self.assertEqual(self.parse('2001-09-13T23:19:24', 'epoch'),
+            1000423164)
+
+    def test_invalid(self):
+        for text in ('yesterday', '2001-09-13', '2001-09-13 23:19:24Z',
+            '2001-09-13T23:19:24.Z', '2001-09-13T23:19:24+0000',
+            '2001-09-13T23:19:24 UTC', '2001-13-13T23:19:24Z'):
+            self.assertRaises(ValueError, iodeflib.parse_datetime, text)
+            # kept as-is when parsing a document:
+            for datetimes in ('datetime', 'epoch'):
+                self.assertEqual(self.parse(text, datetimes), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
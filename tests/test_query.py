@@ -0,0 +1,119 @@
+"""
+tests for queries (IncidentQuery, IODEF_Document.select), columns and
+validation
+"""
+
+import unittest, StringIO
+
+import iodeflib
+from tests import sample_data, SAMPLE_FILE
+
+
+class QueryTest (unittest.TestCase):
+
+    def setUp(self):
+        self.iodef = iodeflib.parse(sample_data())
+
+    def test_select(self):
+        incidents = self.iodef.incidents
+        self.assertEqual(self.iodef.select(), incidents)
+        self.assertEqual(self.iodef.select(purpose='reporting'), [incident
+            for incident in incidents if incident.purpose == 'reporting'])
+        selected = self.iodef.select(source='192.0.2.200')
+        self.assertEqual(len(selected), 2)
+        self.assertEqual(self.iodef.select(source='192.0.2.200',
+            purpose='nothing'), [])
+
+    def test_select_modified(self):
+        self.assertEqual(len(self.iodef.select(purpose='reporting')), 3)
+        incident = iodeflib.Incident(id='z', purpose='other')
+        self.iodef.incidents[1] = incident
+        self.assertEqual(self.iodef.select(purpose='other'), [incident])
+        self.assertEqual(len(self.iodef.select(purpose='reporting')), 2)
+        self.iodef.incidents[0].purpose = 'mitigation'
+        self.assertEqual(self.iodef.select(purpose='mitigation'),
+            [self.iodef.incidents[0], self.iodef.incidents[2]])
+        self.assertEqual(self.iodef.select(purpose='reporting'),
+            [self.iodef.incidents[3]])
+
+    def test_time_window(self):
+        query = iodeflib.IncidentQuery(self.iodef)
+        self.assertEqual(query.select(report_time=('2001-09-13T23:19:24Z',
+            '2001-09-13T23:19:24Z')), [self.iodef.incidents[0]])
+        self.assertEqual(query.select(report_time=(None, 0)), [])
+
+
+class ColumnsTest (unittest.TestCase):
+
+    def test_columns(self):
+        iodef = iodeflib.parse(sample_data())
+        for use_numpy in (False, None):
+            columns = iodeflib.to_columns(iodef, use_numpy=use_numpy)
+            rows = len(columns['incident'])
+            self.assertTrue(rows >= len(iodef.incidents))
+            for name in ('id', 'role', 'address', 'ipv4'):
+                self.assertEqual(len(columns[name]), rows)
+            addresses = [columns['address_values'][code]
+                for code in columns['address'] if code >= 0]
+            self.assertTrue('192.0.2.200' in addresses)
+
+    def test_iter_columns(self):
+        columns = iodeflib.to_columns(iodeflib.parse(sample_data()),
+            use_numpy=False)
+        addresses = []
+        for chunk in iodeflib.iter_columns(SAMPLE_FILE, rows=3,
+            use_numpy=False):
+            addresses += [chunk['address_values'][code]
+                for code in chunk['address'] if code >= 0]
+        self.assertEqual(addresses, [columns['address_values'][code]
+            for code in columns['address'] if code >= 0])
+
+
+class ValidationTest (unittest.TestCase):
+
+    def test_valid(self):
+        iodef = iodeflib.parse(sample_data(), validate='structure')
+        iodeflib.parse(iodef.to_xml_str(validate='structure'))
+
+    def test_invalid(self):
+        data = sample_data().replace('version="1.00"', 'version="2.00"')
+        self.assertRaises(iodeflib.ValidationError, iodeflib.parse, data,
+            validate='structure')
+        iodef = iodeflib.IODEF_Document()
+        self.assertRaises(iodeflib.ValidationError, iodef.write,
+            StringIO.StringIO(), validate='structure')
+
+    def test_schema(self):
+        if not iodeflib.LXML:
+            self.assertRaises(ImportError, iodeflib.get_schema)
+            return
+        iodeflib.parse(sample_data(), validate='schema')
+        iodef = iodeflib.parse(sample_data())
+        iodef.incidents[0].purpose = 'invalid'
+        try:
+            iodef.to_xml_str(validate='schema')
+        except iodeflib.ValidationError, exc:
+            self.assertTrue(exc.errors)
+        else:
+            self.fail('ValidationError not raised')
+
+    def test_schema_round_trip(self):
+        if not iodeflib.LXML:
+            return
+        for options in ({}, {'compact': True}, {'lazy': True},
+            {'editable': True}):
+            iodef = iodeflib.parse_file(SAMPLE_FILE, **options)
+            self.assertEqual(iodef.incidents[0].contacts[0].emails,
+                ['contact@csirt.example.com'])
+            iodeflib.parse(iodef.to_xml_str(validate='schema'),
+                validate='schema')
+            iodef.write(StringIO.StringIO(), validate='schema')
+            # modified incidents are serialized by to_xml:
+            for incident in iodef.incidents:
+                incident.descriptions.append('modified')
+            iodeflib.parse(iodef.to_xml_str(validate='schema'),
+                validate='schema')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+round-trip tests: parsing with each option, then serializing with each
+format must give the same document
+"""
+
+import unittest, os, tempfile, shutil, StringIO, cPickle
+
+import iodeflib
+from tests import sample_data
+
+# combinations of parsing options:
+OPTIONS = (
+    {},
+    {'compact': True},
+    {'lazy': True},
+    {'compact': True, 'lazy': True},
+    {'datetimes': 'datetime'},
+    {'datetimes': 'epoch'},
+    {'compact': True, 'datetimes': 'epoch'},
+    {'lazy': True, 'datetimes': 'datetime'},
+    {'editable': True},
+    {'editable': True, 'compact': True},
+    {'huge_tree': True},
+    {'validate': 'structure'},
+    )
+
+
+class RoundTripTest (unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.expected = iodeflib.fingerprint(iodeflib.parse(sample_data()))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, iodef, options):
+        self.assertEqual(iodeflib.fingerprint(iodef), self.expected,
+            'options: %r' % (options,))
+
+    def test_to_xml_str(self):
+        for options in OPTIONS:
+            iodef = iodeflib.parse(sample_data(), **options)
+            self.check(iodeflib.parse(iodef.to_xml_str()), options)
+            self.check(iodeflib.parse(iodef.to_xml_str(pretty_print=True)),
+                options)
+            self.check(iodeflib.IODEF_Document(from_xml=iodef.to_xml_str()),
+                options)
+
+    def test_write(self):
+        filename = os.path.join(self.directory, 'out.xml')
+        for options in OPTIONS:
+            iodef = iodeflib.parse(sample_data(), **options)
+            iodef.write(filename, validate='structure')
+            self.check(iodeflib.parse_file(filename, **options), options)
+            iodef.write(filename, pretty_print=True)
+            self.check(iodeflib.parse_file(filename), options)
+
+    def test_parse_file(self):
+        filename = os.path.join(self.directory, 'in.xml')
+        f = open(filename, 'wb')
+        f.write(sample_data())
+        f.close()
+        for options in OPTIONS:
+            for use_mmap in (False, True):
+                self.check(iodeflib.parse_file(filename, use_mmap=use_mmap,
+                    **options), options)
+                f = open(filename, 'rb')
+                try:
+                    self.check(iodeflib.parse_file(f, use_mmap=use_mmap,
+                        **options), options)
+                finally:
+                    f.close()
+            self.check(iodeflib.parse_file(StringIO.StringIO(sample_data()),
+                use_mmap=True, **options), options)
+
+    def test_binary(self):
+        for options in OPTIONS:
+            iodef = iodeflib.parse(sample_data(), **options)
+            f = StringIO.StringIO()
+            iodef.dump_binary(f)
+            for load_options in ({}, {'compact': True},
+                {'datetimes': 'epoch'}):
+                f.seek(0)
+                loaded = iodeflib.load_binary(f, **load_options)
+                self.check(loaded, (options, load_options))
+
+    def test_pickle(self):
+        for options in OPTIONS:
+            if options.get('editable'):
+                # editable objects keep their XML element
+                continue
+            iodef = iodeflib.parse(sample_data(), **options)
+            for protocol in (0, 2):
+                loaded = cPickle.loads(cPickle.dumps(iodef, protocol))
+                self.check(loaded, (options, protocol))
+                self.assertEqual(type(loaded), type(iodef))
+
+    def test_editable(self):
+        # unknown content of an unmodified incident is kept:
+        data = sample_data().replace('<ReportTime>',
+            '<Extension xmlns="urn:example">data</Extension><ReportTime>', 1)
+        iodef = iodeflib.parse(data, editable=True)
+        result = iodeflib.parse(iodef.to_xml_str(), editable=True)
+        self.assertTrue('urn:example' in result.to_xml_str())
+        self.assertFalse(iodef.incidents[0].is_modified())
+        iodef.incidents[1].descriptions.append('modified')
+        result = iodeflib.parse(iodef.to_xml_str())
+        self.assertEqual(result.incidents[1].descriptions[-1], 'modified')
+
+
+if __name__ == '__main__':
+    unittest.main()
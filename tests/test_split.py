@@ -0,0 +1,103 @@
+"""
+tests for split_file
+"""
+
+import unittest, os, tempfile, shutil, threading, time
+
+import iodeflib
+from benchmarks import corpus
+
+
+class SplitFileTest (unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.xml')
+        self.iodef = corpus.generate_document(incidents=200, history=1)
+        self.iodef.lang = 'fr'
+        for i, incident in enumerate(self.iodef.incidents):
+            incident.id_name = 'CSIRT-%d' % (i % 10)
+        self.iodef.write(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pattern(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, filenames):
+        "parse shards, return the list of all their incidents"
+        incidents = []
+        for filename in filenames:
+            shard = iodeflib.parse_file(filename, validate='structure')
+            self.assertEqual(shard.lang, 'fr')
+            self.assertEqual(shard.version, '1.00')
+            incidents += shard.incidents
+        return incidents
+
+    def test_max_incidents(self):
+        for workers in (0, 4):
+            filenames = iodeflib.split_file(self.source,
+                self.pattern('%d-%%(index)03d.xml' % workers),
+                max_incidents=30, workers=workers)
+            self.assertEqual(len(filenames), 7)
+            self.assertEqual([len(iodeflib.parse_file(filename).incidents)
+                for filename in filenames], [30] * 6 + [20])
+            self.assertEqual(iodeflib.diff(self.iodef,
+                self.read(filenames)), [])
+
+    def test_max_bytes(self):
+        filenames = iodeflib.split_file(open(self.source, 'rb'),
+            self.pattern('%(index)d.xml'), max_bytes=20000)
+        for filename in filenames:
+            self.assertTrue(os.path.getsize(filename) <= 20000)
+        self.assertEqual(iodeflib.diff(self.iodef, self.read(filenames)), [])
+
+    def test_key(self):
+        key = lambda incident: incident.id_name
+        # more keys than open files:
+        filenames = iodeflib.split_file(self.source,
+            self.pattern('%(key)s-%(index)d.xml'), key=key, max_incidents=15,
+            max_open=3)
+        self.assertEqual(len(filenames), 20)
+        for name in set(key(incident) for incident in self.iodef.incidents):
+            shards = [filename for filename in filenames
+                if os.path.basename(filename).startswith(name + '-')]
+            expected = [incident for incident in self.iodef.incidents
+                if key(incident) == name]
+            # incidents of each key are in the same order:
+            self.assertEqual(iodeflib.diff(expected, self.read(shards)), [])
+
+    def test_threads(self):
+        module = iodeflib.iodeflib
+        write = module._ShardWriters._write
+        threads = set()
+        def recording_write(self, shard, data):
+            threads.add(threading.current_thread().ident)
+            return write(self, shard, data)
+        module._ShardWriters._write = recording_write
+        try:
+            iodeflib.split_file(self.source, self.pattern('%(key)s.xml'),
+                key=lambda incident: incident.id_name, workers=4)
+        finally:
+            module._ShardWriters._write = write
+        self.assertEqual(len(threads), 4)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, iodeflib.split_file, self.source,
+            self.pattern('shard.xml'), key=lambda incident: incident.id)
+        # the exception of key is not hidden by the error of the writer
+        # thread which could not create the first shard:
+        def key(incident):
+            if incident.id == '1':
+                time.sleep(0.5)
+                raise KeyError(incident.id)
+            return incident.id
+        self.assertRaises(KeyError, iodeflib.split_file, self.source,
+            self.pattern('missing/%(key)s.xml'), key=key, workers=1)
+        self.assertRaises(IOError, iodeflib.split_file, self.source,
+            self.pattern('missing/%(index)d.xml'), max_incidents=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+tests for incremental parsing: iter_incidents, IncidentFeedParser,
+IncidentStreamReader and parse_many
+"""
+
+import unittest, os, tempfile, shutil, StringIO
+
+import iodeflib
+from tests import sample_data, SAMPLE_FILE
+
+
+class StreamTest (unittest.TestCase):
+
+    def setUp(self):
+        self.expected = [iodeflib.fingerprint(incident)
+            for incident in iodeflib.parse(sample_data()).incidents]
+
+    def check(self, incidents):
+        self.assertEqual([iodeflib.fingerprint(incident)
+            for incident in incidents], self.expected)
+
+    def test_iter_incidents(self):
+        for options in ({}, {'compact': True}, {'lazy': True},
+            {'datetimes': 'epoch'}, {'editable': True}):
+            self.check(iodeflib.iter_incidents(SAMPLE_FILE, **options))
+            self.check(iodeflib.iter_incidents(
+                StringIO.StringIO(sample_data()), **options))
+
+    def test_feed_parser(self):
+        data = sample_data()
+        for size in (1, 7, 100, len(data)):
+            parser = iodeflib.IncidentFeedParser()
+            incidents = []
+            for i in xrange(0, len(data), size):
+                parser.feed(data[i:i+size])
+                incidents += parser.read_incidents()
+            parser.close()
+            incidents += parser.read_incidents()
+            self.check(incidents)
+            self.assertEqual(parser.lang, 'en')
+            self.assertEqual(parser.version, '1.00')
+
+    def test_incomplete(self):
+        parser = iodeflib.IncidentFeedParser()
+        parser.feed(sample_data()[:-100])
+        self.assertRaises(SyntaxError, parser.close)
+
+    def test_stream_reader(self):
+        data = sample_data()
+        self.check(iodeflib.IncidentStreamReader(StringIO.StringIO(data),
+            chunk_size=50))
+        chunks = [data[i:i+64] for i in xrange(0, len(data), 64)]
+        self.check(iodeflib.IncidentStreamReader(chunks, compact=True))
+
+
+# document including a local file with an external entity (XXE):
+XXE_DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE IODEF-Document [<!ENTITY secret SYSTEM "file://%s">]>
+<IODEF-Document version="1.00" lang="en"
+  xmlns="urn:ietf:params:xml:ns:iodef-1.0">
+  <Incident purpose="reporting">
+    <IncidentID name="csirt.example.com">&secret;</IncidentID>
+    <ReportTime>2001-09-13T23:19:24+00:00</ReportTime>
+    <Assessment><Impact type="dos"/></Assessment>
+    <EventData><Flow><System category="source"><Node>
+      <Address category="ipv4-addr">192.0.2.200</Address>
+    </Node></System></Flow></EventData>
+  </Incident>
+</IODEF-Document>
+"""
+
+SECRET = 'secret-file-content'
+
+
+class EntityTest (unittest.TestCase):
+    """
+    external entities must never be resolved, with any parsing function
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        secret = os.path.join(self.directory, 'secret.txt')
+        f = open(secret, 'wb')
+        f.write(SECRET)
+        f.close()
+        self.filename = os.path.join(self.directory, 'xxe.xml')
+        f = open(self.filename, 'wb')
+        f.write(XXE_DOCUMENT % secret)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, function, *args, **kwargs):
+        """
+        call function, return its result as a string, which must not contain
+        the secret. (ElementTree raises an error for external entities)
+        """
+        try:
+            result = function(*args, **kwargs)
+            if not isinstance(result, basestring):
+                result = repr(list(result))
+        except SyntaxError:
+            return ''
+        self.assertFalse(SECRET in result, function.__name__)
+        return result
+
+    def test_parsers(self):
+        self.check(lambda: iodeflib.parse_file(self.filename).to_xml_str())
+        self.check(lambda: iodeflib.parse_file(self.filename,
+            use_mmap=True).to_xml_str())
+        self.check(lambda: [incident.id for incident in
+            iodeflib.iter_incidents(self.filename)])
+        self.check(lambda: [incident.id for incident in
+            iodeflib.IncidentStreamReader(open(self.filename, 'rb'))])
+        self.check(lambda: [incident.id for incident in
+            iodeflib.merge_documents([self.filename]).incidents])
+        self.check(lambda: [(chunk['id_values'], chunk['address_values'])
+            for chunk in iodeflib.iter_columns(self.filename)])
+
+    def test_split_file(self):
+        pattern = os.path.join(self.directory, 'shard%(index)d.xml')
+        self.check(iodeflib.split_file, self.filename, pattern,
+            max_incidents=1)
+        for filename in os.listdir(self.directory):
+            if filename.startswith('shard'):
+                f = open(os.path.join(self.directory, filename), 'rb')
+                self.assertFalse(SECRET in f.read())
+                f.close()
+
+
+class ParseManyTest (unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parse_many(self, **options):
+        """
+        parse the sample, an invalid and a missing file with parse_many,
+        check the results and return the sample documents
+        """
+        bad = os.path.join(self.directory, 'bad.xml')
+        f = open(bad, 'wb')
+        f.write('<IODEF-Document')
+        f.close()
+        missing = os.path.join(self.directory, 'missing.xml')
+        paths = [SAMPLE_FILE, bad, SAMPLE_FILE, missing]
+        results = list(iodeflib.parse_many(paths, workers=2, **options))
+        if options.get('ordered', True):
+            self.assertEqual([path for path, result, error in results], paths)
+        else:
+            self.assertEqual(sorted(path for path, result, error in results),
+                sorted(paths))
+        expected = iodeflib.fingerprint(iodeflib.parse(sample_data()))
+        documents = []
+        for path, result, error in results:
+            if path == SAMPLE_FILE:
+                self.assertEqual(error, None)
+                if options.get('incidents'):
+                    result = iodeflib.IODEF_Document(incidents=result)
+                self.assertEqual(iodeflib.fingerprint(result), expected)
+                documents.append(result)
+            else:
+                # errors are reported for each file:
+                self.assertEqual(result, None)
+                self.assertTrue(error)
+        return documents
+
+    def test_threads(self):
+        self.parse_many(threads=True, compact=True)
+        self.parse_many(threads=True, editable=True)
+
+    def test_processes(self):
+        self.parse_many()
+        self.parse_many(incidents=True, compact=True, ordered=False)
+        # lazy documents are fully loaded by pickling:
+        documents = self.parse_many(lazy=True)
+        self.assertEqual(len(documents[0].incidents[0].history), 1)
+        # editable documents lose their source XML:
+        documents = self.parse_many(editable=True)
+        incident = documents[0].incidents[0]
+        self.assertTrue(incident.is_modified())
+        incident.descriptions.append('modified')
+        result = iodeflib.parse(documents[0].to_xml_str())
+        self.assertEqual(result.incidents[0].descriptions[-1], 'modified')
+
+
+if __name__ == '__main__':
+    unittest.main()
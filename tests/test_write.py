@@ -0,0 +1,61 @@
+"""
+tests for the serialization of IODEF documents: to_xml_str and write
+"""
+
+import unittest, os, tempfile, shutil, StringIO
+
+import iodeflib
+from tests import sample_data
+
+# text with XML markup and characters which are not in Latin-1 or ASCII:
+TEXT = u'caf\xe9 <&> "quoted" \u20ac'
+
+
+class WriteTest (unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_round_trip(self, encoding, **options):
+        iodef = iodeflib.parse(sample_data())
+        incident = iodef.incidents[0]
+        incident.descriptions.append(TEXT)
+        # attributes are converted with str(), so they must be ASCII:
+        incident.id_name = 'csirt <&> "quoted"'
+        filename = os.path.join(self.directory, 'out.xml')
+        iodef.write(filename, encoding=encoding, **options)
+        result = iodeflib.parse_file(filename)
+        self.assertEqual(result.incidents[0].descriptions[-1], TEXT)
+        self.assertEqual(result.incidents[0].id_name, 'csirt <&> "quoted"')
+        self.assertEqual(iodeflib.fingerprint(result),
+            iodeflib.fingerprint(iodef))
+
+    def test_utf8(self):
+        self.check_round_trip('UTF-8')
+        self.check_round_trip('UTF-8', pretty_print=True)
+
+    def test_latin1(self):
+        self.check_round_trip('ISO-8859-1')
+
+    def test_ascii(self):
+        self.check_round_trip('ascii')
+
+    def test_file_object(self):
+        iodef = iodeflib.parse(sample_data())
+        f = StringIO.StringIO()
+        iodef.write(f)
+        self.assertEqual(iodeflib.fingerprint(iodeflib.parse(f.getvalue())),
+            iodeflib.fingerprint(iodef))
+
+    def test_to_xml_str(self):
+        iodef = iodeflib.parse(sample_data())
+        iodef.incidents[0].descriptions.append(TEXT)
+        result = iodeflib.parse(iodef.to_xml_str())
+        self.assertEqual(result.incidents[0].descriptions[-1], TEXT)
+
+
+if __name__ == '__main__':
+    unittest.main()